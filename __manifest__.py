@@ -1,7 +1,7 @@
 # __manifest__.py
 {
     'name': 'Розподіл витрат / Service Cost Allocation',
-    'version': '17.0.1.6.1',  # ВЕРСИЯ ПОВЫШЕНА - добавлен конфигурируемый справочник
+    'version': '17.0.1.6.3',  # ВЕРСИЯ ПОВЫШЕНА - базовая запись истории строк подписок
     'category': 'Accounting',
     'summary': 'ABC Cost Allocation for Service Companies',
     'description': """
@@ -33,7 +33,7 @@
                                                                  - Backward compatibility with legacy unit_of_measure Selection fields
                                                                  - Centralized unit management with proper categorization
                                                                  """,
-    'depends': ['base', 'hr', 'hr_timesheet', 'project', 'account', 'sale', 'resource'],
+    'depends': ['base', 'bus', 'hr', 'hr_timesheet', 'project', 'account', 'sale', 'resource'],
     'data': [
         # Security
         'security/security.xml',
@@ -62,6 +62,8 @@
         'views/cost_driver_views.xml',
         'views/employee_cost_views.xml',
         'views/client_allocation_views.xml',
+        'views/timesheet_cost_views.xml',
+        'views/kpi_rollup_views.xml',
 
         # Service catalog views (ПРАВИЛЬНЫЙ ПОРЯДОК!)
         'views/service_classification_views.xml',  # справочник классификаций (первым)
@@ -1 +1,2 @@
-from . import dashboard
\ No newline at end of file
+from . import dashboard
+from . import export
\ No newline at end of file
@@ -1,47 +1,41 @@
-from odoo import http
+from odoo import http, fields
 from odoo.http import request
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+import hashlib
 import json
 import logging
 
 _logger = logging.getLogger(__name__)
 
 
-class CostAllocationDashboard(http.Controller):
+class FallbackPayload(dict):
+    """Zero payload of a section that failed: sent to the client, never cached"""
 
-    @http.route('/cost_allocation/dashboard_data', type='json', auth='user')
-    def get_dashboard_data(self, period_months=12):
-        """Get dashboard data for cost allocation KPIs"""
-        try:
-            data = {}
 
-            # Date ranges
-            end_date = datetime.now().date()
-            start_date = end_date - relativedelta(months=period_months)
+class FallbackList(list):
+    """List counterpart of FallbackPayload"""
 
-            # Current month
-            current_month_start = end_date.replace(day=1)
-            prev_month_start = current_month_start - relativedelta(months=1)
 
-            data.update({
-                'period_info': {
-                    'start_date': start_date.strftime('%Y-%m-%d'),
-                    'end_date': end_date.strftime('%Y-%m-%d'),
-                    'period_months': period_months
-                }
-            })
+FALLBACK_TYPES = (FallbackPayload, FallbackList)
 
-            # Get data with error handling
-            data['cost_overview'] = self._get_cost_overview(current_month_start, prev_month_start)
-            data['client_stats'] = self._get_client_statistics(current_month_start)
-            data['employee_utilization'] = self._get_employee_utilization()
-            data['service_performance'] = self._get_service_performance()
-            data['cost_trends'] = self._get_cost_trends(start_date, end_date)
-            data['top_clients'] = self._get_top_clients(current_month_start)
-            data['pool_distribution'] = self._get_pool_distribution()
-            data['billing_summary'] = self._get_billing_summary(current_month_start)
+# Верхняя граница размера рейтинга клиентов для одного запроса
+TOP_CLIENTS_MAX_LIMIT = 100
 
+
+class CostAllocationDashboard(http.Controller):
+    @http.route('/cost_allocation/dashboard_data', type='json', auth='user')
+    def get_dashboard_data(self, period_months=12, filters=None):
+        """Get dashboard data for cost allocation KPIs (all sections at once)
+
+        :param filters: optional dict with company_ids, client_tag_ids, pool_types,
+                        service_category_ids, date_from and date_to
+        """
+        try:
+            filters = self._parse_filters(filters)
+            sections = self._get_section_specs(period_months, filters)
+            data = {'period_info': self._get_period_info(period_months, filters)}
+            data.update(self._load_sections(sections, list(sections), filters))
             return data
 
         except Exception as e:
@@ -49,14 +43,153 @@ class CostAllocationDashboard(http.Controller):
             # Return safe fallback data
             return self._get_fallback_data(period_months)
 
+    @http.route('/cost_allocation/dashboard_data/<string:section>', type='json', auth='user')
+    def get_dashboard_section(self, section, period_months=12, filters=None):
+        """Get a single dashboard section so widgets can load independently"""
+        filters = self._parse_filters(filters)
+        sections = self._get_section_specs(period_months, filters)
+        if section not in sections:
+            return {'error': f"Unknown dashboard section: {section}"}
+
+        try:
+            data = self._load_sections(sections, [section], filters)
+            data['period_info'] = self._get_period_info(period_months, filters)
+            return data
+
+        except Exception as e:
+            _logger.error(f"Dashboard section {section} error: {str(e)}")
+            return {section: self._get_fallback_data(period_months)[section]}
+
+    @http.route('/cost_allocation/top_clients', type='json', auth='user')
+    def get_top_clients(self, limit=10, metric='cost', date_from=None, date_to=None, filters=None):
+        """Top-N clients for an arbitrary period and ranking metric (not cached)"""
+        filters = self._parse_filters(filters)
+        date_from = fields.Date.to_date(date_from) or datetime.now().date().replace(day=1)
+        date_to = fields.Date.to_date(date_to) or date_from + relativedelta(months=1) - timedelta(days=1)
+        limit = min(max(int(limit), 1), TOP_CLIENTS_MAX_LIMIT)
+        return self._get_top_clients(date_from, filters, limit, metric, date_to)
+
+    def _parse_filters(self, filters):
+        """Normalize dashboard filters; companies are limited to the allowed ones"""
+        filters = filters or {}
+        allowed_company_ids = request.env.companies.ids
+        company_ids = [int(cid) for cid in filters.get('company_ids') or [] if int(cid) in allowed_company_ids]
+
+        return {
+            'company_ids': sorted(company_ids or allowed_company_ids),
+            'client_tag_ids': sorted(int(tag_id) for tag_id in filters.get('client_tag_ids') or []),
+            'pool_types': sorted(filters.get('pool_types') or []),
+            'service_category_ids': sorted(int(cid) for cid in filters.get('service_category_ids') or []),
+            'date_from': fields.Date.to_date(filters.get('date_from')),
+            'date_to': fields.Date.to_date(filters.get('date_to')),
+        }
+
+    def _get_date_range(self, period_months, filters):
+        """(start_date, end_date) of the dashboard; an explicit range overrides period_months"""
+        end_date = filters['date_to'] or datetime.now().date()
+        start_date = filters['date_from'] or end_date - relativedelta(months=period_months)
+        return start_date, end_date
+
+    def _get_client_domain(self, filters, field='client_id'):
+        """Domain restricting a client field (the partner itself if None) by tags and service categories"""
+        prefix = f'{field}.' if field else ''
+        domain = []
+        if filters['client_tag_ids']:
+            domain.append((f'{prefix}category_id', 'in', filters['client_tag_ids']))
+        if filters['service_category_ids']:
+            domain.append((f'{prefix}client_service_ids.category_id', 'in', filters['service_category_ids']))
+        return domain
+
+    def _get_period_info(self, period_months, filters=None):
+        if filters:
+            start_date, end_date = self._get_date_range(period_months, filters)
+        else:
+            end_date = datetime.now().date()
+            start_date = end_date - relativedelta(months=period_months)
+        return {
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d'),
+            'period_months': period_months
+        }
+
+    def _get_section_specs(self, period_months, filters):
+        """Dashboard sections: {name: (compute, cache_key, date_from)}
+
+        date_from is the earliest period the section covers (None if it is
+        not period-bound); it drives cache invalidation.
+        """
+        # Date ranges
+        start_date, end_date = self._get_date_range(period_months, filters)
+
+        # Current month (the month of the range end)
+        current_month_start = end_date.replace(day=1)
+        prev_month_start = current_month_start - relativedelta(months=1)
+
+        month_key = current_month_start.isoformat()
+        return {
+            'cost_overview': (lambda: self._get_cost_overview(current_month_start, prev_month_start, filters),
+                              month_key, prev_month_start),
+            'client_stats': (lambda: self._get_client_statistics(current_month_start, filters),
+                             month_key, current_month_start),
+            'employee_utilization': (lambda: self._get_employee_utilization(current_month_start, filters),
+                                     month_key, current_month_start),
+            'service_performance': (lambda: self._get_service_performance(filters), month_key, None),
+            'cost_trends': (lambda: self._get_cost_trends(start_date, end_date, filters),
+                            f"{start_date.isoformat()}:{end_date.isoformat()}", start_date),
+            'top_clients': (lambda: self._get_top_clients(current_month_start, filters),
+                            month_key, current_month_start),
+            'pool_distribution': (lambda: self._get_pool_distribution(filters), month_key, None),
+            'billing_summary': (lambda: self._get_billing_summary(current_month_start, filters),
+                                month_key, current_month_start),
+            'timesheet_costs': (lambda: self._get_timesheet_costs(current_month_start, filters),
+                                month_key, current_month_start),
+        }
+
+    def _load_sections(self, sections, names, filters):
+        """Return requested sections from the KPI cache, computing only stale ones
+
+        Sections are computed with the caller's rights, so the key holds the
+        caller's groups (record rules of the module only depend on
+        companies) besides the allowed companies and filters. Failed sections
+        are returned as zero payloads but never cached.
+        """
+        cache = request.env['cost.dashboard.cache']
+        company_id = request.env.company.id
+        groups_key = hashlib.sha1(
+            ','.join(str(gid) for gid in sorted(request.env.user.groups_id.ids)).encode()).hexdigest()[:16]
+        companies_key = ','.join(str(cid) for cid in sorted(request.env.companies.ids))
+        filters_key = json.dumps(filters, sort_keys=True, default=str)
+        cache_keys = {name: f"{groups_key}|{companies_key}|{filters_key}|{sections[name][1]}" for name in names}
+
+        data = cache._get_fresh_sections(company_id, cache_keys)
+        cached = list(data)
+
+        recomputed = {}
+        for name in names:
+            if name not in data:
+                compute, key, date_from = sections[name]
+                # Ошибка раздела не должна оставлять транзакцию прерванной для остальных
+                with request.env.cr.savepoint() as savepoint:
+                    data[name] = compute()
+                    if isinstance(data[name], FALLBACK_TYPES):
+                        savepoint.rollback()
+                        continue
+                recomputed[name] = (cache_keys[name], date_from, data[name])
+        # Строка кэша покрывает все компании фильтра - по ним ее и сбрасываем
+        cache._store_sections(company_id, filters['company_ids'], recomputed)
+
+        data['cache_info'] = {
+            'hits': len(cached),
+            'misses': len(names) - len(cached),
+            'ttl': cache._get_ttl(),
+            'recomputed': [name for name in names if name not in cached],
+        }
+        return data
+
     def _get_fallback_data(self, period_months):
         """Return safe fallback data when main data fails"""
         return {
-            'period_info': {
-                'start_date': (datetime.now().date() - relativedelta(months=period_months)).strftime('%Y-%m-%d'),
-                'end_date': datetime.now().date().strftime('%Y-%m-%d'),
-                'period_months': period_months
-            },
+            'period_info': self._get_period_info(period_months),
             'cost_overview': {
                 'current_total': 0,
                 'previous_total': 0,
@@ -98,27 +231,39 @@ class CostAllocationDashboard(http.Controller):
                 'total_cost': 0,
                 'margin_percent': 0,
                 'due_invoices': 0
+            },
+            'timesheet_costs': {
+                'total_hours': 0,
+                'total_cost': 0,
+                'top_projects': [],
+                'top_employees': []
             }
         }
 
-    def _get_cost_overview(self, current_month, prev_month):
+    def _get_cost_overview(self, current_month, prev_month, filters):
         """Get total cost overview and comparison"""
         try:
-            # Current month allocations
-            current_allocations = request.env['client.cost.allocation'].search([
-                ('period_date', '>=', current_month),
-                ('state', 'in', ['calculated', 'confirmed'])
-            ])
-
-            # Previous month allocations
-            prev_allocations = request.env['client.cost.allocation'].search([
-                ('period_date', '>=', prev_month),
-                ('period_date', '<', current_month),
-                ('state', 'in', ['calculated', 'confirmed'])
-            ])
-
-            current_total = sum(current_allocations.mapped('total_cost')) if current_allocations else 0
-            prev_total = sum(prev_allocations.mapped('total_cost')) if prev_allocations else 0
+            # Суммы по месяцам считает БД - один сгруппированный запрос на оба периода
+            monthly = request.env['client.cost.allocation']._read_group(
+                [
+                    ('company_id', 'in', filters['company_ids']),
+                    ('period_date', '>=', prev_month),
+                    ('period_date', '<', current_month + relativedelta(months=1)),
+                    ('state', 'in', ['calculated', 'confirmed'])
+                ] + self._get_client_domain(filters),
+                ['period_date:month'],
+                ['direct_cost:sum', 'indirect_cost:sum', 'admin_cost:sum', 'total_cost:sum'],
+            )
+
+            current = [0.0, 0.0, 0.0, 0.0]
+            prev_total = 0
+            for month, *costs in monthly:
+                costs = [cost or 0 for cost in costs]
+                if month >= current_month:
+                    current = [current_cost + cost for current_cost, cost in zip(current, costs)]
+                else:
+                    prev_total += costs[3]
+            current_direct, current_indirect, current_admin, current_total = current
 
             # Calculate change percentage
             change_percent = 0
@@ -130,49 +275,48 @@ class CostAllocationDashboard(http.Controller):
                 'previous_total': prev_total,
                 'change_percent': round(change_percent, 2),
                 'change_direction': 'up' if change_percent > 0 else 'down' if change_percent < 0 else 'stable',
-                'current_direct': sum(current_allocations.mapped('direct_cost')) if current_allocations else 0,
-                'current_indirect': sum(current_allocations.mapped('indirect_cost')) if current_allocations else 0,
-                'current_admin': sum(current_allocations.mapped('admin_cost')) if current_allocations else 0,
+                'current_direct': current_direct,
+                'current_indirect': current_indirect,
+                'current_admin': current_admin,
             }
         except Exception as e:
             _logger.error(f"Cost overview error: {str(e)}")
-            return {
+            return FallbackPayload({
                 'current_total': 0, 'previous_total': 0, 'change_percent': 0,
                 'change_direction': 'stable', 'current_direct': 0,
                 'current_indirect': 0, 'current_admin': 0,
-            }
+            })
 
-    def _get_client_statistics(self, current_month):
+    def _get_client_statistics(self, current_month, filters):
         """Get client-related statistics"""
         try:
-            # Total clients with services
-            total_clients = request.env['res.partner'].search_count([
+            partner_model = request.env['res.partner']
+            partner_domain = [
                 ('is_company', '=', True),
-                ('service_count', '>', 0)
-            ])
+                '|', ('company_id', '=', False), ('company_id', 'in', filters['company_ids']),
+            ] + self._get_client_domain(filters, field=None)
+
+            # Total clients with services
+            total_clients = partner_model.search_count(partner_domain + [('service_count', '>', 0)])
 
-            # If no service_count field exists, use alternative
+            # If no client has services yet, count all companies
             if total_clients == 0:
-                total_clients = request.env['res.partner'].search_count([
-                    ('is_company', '=', True)
-                ])
+                total_clients = partner_model.search_count(partner_domain)
 
             # Active subscriptions
-            active_subscriptions = 0
-            if hasattr(request.env['res.partner'], 'subscription_count'):
-                active_subscriptions = request.env['res.partner'].search_count([
-                    ('is_company', '=', True),
-                    ('subscription_count', '>', 0)
-                ])
-
-            # Clients with allocations this month
-            clients_with_allocations = request.env['client.cost.allocation'].search([
-                ('period_date', '>=', current_month),
-                ('state', 'in', ['calculated', 'confirmed'])
-            ])
-
-            allocated_clients = len(
-                set(clients_with_allocations.mapped('client_id.id'))) if clients_with_allocations else 0
+            active_subscriptions = partner_model.search_count(partner_domain + [('subscription_count', '>', 0)])
+
+            # Clients with allocations this month - COUNT(DISTINCT) на стороне БД
+            [(allocated_clients,)] = request.env['client.cost.allocation']._read_group(
+                [
+                    ('company_id', 'in', filters['company_ids']),
+                    ('period_date', '>=', current_month),
+                    ('period_date', '<', current_month + relativedelta(months=1)),
+                    ('state', 'in', ['calculated', 'confirmed'])
+                ] + self._get_client_domain(filters),
+                [],
+                ['client_id:count_distinct'],
+            )
 
             return {
                 'total_clients': total_clients,
@@ -182,36 +326,37 @@ class CostAllocationDashboard(http.Controller):
             }
         except Exception as e:
             _logger.error(f"Client statistics error: {str(e)}")
-            return {
+            return FallbackPayload({
                 'total_clients': 0, 'active_subscriptions': 0,
                 'allocated_clients': 0, 'allocation_coverage': 0
-            }
+            })
 
-    def _get_employee_utilization(self):
+    def _get_employee_utilization(self, current_month, filters):
         """Get employee utilization statistics"""
         try:
-            # Get latest workload data
-            workloads = request.env['employee.workload'].search([
-                ('period_date', '>=', datetime.now().date().replace(day=1))
-            ])
-
-            if not workloads:
-                # Fallback to previous month
-                prev_month = datetime.now().date().replace(day=1) - relativedelta(months=1)
-                workloads = request.env['employee.workload'].search([
-                    ('period_date', '>=', prev_month)
+            employee_domain = [('company_id', 'in', filters['company_ids'])]
+            if filters['pool_types']:
+                # Только сотрудники, распределенные в пулы выбранных типов
+                pool_allocations = request.env['cost.pool.allocation'].search([
+                    ('pool_id.pool_type', 'in', filters['pool_types']),
+                    ('pool_id.company_id', 'in', filters['company_ids']),
                 ])
+                employee_domain.append(('id', 'in', pool_allocations.employee_cost_id.employee_id.ids))
+            employees = request.env['hr.employee'].search(employee_domain)
 
-            total_employees = len(workloads)
-            if total_employees == 0:
-                # Fallback to employee count
-                total_employees = request.env['cost.employee'].search_count([('active', '=', True)])
+            # Табели, мощность и нагрузка по сервисам - сгруппированными запросами по выбранным сотрудникам
+            utilization = request.env['employee.workload']._get_utilization_data(current_month, employees.ids)
 
+            total_employees = len(utilization)
             avg_utilization = 0
             overloaded_count = 0
-            if workloads:
-                avg_utilization = sum(workloads.mapped('utilization_percentage')) / total_employees
-                overloaded_count = len(workloads.filtered('overloaded'))
+            if utilization:
+                avg_utilization = sum(
+                    data['utilization_percentage'] for data in utilization.values()) / total_employees
+                overloaded_count = len([
+                    data for data in utilization.values()
+                    if data['utilization_percentage'] > 100
+                ])
 
             return {
                 'total_employees': total_employees,
@@ -221,208 +366,157 @@ class CostAllocationDashboard(http.Controller):
             }
         except Exception as e:
             _logger.error(f"Employee utilization error: {str(e)}")
-            return {
+            return FallbackPayload({
                 'total_employees': 0, 'avg_utilization': 0,
                 'overloaded_count': 0, 'overloaded_percent': 0
-            }
+            })
 
-    def _get_service_performance(self):
+    def _get_service_performance(self, filters):
         """Get service performance metrics"""
         try:
+            service_domain = [('status', '=', 'active')] + self._get_client_domain(filters)
+            if filters['service_category_ids']:
+                service_domain.append(('category_id', 'in', filters['service_category_ids']))
+
             # Active services by type
-            services = request.env['client.service'].search([('status', '=', 'active')])
+            service_groups = request.env['client.service']._read_group(
+                service_domain, ['service_type_id'], ['__count'])
 
-            # Group by service type
             service_types = {}
-            for service in services:
-                if hasattr(service, 'service_type_id') and service.service_type_id:
-                    type_name = service.service_type_id.name
-                elif hasattr(service, 'service_id') and service.service_id:
-                    type_name = service.service_id.name
-                else:
-                    type_name = 'Other'
-
-                if type_name not in service_types:
-                    service_types[type_name] = 0
-                service_types[type_name] += 1
-
-            # Active subscriptions
-            active_subs = 0
-            try:
-                active_subs = request.env['client.service.subscription'].search_count([
-                    ('state', '=', 'active')
-                ])
-            except:
-                pass
-
-            # Revenue from subscriptions this month
-            total_revenue = 0
-            try:
-                monthly_revenue = request.env['client.service.subscription'].search([
-                    ('state', '=', 'active')
-                ])
-                total_revenue = sum(monthly_revenue.mapped('total_amount'))
-            except:
-                pass
+            total_services = 0
+            for service_type, count in service_groups:
+                type_name = service_type.name or 'Other'
+                service_types[type_name] = service_types.get(type_name, 0) + count
+                total_services += count
+
+            # Active subscriptions and their monthly revenue in one query
+            [(active_subs, total_revenue)] = request.env['client.service.subscription']._read_group(
+                [
+                    ('state', '=', 'active'),
+                    ('company_id', 'in', filters['company_ids'])
+                ] + self._get_client_domain(filters),
+                [], ['__count', 'total_amount:sum'])
 
             return {
-                'total_services': len(services),
+                'total_services': total_services,
                 'active_subscriptions': active_subs,
-                'monthly_revenue': total_revenue,
+                'monthly_revenue': total_revenue or 0,
                 'service_types': service_types
             }
         except Exception as e:
             _logger.error(f"Service performance error: {str(e)}")
-            return {
+            return FallbackPayload({
                 'total_services': 0, 'active_subscriptions': 0,
                 'monthly_revenue': 0, 'service_types': {}
-            }
+            })
 
-    def _get_cost_trends(self, start_date, end_date):
+    def _get_cost_trends(self, start_date, end_date, filters):
         """Get cost trends over time"""
         try:
-            allocations = request.env['client.cost.allocation'].search([
-                ('period_date', '>=', start_date),
-                ('period_date', '<=', end_date),
-                ('state', 'in', ['calculated', 'confirmed'])
-            ])
-
-            if not allocations:
-                return {
-                    'months': [], 'direct_costs': [], 'indirect_costs': [],
-                    'admin_costs': [], 'total_costs': []
-                }
-
-            # Group by month
-            monthly_costs = {}
-            for allocation in allocations:
-                month_key = allocation.period_date.strftime('%Y-%m')
-                if month_key not in monthly_costs:
-                    monthly_costs[month_key] = {
-                        'direct': 0, 'indirect': 0, 'admin': 0, 'total': 0
-                    }
-
-                monthly_costs[month_key]['direct'] += allocation.direct_cost
-                monthly_costs[month_key]['indirect'] += allocation.indirect_cost
-                monthly_costs[month_key]['admin'] += allocation.admin_cost
-                monthly_costs[month_key]['total'] += allocation.total_cost
-
-            # Convert to lists for charts
-            months = sorted(monthly_costs.keys())
-            direct_costs = [monthly_costs[month]['direct'] for month in months]
-            indirect_costs = [monthly_costs[month]['indirect'] for month in months]
-            admin_costs = [monthly_costs[month]['admin'] for month in months]
-            total_costs = [monthly_costs[month]['total'] for month in months]
+            client_domain = self._get_client_domain(filters)
+            if client_domain:
+                # Свод не разбит по клиентам - при фильтре по клиентам группируем распределения
+                monthly = request.env['client.cost.allocation']._read_group(
+                    [
+                        ('company_id', 'in', filters['company_ids']),
+                        ('period_date', '>=', start_date),
+                        ('period_date', '<=', end_date),
+                        ('state', 'in', ['calculated', 'confirmed'])
+                    ] + client_domain,
+                    ['period_date:month'],
+                    ['direct_cost:sum', 'indirect_cost:sum', 'admin_cost:sum', 'total_cost:sum'],
+                    order='period_date:month',
+                )
+                monthly = [(month, *costs, 0) for month, *costs in monthly]
+            else:
+                # Одна строка месячного свода на месяц вместо всех распределений
+                monthly = request.env['cost.kpi.monthly']._get_trends(
+                    start_date, end_date, filters['company_ids'])
 
             return {
-                'months': months,
-                'direct_costs': direct_costs,
-                'indirect_costs': indirect_costs,
-                'admin_costs': admin_costs,
-                'total_costs': total_costs
+                'months': [month.strftime('%Y-%m') for month, *values in monthly],
+                'direct_costs': [direct or 0 for month, direct, indirect, admin, total, revenue in monthly],
+                'indirect_costs': [indirect or 0 for month, direct, indirect, admin, total, revenue in monthly],
+                'admin_costs': [admin or 0 for month, direct, indirect, admin, total, revenue in monthly],
+                'total_costs': [total or 0 for month, direct, indirect, admin, total, revenue in monthly],
+                'revenues': [revenue or 0 for month, direct, indirect, admin, total, revenue in monthly]
             }
         except Exception as e:
             _logger.error(f"Cost trends error: {str(e)}")
-            return {
+            return FallbackPayload({
                 'months': [], 'direct_costs': [], 'indirect_costs': [],
                 'admin_costs': [], 'total_costs': []
-            }
+            })
 
-    def _get_top_clients(self, current_month):
-        """Get top clients by cost"""
+    def _get_top_clients(self, current_month, filters, limit=10, metric='cost', date_to=None):
+        """Get top clients ranked by cost, revenue or margin"""
         try:
-            allocations = request.env['client.cost.allocation'].search([
-                ('period_date', '>=', current_month),
-                ('state', 'in', ['calculated', 'confirmed'])
-            ])
-
-            if not allocations:
-                return []
-
-            # Group by client
-            client_costs = {}
-            for allocation in allocations:
-                client_id = allocation.client_id.id
-                client_name = allocation.client_id.name
-
-                if client_id not in client_costs:
-                    service_count = 0
-                    cost_trend = 'new'
-
-                    # Try to get service count
-                    try:
-                        service_count = allocation.client_id.service_count or 0
-                    except:
-                        service_count = 0
-
-                    # Try to get cost trend
-                    try:
-                        cost_trend = allocation.client_id.cost_trend or 'new'
-                    except:
-                        cost_trend = 'new'
-
-                    client_costs[client_id] = {
-                        'name': client_name,
-                        'total_cost': 0,
-                        'service_count': service_count,
-                        'cost_trend': cost_trend
-                    }
-
-                client_costs[client_id]['total_cost'] += allocation.total_cost
-
-            # Sort by total cost and take top 10
-            top_clients = sorted(client_costs.values(), key=lambda x: x['total_cost'], reverse=True)[:10]
-            return top_clients
+            date_to = date_to or current_month + relativedelta(months=1) - timedelta(days=1)
+            client_domain = self._get_client_domain(filters, field=None)
+            client_ids = request.env['res.partner'].search(client_domain).ids if client_domain else None
+            return request.env['client.cost.allocation']._get_top_clients(
+                current_month, date_to, limit=limit, metric=metric,
+                company_ids=filters['company_ids'], client_ids=client_ids)
 
         except Exception as e:
             _logger.error(f"Top clients error: {str(e)}")
-            return []
+            return FallbackList()
 
-    def _get_pool_distribution(self):
+    def _get_pool_distribution(self, filters):
         """Get cost pool distribution"""
         try:
-            pools = request.env['cost.pool'].search([('active', '=', True)])
-
-            pool_data = []
-            for pool in pools:
-                pool_data.append({
-                    'name': pool.name,
-                    'type': pool.pool_type,
-                    'cost': pool.total_monthly_cost
-                })
-
-            return pool_data
+            domain = [('active', '=', True), ('company_id', 'in', filters['company_ids'])]
+            if filters['pool_types']:
+                domain.append(('pool_type', 'in', filters['pool_types']))
+            pools = request.env['cost.pool'].search_read(domain, ['name', 'pool_type', 'total_monthly_cost'])
+
+            return [{
+                'name': pool['name'],
+                'type': pool['pool_type'],
+                'cost': pool['total_monthly_cost']
+            } for pool in pools]
         except Exception as e:
             _logger.error(f"Pool distribution error: {str(e)}")
-            return []
+            return FallbackList()
 
-    def _get_billing_summary(self, current_month):
+    def _get_billing_summary(self, current_month, filters):
         """Get billing and revenue summary"""
         try:
-            # Active subscriptions revenue
-            total_revenue = 0
-            total_cost = 0
-            due_subscriptions = 0
-
-            try:
-                subscriptions = request.env['client.service.subscription'].search([
-                    ('state', '=', 'active')
-                ])
-                total_revenue = sum(subscriptions.mapped('total_amount'))
-
-                # Try to get total cost
-                try:
-                    total_cost = sum(subscriptions.mapped('total_cost'))
-                except:
-                    total_cost = 0
-
-                # Subscriptions due for invoice
-                due_subscriptions = request.env['client.service.subscription'].search_count([
-                    ('state', '=', 'active'),
-                    ('next_invoice_date', '<=', datetime.now().date())
-                ])
-            except:
-                pass
+            subscription_model = request.env['client.service.subscription']
+            subscription_domain = [
+                ('state', '=', 'active'),
+                ('company_id', 'in', filters['company_ids'])
+            ] + self._get_client_domain(filters)
+
+            # Выручка и выставленные счета активных подписок
+            [(total_revenue, total_invoiced)] = subscription_model._read_group(
+                subscription_domain, [], ['total_amount:sum', 'total_invoiced:sum'])
+            total_revenue = total_revenue or 0
+
+            # Себестоимость текущего месяца по клиентам с активными подписками
+            [(total_cost,)] = request.env['client.cost.allocation']._read_group(
+                [
+                    ('company_id', 'in', filters['company_ids']),
+                    ('period_date', '>=', current_month),
+                    ('period_date', '<', current_month + relativedelta(months=1)),
+                    ('state', 'in', ['calculated', 'confirmed']),
+                    ('client_id.subscription_ids.state', '=', 'active')
+                ] + self._get_client_domain(filters),
+                [],
+                ['total_cost:sum'],
+            )
+            total_cost = total_cost or 0
+
+            # Subscriptions due for invoice
+            [(due_subscriptions,)] = request.env['client.service.billing.schedule']._read_group(
+                [
+                    ('state', '=', 'pending'),
+                    ('date', '<=', fields.Date.today()),
+                    ('company_id', 'in', filters['company_ids'])
+                ] + self._get_client_domain(filters),
+                [],
+                ['subscription_id:count_distinct'],
+            )
 
             # Calculate margin
             margin = 0
@@ -433,11 +527,47 @@ class CostAllocationDashboard(http.Controller):
                 'total_revenue': total_revenue,
                 'total_cost': total_cost,
                 'margin_percent': round(margin, 1),
-                'due_invoices': due_subscriptions
+                'due_invoices': due_subscriptions,
+                'total_invoiced': total_invoiced or 0
             }
         except Exception as e:
             _logger.error(f"Billing summary error: {str(e)}")
-            return {
+            return FallbackPayload({
                 'total_revenue': 0, 'total_cost': 0,
-                'margin_percent': 0, 'due_invoices': 0
-            }
\ No newline at end of file
+                'margin_percent': 0, 'due_invoices': 0, 'total_invoiced': 0
+            })
+
+    def _get_timesheet_costs(self, current_month, filters, limit=5):
+        """Get direct cost breakdown by project and employee from timesheet cost facts"""
+        try:
+            fact_model = request.env['timesheet.cost.fact']
+            domain = [
+                ('period_date', '=', current_month),
+                ('company_id', 'in', filters['company_ids'])
+            ] + self._get_client_domain(filters, field='partner_id')
+
+            [(total_hours, total_cost)] = fact_model._read_group(domain, [], ['hours:sum', 'cost:sum'])
+
+            top_projects = fact_model._read_group(
+                domain, ['project_id'], ['hours:sum', 'cost:sum'], order='cost:sum desc', limit=limit)
+            top_employees = fact_model._read_group(
+                domain, ['employee_id'], ['hours:sum', 'cost:sum'], order='cost:sum desc', limit=limit)
+
+            return {
+                'total_hours': total_hours or 0,
+                'total_cost': total_cost or 0,
+                'top_projects': [
+                    {'name': project.display_name, 'hours': hours, 'cost': cost}
+                    for project, hours, cost in top_projects
+                ],
+                'top_employees': [
+                    {'name': employee.name, 'hours': hours, 'cost': cost}
+                    for employee, hours, cost in top_employees
+                ],
+            }
+        except Exception as e:
+            _logger.error(f"Timesheet costs error: {str(e)}")
+            return FallbackPayload({
+                'total_hours': 0, 'total_cost': 0,
+                'top_projects': [], 'top_employees': []
+            })
@@ -0,0 +1,153 @@
+from odoo import http, fields
+from odoo.http import request, content_disposition
+from werkzeug.exceptions import BadRequest
+from werkzeug.wrappers import Response
+from dateutil.relativedelta import relativedelta
+from datetime import timedelta
+import csv
+import io
+import logging
+import tempfile
+
+import xlsxwriter
+
+_logger = logging.getLogger(__name__)
+
+# Строк за одну выборку из серверного курсора
+EXPORT_CHUNK_SIZE = 5000
+# Лимит строк листа Excel (без заголовка)
+XLSX_SHEET_ROWS = 1048575
+
+EXPORT_COLUMNS = [
+    'Allocation', 'Period', 'Company', 'Client', 'Status',
+    'Direct Cost', 'Indirect Cost', 'Administrative Cost', 'Total Cost',
+    'Cost Driver', 'Driver Quantity', 'Cost per Unit', 'Allocated Cost', 'Currency',
+]
+
+EXPORT_QUERY = """
+    SELECT allocation.code, allocation.period_date, company.name, partner.name, allocation.state,
+           allocation.direct_cost, allocation.indirect_cost, allocation.admin_cost, allocation.total_cost,
+           driver.name, indirect.quantity, indirect.cost_per_unit, indirect.allocated_cost, currency.name
+      FROM client_cost_allocation allocation
+      JOIN res_partner partner ON partner.id = allocation.client_id
+      JOIN res_company company ON company.id = allocation.company_id
+ LEFT JOIN res_currency currency ON currency.id = allocation.currency_id
+ LEFT JOIN client_indirect_cost indirect ON indirect.allocation_id = allocation.id
+ LEFT JOIN cost_driver driver ON driver.id = indirect.driver_id
+     WHERE allocation.period_date >= %(date_from)s
+       AND allocation.period_date <= %(date_to)s
+       AND allocation.company_id IN %(company_ids)s
+       {client_filter}
+  ORDER BY allocation.period_date, allocation.id, indirect.id
+"""
+
+
+class CostAllocationExport(http.Controller):
+
+    @http.route('/cost_allocation/export/allocations', type='http', auth='user')
+    def export_allocations(self, date_from=None, date_to=None, export_format='csv', client_ids=None):
+        """Stream allocation x indirect cost detail rows as CSV or XLSX
+
+        Rows are read from a server-side cursor in chunks and written out
+        immediately, so memory use does not depend on the number of rows.
+
+        :param client_ids: optional comma-separated client ids
+        """
+        env = request.env
+        env['client.cost.allocation'].check_access_rights('read')
+
+        date_from = fields.Date.to_date(date_from) or fields.Date.today().replace(day=1)
+        date_to = fields.Date.to_date(date_to) or date_from + relativedelta(months=1) - timedelta(days=1)
+        params = {
+            'date_from': date_from,
+            'date_to': date_to,
+            # Сырой SQL обходит правила записей - ограничиваем разрешенными компаниями явно
+            'company_ids': tuple(env.companies.ids),
+        }
+        client_filter = ''
+        if client_ids:
+            client_filter = 'AND allocation.client_id IN %(client_ids)s'
+            try:
+                params['client_ids'] = tuple(int(cid) for cid in client_ids.split(','))
+            except ValueError:
+                raise BadRequest("client_ids must be a comma-separated list of ids")
+
+        env['client.cost.allocation'].flush_model()
+        env['client.indirect.cost'].flush_model()
+
+        query = EXPORT_QUERY.format(client_filter=client_filter)
+        registry = env.registry
+        filename = f"cost_allocations_{date_from}_{date_to}"
+        if export_format == 'xlsx':
+            body = self._stream_xlsx(registry, query, params)
+            filename += '.xlsx'
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        else:
+            body = self._stream_csv(registry, query, params)
+            filename += '.csv'
+            mimetype = 'text/csv'
+
+        return Response(body, mimetype=mimetype, direct_passthrough=True, headers=[
+            ('Content-Disposition', content_disposition(filename)),
+        ])
+
+    def _iter_rows(self, registry, query, params):
+        """Yield row chunks from a server-side SQL cursor
+
+        The request cursor is closed once the handler returns, so the
+        generator opens its own cursor for the duration of the download and
+        pages through the result with DECLARE/FETCH.
+        """
+        with registry.cursor() as cr:
+            cr.execute(f"DECLARE cost_allocation_export NO SCROLL CURSOR FOR {query}", params)
+            while True:
+                cr.execute("FETCH FORWARD %s FROM cost_allocation_export", [EXPORT_CHUNK_SIZE])
+                rows = cr.fetchall()
+                if not rows:
+                    break
+                yield rows
+
+    def _stream_csv(self, registry, query, params):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in self._iter_rows(registry, query, params):
+            writer.writerows(rows)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+    def _stream_xlsx(self, registry, query, params):
+        # XLSX - zip-архив, его нельзя отдавать по частям до закрытия книги.
+        # constant_memory сбрасывает строки на диск, затем файл отдается блоками
+        with tempfile.TemporaryFile() as output:
+            workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+            header_format = workbook.add_format({'bold': True})
+
+            sheet = None
+            sheet_rows = XLSX_SHEET_ROWS
+            for rows in self._iter_rows(registry, query, params):
+                for row in rows:
+                    # ~2M строк в год не помещаются на один лист
+                    if sheet_rows >= XLSX_SHEET_ROWS:
+                        sheet = workbook.add_worksheet(f"Allocations {len(workbook.worksheets()) + 1}")
+                        sheet.write_row(0, 0, EXPORT_COLUMNS, header_format)
+                        sheet_rows = 0
+                    sheet_rows += 1
+                    sheet.write_row(sheet_rows, 0, row)
+
+            if sheet is None:
+                sheet = workbook.add_worksheet("Allocations 1")
+                sheet.write_row(0, 0, EXPORT_COLUMNS, header_format)
+            workbook.close()
+
+            output.seek(0)
+            while True:
+                data = output.read(io.DEFAULT_BUFFER_SIZE * 16)
+                if not data:
+                    break
+                yield data
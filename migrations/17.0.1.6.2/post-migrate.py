@@ -0,0 +1,39 @@
+# migrations/17.0.1.6.2/post-migrate.py
+
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    """Derive the company of existing allocations from their client
+
+    The required company_id was filled with the installer's company for all
+    historical allocations. Take the client's company, or the company of the
+    client's latest subscription, and rebuild the KPI rollup afterwards.
+    """
+    if not version:
+        return
+
+    cr.execute("""
+        UPDATE client_cost_allocation allocation
+           SET company_id = derived.company_id
+          FROM (
+                SELECT allocation.id,
+                       COALESCE(partner.company_id, (
+                           SELECT subscription.company_id
+                             FROM client_service_subscription subscription
+                            WHERE subscription.client_id = allocation.client_id
+                            ORDER BY subscription.state = 'active' DESC, subscription.start_date DESC
+                            LIMIT 1
+                       )) AS company_id
+                  FROM client_cost_allocation allocation
+                  JOIN res_partner partner ON partner.id = allocation.client_id
+               ) derived
+         WHERE derived.id = allocation.id
+           AND derived.company_id IS NOT NULL
+           AND derived.company_id != allocation.company_id
+    """)
+
+    # Свод по месяцам собран по неверным компаниям - пересобираем всю историю
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['cost.kpi.monthly'].search([]).unlink()
+    env['cost.kpi.monthly'].action_backfill()
@@ -0,0 +1,36 @@
+# migrations/17.0.1.6.3/post-migrate.py
+
+
+def migrate(cr, version):
+    """Seed the baseline history row of subscription lines
+
+    Lines created before the change history have no undated row, so a
+    quantity or price change recorded only the new values and the days
+    before it were billed at zero. Lines without history get their current
+    values; lines changed since get the earliest recorded values, the
+    closest known to what they were billed with.
+    """
+    if not version:
+        return
+
+    cr.execute("""
+        INSERT INTO client_service_subscription_line_change
+                    (line_id, subscription_id, date, quantity, unit_price,
+                     create_uid, create_date, write_uid, write_date)
+        SELECT line.id, line.subscription_id, NULL,
+               COALESCE(first_change.quantity, line.quantity),
+               COALESCE(first_change.unit_price, line.unit_price),
+               1, now() at time zone 'UTC', 1, now() at time zone 'UTC'
+          FROM client_service_subscription_line line
+     LEFT JOIN LATERAL (
+                SELECT change.quantity, change.unit_price
+                  FROM client_service_subscription_line_change change
+                 WHERE change.line_id = line.id
+                 ORDER BY change.date, change.id
+                 LIMIT 1
+               ) first_change ON TRUE
+         WHERE NOT EXISTS (SELECT 1
+                             FROM client_service_subscription_line_change change
+                            WHERE change.line_id = line.id
+                              AND change.date IS NULL)
+    """)
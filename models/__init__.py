@@ -5,12 +5,14 @@ from . import sequence_config
 from . import cost_settings
 from . import working_days_util
 from . import unit_measure
+from . import dashboard_cache      # KPI cache + mixin инвалидации (до моделей, которые его наследуют)
 
 # Core cost allocation models
 from . import employee_cost
 from . import cost_pool
 from . import cost_driver
 from . import client_allocation
+from . import timesheet_cost
 
 # ДОБАВЛЕНО: справочник классификации сервисов (должен быть первым)
 from . import service_classification
@@ -27,6 +29,7 @@ from . import employee_workload     # EmployeeWorkload + EmployeePoolWorkload
 # Billing and automation
 from . import billing_automation
 from . import subscription
+from . import kpi_rollup             # CostKpiMonthly (месячные KPI для дашборда)
 
 # Partner and company extensions
 from . import res_partner
@@ -8,6 +8,22 @@ class AccountMove(models.Model):
     subscription_id = fields.Many2one('client.service.subscription', string='Subscription',
                                       help='Source subscription for this invoice')
 
+    # Ключ идемпотентности: один действующий (не отмененный) счет на подписку и расчетный период
+    billing_period_date = fields.Date(string='Billing Period', copy=False, readonly=True,
+                                      help='Subscription due date this invoice bills')
+
+    def init(self):
+        super().init()
+        # Раньше ключ был ограничением на все счета - отмененный счет блокировал период навсегда
+        self.env.cr.execute("""
+            ALTER TABLE account_move DROP CONSTRAINT IF EXISTS account_move_unique_subscription_billing_period
+        """)
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS account_move_subscription_billing_period_uniq
+                ON account_move (subscription_id, billing_period_date)
+             WHERE state != 'cancel'
+        """)
+
 
 class AccountMoveLine(models.Model):
     _inherit = 'account.move.line'
@@ -1,6 +1,14 @@
-from odoo import models, fields, api
+from odoo import models, fields, api, Command
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Сколько раз автоматически повторять подписку, счет по которой не создался
+BILLING_MAX_ATTEMPTS = 3
+# Пауза перед повторным проходом по упавшим подпискам
+BILLING_RETRY_DELAY = timedelta(minutes=10)
 
 
 class BillingAutomation(models.Model):
@@ -57,67 +65,90 @@ class BillingAutomation(models.Model):
     last_invoice_count = fields.Integer(string='Last Invoice Count', readonly=True)
     total_invoices_created = fields.Integer(string='Total Invoices Created', readonly=True)
 
+    # Runs
+    run_ids = fields.One2many('billing.run', 'automation_id', string='Billing Runs')
+    run_count = fields.Integer(string='Runs', compute='_compute_run_count')
+
+    def _compute_run_count(self):
+        counts = dict(self.env['billing.run']._read_group(
+            [('automation_id', 'in', self.ids)], ['automation_id'], ['__count']))
+        for automation in self:
+            automation.run_count = counts.get(automation, 0)
+
     def action_run_billing(self):
         """Manual run of billing automation"""
         self.ensure_one()
-        return self._run_billing()
+        run = self._run_billing()
+        if not run:
+            return False
+        return run.action_open()
 
-    def _run_billing(self):
-        """Execute billing automation"""
-        if not self.active:
-            return
+    def action_view_runs(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': 'Billing Runs',
+            'res_model': 'billing.run',
+            'view_mode': 'tree,form',
+            'domain': [('automation_id', '=', self.id)],
+            'context': {'default_automation_id': self.id},
+        }
 
-        # Calculate period dates
-        period_start, period_end = self._get_billing_period()
+    def _run_billing(self):
+        """Start (or resume) a billing run
 
-        # Get subscriptions to bill
-        subscriptions = self._get_subscriptions_to_bill()
+        The run gets one line per subscription to bill; the lines are
+        processed in chunks by the billing worker crons, see billing.run.
+        """
+        self.ensure_one()
+        if not self.active:
+            return self.env['billing.run']
 
-        invoices_created = []
-        acts_created = []
+        # Незавершенный запуск продолжаем, а не создаем второй по тем же подпискам
+        run = self.env['billing.run'].search([
+            ('automation_id', '=', self.id),
+            ('state', '=', 'running')
+        ], limit=1)
 
-        for subscription in subscriptions:
-            try:
-                # Create invoice
-                invoice = self._create_invoice(subscription, period_start, period_end)
-                if invoice:
-                    invoices_created.append(invoice)
+        if not run:
+            period_start, period_end = self._get_billing_period()
+            subscriptions = self._get_subscriptions_to_bill()
+            # Рейтинг использования - один проход по всем подпискам запуска
+            subscriptions._rate_usage()
+            run = self.env['billing.run'].create({
+                'automation_id': self.id,
+                'period_start': period_start,
+                'period_end': period_end,
+                'line_ids': [Command.create({'subscription_id': subscription.id}) for subscription in subscriptions],
+            })
 
-                    # Create work act if needed
-                    if self.auto_create_acts:
-                        act = self._create_work_act(subscription, invoice, period_start, period_end)
-                        if act:
-                            acts_created.append(act)
+            self.last_run_date = fields.Date.today()
+            self._calculate_next_run_date()
 
-                    # Update subscription next invoice date
-                    subscription._update_next_invoice_date()
+        if run.line_ids:
+            run._trigger_workers()
+        else:
+            run._finalize()
+        return run
 
-            except Exception as e:
-                # Log error and continue
-                self.env['ir.logging'].create({
-                    'name': f'Billing Automation Error: {subscription.name}',
-                    'type': 'server',
-                    'level': 'ERROR',
-                    'message': str(e),
-                    'func': '_run_billing',
-                    'path': __file__,
-                    'line': 0,
-                })
+    def _bill_subscription(self, subscription, period_start, period_end, resolver=None):
+        """Invoice one subscription of a run
 
-        # Update automation record
-        self.last_run_date = fields.Date.today()
-        self.last_invoice_count = len(invoices_created)
-        self.total_invoices_created += len(invoices_created)
-        self._calculate_next_run_date()
+        A subscription with no line active in its billing period gets no
+        invoice, but the period is still marked handled.
 
-        # Send notifications
-        if self.notify_user_ids and invoices_created:
-            self._send_notifications(invoices_created, acts_created)
+        :param resolver: see _get_billing_resolver
+        :return: (invoice or empty recordset, work act created)
+        """
+        invoice = self._create_invoice(subscription, period_start, period_end, resolver=resolver)
+        act = None
+        # Create work act if needed
+        if invoice and self.auto_create_acts:
+            act = self._create_work_act(subscription, invoice, period_start, period_end)
 
-        return {
-            'invoices': invoices_created,
-            'acts': acts_created
-        }
+        # Update subscription next invoice date
+        subscription._update_next_invoice_date()
+        return invoice, bool(act)
 
     def _get_billing_period(self):
         """Calculate billing period start and end dates"""
@@ -138,29 +169,47 @@ class BillingAutomation(models.Model):
 
     def _get_subscriptions_to_bill(self):
         """Get subscriptions that need billing"""
-        domain = [('state', '=', 'active')]
+        domain = []
 
         if self.subscription_ids:
-            domain.append(('id', 'in', self.subscription_ids.ids))
+            domain.append(('subscription_id', 'in', self.subscription_ids.ids))
         elif self.client_ids:
             domain.append(('client_id', 'in', self.client_ids.ids))
 
         # Check next invoice date
-        domain.append(('next_invoice_date', '<=', fields.Date.today()))
+        return self.env['client.service.billing.schedule']._get_due_subscriptions(domain)
 
-        return self.env['client.service.subscription'].search(domain)
+    def _get_billing_resolver(self, subscriptions):
+        """Products, income accounts and prorated charges for all lines of the subscriptions
 
-    def _create_invoice(self, subscription, period_start, period_end):
-        """Create invoice for subscription"""
-        # Check if invoice already exists for this period
-        existing_invoice = self.env['account.move'].search([
-            ('partner_id', '=', subscription.client_id.id),
-            ('move_type', '=', 'out_invoice'),
-            ('invoice_date', '>=', period_start),
-            ('invoice_date', '<=', period_end),
-            ('ref', 'ilike', subscription.name)
-        ], limit=1)
+        Resolved once per run in a few queries, so preparing invoice lines
+        does not query anything per line. Charges are prorated over each
+        subscription's own billing period, as in the invoicing cron, so a
+        period is billed the same amount whichever path bills it.
+
+        :return: dict with 'products' (service.catalog -> product.product),
+                 'income_accounts' (company id -> account.account)
+                 and 'charges' (line id -> prorated charge)
+        """
+        lines = subscriptions.service_line_ids
+        return {
+            'products': self._get_service_products(lines.service_id),
+            'income_accounts': self.env['client.service.subscription']._get_income_accounts(
+                self.journal_id.company_id),
+            'charges': lines._get_prorated_charges({
+                subscription.id: subscription._get_billing_period_bounds()
+                for subscription in subscriptions
+                if subscription.next_invoice_date
+            }),
+        }
 
+    def _create_invoice(self, subscription, period_start, period_end, resolver=None):
+        """Create invoice for subscription
+
+        :return: the invoice, or an empty recordset when no line was active in the period
+        """
+        # Check if invoice already exists for this period
+        existing_invoice = subscription._get_period_invoices().get(subscription)
         if existing_invoice:
             return existing_invoice
 
@@ -174,45 +223,54 @@ class BillingAutomation(models.Model):
                 ('state', '=', 'confirmed')
             ], limit=1)
 
+        if resolver is None:
+            resolver = self._get_billing_resolver(subscription)
+        income_account = resolver['income_accounts'].get(self.journal_id.company_id.id)
+        # Текст счета - по периоду, за который считаются суммы строк
+        billed_from, billed_to = (subscription._get_billing_period_bounds() if subscription.next_invoice_date
+                                  else (period_start, period_end))
+
         # Create invoice
         invoice_vals = {
             'partner_id': subscription.client_id.id,
             'move_type': 'out_invoice',
+            'subscription_id': subscription.id,
+            'billing_period_date': subscription.next_invoice_date,
             'journal_id': self.journal_id.id,
             'invoice_date': fields.Date.today(),
-            'ref': f"{subscription.name} - {period_start.strftime('%m/%Y')}",
-            'narration': f"IT Services for period {period_start} - {period_end}",
+            'ref': f"{subscription.name} - {billed_from.strftime('%m/%Y')}",
+            'narration': f"IT Services for period {billed_from} - {billed_to}",
+            # Add invoice lines from subscription
+            'invoice_line_ids': [
+                Command.create(line._apply_proration({
+                    'product_id': resolver['products'][line.service_id].id,
+                    'name': line.name or line.service_id.name,
+                    'quantity': line.quantity,
+                    'price_unit': line.unit_price,
+                    'account_id': income_account.id if income_account else False,
+                    'subscription_line_id': line.id,
+                }, resolver['charges'].get(line.id)))
+                for line in subscription.service_line_ids
+                # Строки, не действовавшие в периоде, не выставляются
+                if not resolver['charges'].get(line.id) or resolver['charges'][line.id][1]
+            ],
         }
-
-        invoice = self.env['account.move'].create(invoice_vals)
-
-        # Add invoice lines from subscription
-        for line in subscription.service_line_ids:
-            # Get or create product for service type
-            product = self._get_or_create_product(line.service_id)
-
-            invoice_line_vals = {
-                'move_id': invoice.id,
-                'product_id': product.id,
-                'name': line.name or line.service_id.name,
-                'quantity': line.quantity,
-                'price_unit': line.unit_price,
-                'account_id': self._get_income_account().id,
-            }
-            self.env['account.move.line'].create(invoice_line_vals)
+        # Пустой счет не создаем: action_post на нем падает, и строка запуска сжигает все попытки
+        if not invoice_vals['invoice_line_ids']:
+            return self.env['account.move']
 
         # Add cost allocation summary if available
         if cost_allocation:
-            self._add_cost_allocation_line(invoice, cost_allocation)
+            invoice_vals['invoice_line_ids'].append(
+                Command.create(self._prepare_cost_allocation_line_vals(cost_allocation)))
+
+        invoice = self.env['account.move'].create(invoice_vals)
 
         # Auto confirm if needed
         if self.auto_confirm_invoices:
             invoice.action_post()
 
-        # Auto send if needed
-        if self.auto_send_invoices and invoice.state == 'posted':
-            invoice.action_send_and_print()
-
+        # Отправка по e-mail - отдельным этапом после коммита пакета, см. billing.run.line._deliver_queued
         return invoice
 
     def _create_work_act(self, subscription, invoice, period_start, period_end):
@@ -236,6 +294,11 @@ class BillingAutomation(models.Model):
 
     def _add_cost_allocation_line(self, invoice, cost_allocation):
         """Add cost breakdown as invoice line comment"""
+        self.env['account.move.line'].create(dict(
+            self._prepare_cost_allocation_line_vals(cost_allocation), move_id=invoice.id))
+
+    def _prepare_cost_allocation_line_vals(self, cost_allocation):
+        """Cost breakdown note line values"""
         description = f"""
 Cost Breakdown:
 - Direct Costs: {cost_allocation.direct_cost:.2f}
@@ -245,43 +308,40 @@ Cost Breakdown:
 """
 
         # Add as note line
-        self.env['account.move.line'].create({
-            'move_id': invoice.id,
+        return {
             'name': description,
             'display_type': 'line_note',
-        })
+        }
 
     def _get_income_account(self):
         """Get default income account"""
-        # Try different approaches for finding income account
-        income_account = self.env['account.account'].search([
-            ('account_type', '=', 'income'),
-            ('company_id', '=', self.env.company.id)
-        ], limit=1)
+        company = self.journal_id.company_id or self.env.company
+        return self.env['client.service.subscription']._get_income_accounts(company).get(
+            company.id, self.env['account.account'])
 
-        if not income_account:
-            # Fallback: try by name pattern
-            income_account = self.env['account.account'].search([
-                ('name', 'ilike', 'income'),
-                ('company_id', '=', self.env.company.id)
-            ], limit=1)
+    def _get_or_create_product(self, service_catalog):
+        """Get or create product for service catalog item"""
+        return self._get_service_products(service_catalog)[service_catalog]
 
-        if not income_account:
-            # Last fallback: try by code pattern
-            income_account = self.env['account.account'].search([
-                ('code', 'like', '7%'),
-                ('company_id', '=', self.env.company.id)
-            ], limit=1)
+    def _get_service_products(self, services):
+        """Get or create the products of service catalog items
 
-        return income_account
+        One search for all existing products and one multi-create for the
+        missing ones.
 
-    def _get_or_create_product(self, service_catalog):
-        """Get or create product for service catalog item"""
-        product = self.env['product.template'].search([
-            ('default_code', '=', f"SRV_{service_catalog.code}")
-        ], limit=1)
+        :return: dict service.catalog -> product.product
+        """
+        codes = {service: f"SRV_{service.code}" for service in services}
+        products = {}
+        for product in self.env['product.template'].search([('default_code', 'in', list(set(codes.values())))]):
+            products.setdefault(product.default_code, product)
+
+        missing = {}
+        for service, code in codes.items():
+            if code not in products:
+                missing.setdefault(code, service)
 
-        if not product:
+        if missing:
             category = self.env['product.category'].search([
                 ('name', '=', 'IT Services')
             ], limit=1)
@@ -291,15 +351,17 @@ Cost Breakdown:
                     'name': 'IT Services',
                 })
 
-            product = self.env['product.template'].create({
-                'name': service_catalog.name,
-                'default_code': f"SRV_{service_catalog.code}",
+            for product in self.env['product.template'].create([{
+                'name': service.name,
+                'default_code': code,
                 'type': 'service',
                 'invoice_policy': 'order',
-                'list_price': service_catalog.sales_price,
+                'list_price': service.sales_price,
                 'categ_id': category.id,
-            })
-        return product.product_variant_id
+            } for code, service in missing.items()]):
+                products[product.default_code] = product
+
+        return {service: products[code].product_variant_id for service, code in codes.items()}
 
     def _calculate_next_run_date(self):
         """Calculate next run date based on billing period"""
@@ -318,7 +380,11 @@ Cost Breakdown:
             self.next_run_date = self.next_run_date.replace(day=28)
 
     def _send_notifications(self, invoices, acts):
-        """Send notifications to users"""
+        """Queue notifications to users
+
+        The mails are only queued here; the mail queue cron sends them after
+        the billing transaction commits.
+        """
         subject = f"Billing Automation Complete - {len(invoices)} invoices created"
         body = f"""
 Billing automation '{self.name}' has completed successfully.
@@ -332,13 +398,13 @@ Created invoices:
 {chr(10).join([f"- {inv.name} ({inv.partner_id.name}): {inv.amount_total}" for inv in invoices])}
 """
 
-        for user in self.notify_user_ids:
-            self.env['mail.mail'].create({
-                'subject': subject,
-                'body_html': body.replace(chr(10), '<br/>'),
-                'email_to': user.email,
-                'auto_delete': True,
-            }).send()
+        self.env['mail.mail'].sudo().create([{
+            'subject': subject,
+            'body_html': body.replace(chr(10), '<br/>'),
+            'email_to': user.email,
+            'auto_delete': True,
+        } for user in self.notify_user_ids if user.email])
+        self.env.ref('mail.ir_cron_mail_scheduler_action').sudo()._trigger()
 
     @api.model
     def cron_run_billing_automations(self):
@@ -361,4 +427,368 @@ Created invoices:
                     'func': 'cron_run_billing_automations',
                     'path': __file__,
                     'line': 0,
-                })
\ No newline at end of file
+                })
+
+
+class BillingRun(models.Model):
+    _name = 'billing.run'
+    _description = 'Billing Automation Run'
+    _order = 'date_start desc, id desc'
+
+    name = fields.Char(string='Run', compute='_compute_name', store=True)
+    automation_id = fields.Many2one('billing.automation', string='Automation', required=True,
+                                    ondelete='cascade', index=True)
+    state = fields.Selection([
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('cancelled', 'Cancelled')
+    ], string='Status', default='running', required=True, index=True)
+
+    period_start = fields.Date(string='Period Start', required=True)
+    period_end = fields.Date(string='Period End', required=True)
+    date_start = fields.Datetime(string='Started', default=fields.Datetime.now, readonly=True)
+    date_done = fields.Datetime(string='Finished', readonly=True)
+
+    line_ids = fields.One2many('billing.run.line', 'run_id', string='Subscriptions')
+
+    # Progress
+    subscription_count = fields.Integer(string='Subscriptions', compute='_compute_progress')
+    pending_count = fields.Integer(string='Pending', compute='_compute_progress')
+    done_count = fields.Integer(string='Billed', compute='_compute_progress')
+    skipped_count = fields.Integer(string='Skipped', compute='_compute_progress')
+    failed_count = fields.Integer(string='Failed', compute='_compute_progress')
+    progress = fields.Float(string='Progress (%)', compute='_compute_progress')
+
+    @api.depends('automation_id.name', 'period_start')
+    def _compute_name(self):
+        for run in self:
+            run.name = f"{run.automation_id.name} - {run.period_start and run.period_start.strftime('%m/%Y')}"
+
+    def _compute_progress(self):
+        counts = {
+            (run.id, state): count
+            for run, state, count in self.env['billing.run.line']._read_group(
+                [('run_id', 'in', self.ids)], ['run_id', 'state'], ['__count'])
+        }
+        for run in self:
+            run.pending_count = counts.get((run.id, 'pending'), 0)
+            run.done_count = counts.get((run.id, 'done'), 0)
+            run.skipped_count = counts.get((run.id, 'skipped'), 0)
+            run.failed_count = counts.get((run.id, 'failed'), 0)
+            finished = run.done_count + run.skipped_count + run.failed_count
+            run.subscription_count = run.pending_count + finished
+            run.progress = 100.0 * finished / run.subscription_count if run.subscription_count else 100.0
+
+    def action_open(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': 'Billing Run',
+            'res_model': 'billing.run',
+            'res_id': self.id,
+            'view_mode': 'form',
+            'views': [(False, 'form')]
+        }
+
+    def action_retry_failed(self):
+        """Put failed subscriptions back into the queue, whatever their attempts"""
+        failed_lines = self.line_ids.filtered(lambda line: line.state == 'failed')
+        failed_lines.write({'state': 'pending', 'next_attempt_at': False})
+        self.filtered(lambda run: run.state == 'done' and failed_lines & run.line_ids).write({
+            'state': 'running',
+            'date_done': False,
+        })
+        self.filtered(lambda run: run.state == 'running')._trigger_workers()
+
+    def action_cancel(self):
+        self.line_ids.filtered(lambda line: line.state == 'pending').unlink()
+        self.write({'state': 'cancelled', 'date_done': fields.Datetime.now()})
+
+    @api.model
+    def _get_chunk_size(self):
+        return max(int(self.env['ir.config_parameter'].sudo().get_param(
+            'cost_allocation.billing_chunk_size', 50)), 1)
+
+    @api.model
+    def _get_workers(self):
+        """Worker crons, one per allowed parallel worker
+
+        A cron job never runs twice at the same time, so parallelism comes
+        from several copies of the worker cron. Copies beyond the configured
+        count are deactivated, and reactivated when the count is raised again.
+        """
+        worker_count = max(int(self.env['ir.config_parameter'].sudo().get_param(
+            'cost_allocation.billing_parallel_workers', 2)), 1)
+        crons = self.env['ir.cron'].sudo().with_context(active_test=False)
+        worker = self.env.ref('cost_allocation.cron_billing_run_worker').sudo()
+        workers = worker | crons.search([
+            ('code', '=', worker.code),
+            ('id', '!=', worker.id)
+        ], order='id')
+
+        for index in range(len(workers), worker_count):
+            workers |= worker.copy({'name': f"{worker.name} #{index + 1}"})
+
+        active_workers = workers[:worker_count]
+        to_switch = active_workers.filtered(lambda cron: not cron.active) \
+            | (workers - active_workers).filtered('active')
+        if to_switch:
+            # Выполняющийся cron заблокирован планировщиком - переключим его в следующий раз
+            self.env.cr.execute("""
+                SELECT id FROM ir_cron WHERE id IN %s FOR NO KEY UPDATE SKIP LOCKED
+            """, [tuple(to_switch.ids)])
+            unlocked = crons.browse([cron_id for cron_id, in self.env.cr.fetchall()])
+            (unlocked & active_workers).write({'active': True})
+            (unlocked - active_workers).write({'active': False})
+        return active_workers
+
+    def _trigger_workers(self, at=None):
+        self._get_workers()._trigger(at)
+
+    @api.model
+    def _claim_chunk(self):
+        """Lock the next chunk of pending lines of one run
+
+        SKIP LOCKED lets parallel workers take different chunks; the locks
+        are released with the commit, or with the rollback of a crashed
+        worker, whose lines stay pending for the next worker. Lines put back
+        for a retry are not claimed before their next attempt time.
+        """
+        self.env['billing.run.line'].flush_model(['state', 'run_id', 'next_attempt_at'])
+        now = fields.Datetime.now()
+        self.env.cr.execute("""
+            SELECT line.run_id
+              FROM billing_run_line line
+              JOIN billing_run run ON run.id = line.run_id
+             WHERE line.state = 'pending'
+               AND (line.next_attempt_at IS NULL OR line.next_attempt_at <= %s)
+               AND run.state = 'running'
+             ORDER BY line.run_id, line.id
+             LIMIT 1
+               FOR UPDATE OF line SKIP LOCKED
+        """, [now])
+        row = self.env.cr.fetchone()
+        if not row:
+            return self.env['billing.run.line']
+
+        self.env.cr.execute("""
+            SELECT id
+              FROM billing_run_line
+             WHERE run_id = %s
+               AND state = 'pending'
+               AND (next_attempt_at IS NULL OR next_attempt_at <= %s)
+             ORDER BY id
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        """, [row[0], now, self._get_chunk_size()])
+        return self.env['billing.run.line'].browse([line_id for line_id, in self.env.cr.fetchall()])
+
+    @api.model
+    def cron_process_billing_runs(self):
+        """Cron job (worker): bill pending run lines chunk by chunk
+
+        Each chunk is committed on its own. A line is marked done in the same
+        transaction that creates its invoice, so a crashed worker leaves
+        either both or neither and a resumed run never bills it twice.
+        """
+        while True:
+            lines = self._claim_chunk()
+            if not lines:
+                break
+
+            run = lines.run_id
+            lines._process()
+            if not run.line_ids.filtered(lambda line: line.state == 'pending'):
+                run._finalize()
+
+            if self.env.registry.in_test_mode():
+                break
+            self.env.cr.commit()
+
+            # Письма счетов пакета - после его коммита, задержки SMTP не держат биллинг
+            self.env['billing.run.line']._deliver_queued(lines.ids)
+
+        # Досылаем письма пакетов, чей воркер упал между коммитами
+        self.env['billing.run.line']._deliver_queued()
+
+    def _finalize(self):
+        """Close a run whose queue is empty, or schedule a retry of its failures"""
+        self.ensure_one()
+        # Два воркера могут закончить последние пакеты одновременно
+        self.env.cr.execute("SELECT id FROM billing_run WHERE id = %s FOR UPDATE", [self.id])
+        self.invalidate_recordset(['state'])
+        self.line_ids.invalidate_recordset(['state', 'attempts'])
+        if self.state != 'running' or self.line_ids.filtered(lambda line: line.state == 'pending'):
+            return
+
+        retry_lines = self.line_ids.filtered(
+            lambda line: line.state == 'failed' and line.attempts < BILLING_MAX_ATTEMPTS)
+        if retry_lines:
+            retry_at = fields.Datetime.now() + BILLING_RETRY_DELAY
+            retry_lines.write({'state': 'pending', 'next_attempt_at': retry_at})
+            self._trigger_workers(retry_at)
+            return
+
+        self.state = 'done'
+        self.date_done = fields.Datetime.now()
+
+        done_lines = self.line_ids.filtered(lambda line: line.state == 'done')
+        invoices = done_lines.invoice_id
+        automation = self.automation_id
+        automation.last_invoice_count = len(invoices)
+        automation.total_invoices_created += len(invoices)
+
+        # Send notifications
+        if automation.notify_user_ids and invoices:
+            automation._send_notifications(invoices, done_lines.filtered('act_created'))
+
+
+class BillingRunLine(models.Model):
+    _name = 'billing.run.line'
+    _description = 'Billing Run Subscription'
+    _order = 'run_id, id'
+
+    run_id = fields.Many2one('billing.run', string='Run', required=True, ondelete='cascade', index=True)
+    subscription_id = fields.Many2one('client.service.subscription', string='Subscription', required=True)
+    client_id = fields.Many2one(related='subscription_id.client_id', string='Client')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Billed'),
+        ('skipped', 'Skipped'),
+        ('failed', 'Failed')
+    ], string='Status', default='pending', required=True, index=True)
+
+    invoice_id = fields.Many2one('account.move', string='Invoice', readonly=True)
+    act_created = fields.Boolean(string='Work Act Created', readonly=True)
+    attempts = fields.Integer(string='Attempts', readonly=True)
+    next_attempt_at = fields.Datetime(string='Next Attempt', readonly=True)
+    error = fields.Text(string='Error', readonly=True)
+    send_state = fields.Selection([
+        ('none', 'Not Sent'),
+        ('to_send', 'To Send'),
+        ('queued', 'E-mail Queued'),
+        ('failed', 'E-mail Failed')
+    ], string='E-mail', default='none', required=True, index=True)
+
+    _sql_constraints = [
+        ('unique_run_subscription', 'unique(run_id, subscription_id)',
+         'A subscription can only be billed once per run!')
+    ]
+
+    def _process(self):
+        """Bill the lines, each in its own savepoint
+
+        Subscriptions no longer due at the run date (billed meanwhile by the
+        invoicing cron, paused, ...) are skipped instead of being invoiced for
+        their next period.
+        """
+        for run in self.run_id:
+            run_lines = self.filtered(lambda line: line.run_id == run)
+            run_date = run.date_start.date()
+            due_lines = run_lines.filtered(
+                lambda line: line.subscription_id.next_invoice_date
+                and line.subscription_id.next_invoice_date <= run_date)
+            (run_lines - due_lines).write({
+                'state': 'skipped',
+                'error': f"Not due on {run_date}: already invoiced or no longer billable",
+            })
+            if not due_lines:
+                continue
+
+            try:
+                with self.env.cr.savepoint():
+                    resolver = run.automation_id._get_billing_resolver(due_lines.subscription_id)
+            except Exception as e:
+                # Без справочников не выставить ни одну подписку пакета - считаем попыткой для всех
+                _logger.warning("Billing run %s: resolving products and accounts failed: %s", run.id, e)
+                for line in due_lines:
+                    line.write({
+                        'state': 'failed',
+                        'attempts': line.attempts + 1,
+                        'error': str(e),
+                    })
+                continue
+
+            for line in due_lines:
+                line._bill(resolver)
+
+    def _bill(self, resolver):
+        """Bill one line in a savepoint and record the outcome"""
+        self.ensure_one()
+        run = self.run_id
+        try:
+            with self.env.cr.savepoint():
+                invoice, act_created = run.automation_id._bill_subscription(
+                    self.subscription_id, run.period_start, run.period_end, resolver=resolver)
+            if not invoice:
+                self.write({
+                    'state': 'skipped',
+                    'attempts': self.attempts + 1,
+                    'error': "No service line active in the billing period",
+                })
+                return
+            to_send = (run.automation_id.auto_send_invoices
+                       and invoice.state == 'posted' and not invoice.is_move_sent)
+            self.write({
+                'state': 'done',
+                'invoice_id': invoice.id,
+                'act_created': act_created,
+                'attempts': self.attempts + 1,
+                'error': False,
+                'send_state': 'to_send' if to_send else 'none',
+            })
+        except Exception as e:
+            _logger.warning("Billing run %s: subscription %s failed: %s", run.id, self.subscription_id.id, e)
+            self.write({
+                'state': 'failed',
+                'attempts': self.attempts + 1,
+                'error': str(e),
+            })
+
+    @api.model
+    def _deliver_queued(self, line_ids=None):
+        """Queue the invoice e-mails of billed lines, chunk by chunk
+
+        Lines are claimed with SKIP LOCKED so parallel workers never mail an
+        invoice twice. Templates are rendered for the whole chunk at once and
+        the resulting mails are sent by the mail queue cron, outside of the
+        billing transactions.
+
+        :param line_ids: restrict to these lines (all waiting lines if None)
+        """
+        template = self.env.ref('account.email_template_edi_invoice', raise_if_not_found=False)
+        mail_cron = self.env.ref('mail.ir_cron_mail_scheduler_action').sudo()
+        chunk_size = self.env['billing.run']._get_chunk_size()
+        self.flush_model(['send_state'])
+        while True:
+            self.env.cr.execute("""
+                SELECT id
+                  FROM billing_run_line
+                 WHERE send_state = 'to_send'
+                   {line_filter}
+                 ORDER BY id
+                 LIMIT %(limit)s
+                   FOR UPDATE SKIP LOCKED
+            """.format(line_filter='AND id IN %(line_ids)s' if line_ids else ''), {
+                'line_ids': tuple(line_ids or ()),
+                'limit': chunk_size,
+            })
+            lines = self.browse([line_id for line_id, in self.env.cr.fetchall()])
+            if not lines:
+                break
+
+            invoices = lines.invoice_id
+            try:
+                with self.env.cr.savepoint():
+                    if template:
+                        template.send_mail_batch(invoices.ids)
+                    invoices.write({'is_move_sent': True})
+                lines.write({'send_state': 'queued'})
+                mail_cron._trigger()
+            except Exception as e:
+                _logger.warning("Billing run invoice e-mails failed: %s", e)
+                lines.write({'send_state': 'failed', 'error': str(e)})
+
+            if self.env.registry.in_test_mode():
+                break
+            self.env.cr.commit()
@@ -2,19 +2,28 @@ from odoo import models, fields, api
 from odoo.exceptions import ValidationError
 from datetime import datetime, date, timedelta
 
+# Метрики рейтинга клиентов -> выражение сортировки
+TOP_CLIENT_METRICS = {
+    'cost': 'cost',
+    'revenue': 'revenue',
+    'margin': 'margin',
+}
+
 
 class ClientCostAllocation(models.Model):
     _name = 'client.cost.allocation'
     _description = 'Client Cost Allocation'
     _order = 'period_date desc, client_id'
     _rec_name = 'display_name'
-    _inherit = ['mail.thread', 'mail.activity.mixin', 'sequence.helper']
+    _inherit = ['mail.thread', 'mail.activity.mixin', 'sequence.helper', 'cost.dashboard.cache.mixin']
+    _dashboard_period_field = 'period_date'
 
     # ДОБАВЛЕНО: поле кода
     code = fields.Char(string='Allocation Code', readonly=True, copy=False)
     client_id = fields.Many2one('res.partner', string='Client', required=True,
-                                domain=[('is_company', '=', True)], tracking=True)
-    period_date = fields.Date(string='Period', required=True, default=fields.Date.today, tracking=True)
+                                domain=[('is_company', '=', True)], tracking=True, index=True)
+    period_date = fields.Date(string='Period', required=True, default=fields.Date.today, tracking=True,
+                              index=True)
 
     # Cost breakdown
     direct_cost = fields.Monetary(string='Direct Costs', tracking=True, currency_field='currency_id')
@@ -40,6 +49,8 @@ class ClientCostAllocation(models.Model):
 
     # Currency
     currency_id = fields.Many2one('res.currency', default=lambda self: self.env.company.currency_id)
+    company_id = fields.Many2one('res.company', string='Company', required=True, index=True,
+                                 default=lambda self: self.env.company)
 
     @api.depends('client_id', 'period_date')
     def _compute_display_name(self):
@@ -100,10 +111,12 @@ class ClientCostAllocation(models.Model):
 
     def action_calculate_costs(self):
         """Calculate all costs for this allocation"""
-        for record in self:
-            # 1. Calculate direct costs from timesheets
-            record._calculate_direct_costs()
+        kpi_before = self._get_kpi_snapshot()
 
+        # 1. Calculate direct costs from the timesheet cost facts (whole batch at once)
+        self._calculate_direct_costs()
+
+        for record in self:
             # 2. Calculate indirect costs from drivers
             record._calculate_indirect_costs()
 
@@ -112,31 +125,25 @@ class ClientCostAllocation(models.Model):
             record.state = 'calculated'
             record.message_post(body="Cost calculation completed")
 
-    def _calculate_direct_costs(self):
-        """Calculate direct costs from timesheet entries"""
-        self.ensure_one()
+        self._refresh_kpi_rollup()
+        self._notify_kpi_delta(kpi_before, 'allocation_calculated')
 
-        # Get timesheet entries for this client and period
-        domain = [
-            ('project_id.partner_id', '=', self.client_id.id),
-            ('date', '>=', self.period_date.replace(day=1)),
-            ('date', '<=', self._get_month_end())
-        ]
-
-        timesheet_lines = self.env['account.analytic.line'].search(domain)
+    def _calculate_direct_costs(self):
+        """Calculate direct costs from timesheet cost facts of the period"""
+        fact_model = self.env['timesheet.cost.fact']
+        periods = {record.period_date.replace(day=1) for record in self}
 
-        total_direct_cost = 0
-        for line in timesheet_lines:
-            if line.employee_id:
-                # Get employee hourly cost
-                employee_cost = self.env['cost.employee'].search([
-                    ('employee_id', '=', line.employee_id.id)
-                ], limit=1)
+        # Факты пересобираем из текущих табелей, но только по клиентам этих распределений;
+        # весь месяц пересобирает cron
+        fact_model._refresh_periods(periods, partner_ids=self.client_id.ids)
+        costs = fact_model._get_cost_by_partner(periods, self.client_id.ids)
 
-                if employee_cost:
-                    total_direct_cost += line.unit_amount * employee_cost.hourly_cost
+        for record in self:
+            record.direct_cost = costs.get((record.client_id.id, record.period_date.replace(day=1)), 0.0)
 
-        self.direct_cost = total_direct_cost
+    def action_refresh_timesheet_costs(self):
+        """Rebuild timesheet cost facts for these periods and recalculate direct costs"""
+        self._calculate_direct_costs()
 
     def _calculate_indirect_costs(self):
         """Calculate indirect costs from cost drivers"""
@@ -164,6 +171,115 @@ class ClientCostAllocation(models.Model):
                     'allocated_cost': client_driver.allocated_cost
                 })
 
+    @api.model
+    def _get_top_clients(self, date_from, date_to, limit=10, metric='cost', company_ids=None, client_ids=None):
+        """Rank clients for a period with one SQL query
+
+        Costs of the period and of the equally long period before it, monthly
+        subscription revenue scaled to the period length and active service
+        counts are joined per client and ranked with a window function.
+        Ties are broken by client id, so at most `limit` clients are returned.
+
+        :param metric: 'cost', 'revenue' or 'margin' (revenue - cost)
+        :param client_ids: restrict the ranking to these clients (all if None)
+        :return: list of dicts ordered by rank
+        """
+        if metric not in TOP_CLIENT_METRICS:
+            raise ValidationError(f"Unknown ranking metric: {metric}")
+        if company_ids is None:
+            company_ids = self.env.companies.ids
+        client_filter = "AND client_id IN %(client_ids)s" if client_ids is not None else ""
+
+        period_days = (date_to - date_from).days + 1
+        prev_from = date_from - timedelta(days=period_days)
+        months = max(1, round(period_days / 30.4))
+
+        self.flush_model(['client_id', 'company_id', 'period_date', 'state', 'total_cost'])
+        self.env['client.service.subscription'].flush_model(
+            ['client_id', 'company_id', 'state', 'start_date', 'end_date', 'total_amount'])
+        self.env['client.service'].flush_model(['client_id', 'status'])
+
+        self.env.cr.execute(f"""
+            WITH costs AS (
+                SELECT client_id,
+                       SUM(total_cost) FILTER (WHERE period_date >= %(date_from)s) AS cost,
+                       SUM(total_cost) FILTER (WHERE period_date < %(date_from)s) AS prev_cost
+                  FROM client_cost_allocation
+                 WHERE state IN ('calculated', 'confirmed')
+                   AND company_id IN %(company_ids)s
+                   AND period_date >= %(prev_from)s
+                   AND period_date <= %(date_to)s
+                   {client_filter}
+                 GROUP BY client_id
+            ), revenues AS (
+                SELECT client_id, SUM(total_amount) * %(months)s AS revenue
+                  FROM client_service_subscription
+                 WHERE state != 'draft'
+                   AND company_id IN %(company_ids)s
+                   AND start_date <= %(date_to)s
+                   AND (end_date >= %(date_from)s OR (end_date IS NULL AND state = 'active'))
+                   {client_filter}
+                 GROUP BY client_id
+            ), clients AS (
+                SELECT COALESCE(c.client_id, r.client_id) AS client_id,
+                       COALESCE(c.cost, 0) AS cost,
+                       c.prev_cost,
+                       COALESCE(r.revenue, 0) AS revenue,
+                       COALESCE(r.revenue, 0) - COALESCE(c.cost, 0) AS margin
+                  FROM costs c
+                  FULL JOIN revenues r ON r.client_id = c.client_id
+                 WHERE c.cost IS NOT NULL OR r.revenue IS NOT NULL
+            ), ranked AS (
+                SELECT clients.*,
+                       ROW_NUMBER() OVER (ORDER BY {TOP_CLIENT_METRICS[metric]} DESC, client_id) AS rank
+                  FROM clients
+            )
+            SELECT ranked.client_id, partner.name, ranked.rank, ranked.cost, ranked.prev_cost,
+                   ranked.revenue, ranked.margin, COALESCE(services.count, 0) AS service_count
+              FROM ranked
+              JOIN res_partner partner ON partner.id = ranked.client_id
+              LEFT JOIN LATERAL (
+                  SELECT COUNT(*) AS count
+                    FROM client_service
+                   WHERE client_service.client_id = ranked.client_id
+                     AND client_service.status = 'active'
+              ) services ON TRUE
+             WHERE ranked.rank <= %(limit)s
+             ORDER BY ranked.rank, ranked.client_id
+        """, {
+            'date_from': date_from,
+            'date_to': date_to,
+            'prev_from': prev_from,
+            'months': months,
+            'company_ids': tuple(company_ids) or (None,),
+            'client_ids': tuple(client_ids or []) or (None,),
+            'limit': limit,
+        })
+
+        result = []
+        for client_id, name, rank, cost, prev_cost, revenue, margin, service_count in self.env.cr.fetchall():
+            # Тот же порог 5%, что и в res.partner.cost_trend
+            if prev_cost is None:
+                trend = 'new'
+            elif abs(cost - prev_cost) / max(prev_cost, 1) < 0.05:
+                trend = 'stable'
+            else:
+                trend = 'up' if cost > prev_cost else 'down'
+
+            result.append({
+                'id': client_id,
+                'name': name,
+                'rank': rank,
+                'total_cost': cost,
+                'previous_cost': prev_cost or 0,
+                'revenue': revenue,
+                'margin': margin,
+                'margin_percent': round(margin / revenue * 100, 1) if revenue else 0,
+                'service_count': service_count,
+                'cost_trend': trend,
+            })
+        return result
+
     def _get_month_end(self):
         """Get last day of the period month"""
         if self.period_date.month == 12:
@@ -173,8 +289,53 @@ class ClientCostAllocation(models.Model):
 
     def action_confirm(self):
         """Confirm the allocation"""
+        kpi_before = self._get_kpi_snapshot()
         self.state = 'confirmed'
         self.message_post(body="Cost allocation confirmed")
+        self._refresh_kpi_rollup()
+        self._notify_kpi_delta(kpi_before, 'allocation_confirmed')
+
+    def _get_kpi_snapshot(self):
+        """Dashboard-relevant values per allocation: {id: (counted, direct, indirect, admin, total)}"""
+        return {
+            record.id: (
+                record.state in ('calculated', 'confirmed'),
+                record.direct_cost, record.indirect_cost, record.admin_cost, record.total_cost,
+            )
+            for record in self
+        }
+
+    def _notify_kpi_delta(self, before, event):
+        """Send cost deltas per (company, month) to open dashboards"""
+        deltas = {}
+        for record in self:
+            counted, *old_costs = before.get(record.id, (False, 0, 0, 0, 0))
+            old_costs = old_costs if counted else [0, 0, 0, 0]
+            new_costs = [record.direct_cost, record.indirect_cost, record.admin_cost, record.total_cost]
+            if record.state not in ('calculated', 'confirmed'):
+                new_costs = [0, 0, 0, 0]
+
+            key = (record.company_id.id, record.period_date.strftime('%Y-%m'))
+            delta = deltas.setdefault(key, {'direct': 0, 'indirect': 0, 'admin': 0, 'total': 0,
+                                            'new_clients': set()})
+            for name, old, new in zip(('direct', 'indirect', 'admin', 'total'), old_costs, new_costs):
+                delta[name] += new - old
+            if not counted and record.state in ('calculated', 'confirmed'):
+                delta['new_clients'].add(record.client_id.id)
+
+        cache = self.env['cost.dashboard.cache']
+        for (company_id, period), delta in deltas.items():
+            cache._notify_kpi_update([company_id], {
+                'event': event,
+                'company_id': company_id,
+                'period': period,
+                'cost_delta': {name: delta[name] for name in ('direct', 'indirect', 'admin', 'total')},
+                'client_ids': list(delta['new_clients']),
+            })
+
+    def _refresh_kpi_rollup(self):
+        """Rebuild monthly KPI rollup rows of these allocations' periods"""
+        self.env['cost.kpi.monthly']._refresh_months(self.mapped('period_date'), self.company_id.ids)
 
     _sql_constraints = [
         ('unique_client_period', 'unique(client_id, period_date)',
@@ -11,7 +11,7 @@ class ClientService(models.Model):
 
     code = fields.Char(string='Service Code', readonly=True, copy=False)
     client_id = fields.Many2one('res.partner', string='Client',
-                                domain=[('is_company', '=', True)], required=True)
+                                domain=[('is_company', '=', True)], required=True, index=True)
 
     # ОСНОВНЫЕ связи
     service_type_id = fields.Many2one('service.type', string='Service Type', required=True)
@@ -20,7 +20,7 @@ class ClientService(models.Model):
 
     # Категория берется из service_type
     category_id = fields.Many2one('service.category', string='Category',
-                                  related='service_type_id.category_id', store=True, readonly=True)
+                                  related='service_type_id.category_id', store=True, readonly=True, index=True)
 
     # Equipment/Service details
     name = fields.Char(string='Equipment/Service Name', required=True)
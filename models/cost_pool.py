@@ -6,7 +6,7 @@ class CostPool(models.Model):
     _name = 'cost.pool'
     _description = 'Cost Pool'
     _rec_name = 'name'
-    _inherit = ['sequence.helper']  # ДОБАВЛЕНО: наследование для автогенерации кодов
+    _inherit = ['sequence.helper', 'cost.dashboard.cache.mixin']  # ДОБАВЛЕНО: наследование для автогенерации кодов
 
     name = fields.Char(string='Pool Name', required=True)
     code = fields.Char(string='Pool Code', readonly=True, copy=False)  # ДОБАВЛЕНО: поле кода
@@ -15,7 +15,7 @@ class CostPool(models.Model):
         ('direct', 'Direct Costs'),
         ('indirect', 'Indirect Costs'),
         ('admin', 'Administrative Costs')
-    ], string='Pool Type', default='indirect', required=True)
+    ], string='Pool Type', default='indirect', required=True, index=True)
 
     active = fields.Boolean(string='Active', default=True)
 
@@ -32,7 +32,7 @@ class CostPool(models.Model):
                                             string='Available Drivers')
 
     # ДОБАВЛЕНО: поле company_id для multi-company
-    company_id = fields.Many2one('res.company', string='Company', required=True,
+    company_id = fields.Many2one('res.company', string='Company', required=True, index=True,
                                  default=lambda self: self.env.company)
 
     @api.depends()
@@ -81,6 +81,32 @@ class CostAllocationSettings(models.TransientModel):
         help="Automatically generate codes for new records"
     )
 
+    # Dashboard KPI cache
+    dashboard_cache_ttl = fields.Integer(
+        string='Dashboard Cache TTL (seconds)',
+        default=300,
+        config_parameter='cost_allocation.dashboard_cache_ttl',
+        default_model='cost.allocation.settings',
+        help="How long computed dashboard sections are reused; 0 disables the cache"
+    )
+
+    # Billing runs
+    billing_parallel_workers = fields.Integer(
+        string='Parallel Billing Workers',
+        default=2,
+        config_parameter='cost_allocation.billing_parallel_workers',
+        default_model='cost.allocation.settings',
+        help="Number of cron workers processing billing run chunks at the same time"
+    )
+
+    billing_chunk_size = fields.Integer(
+        string='Billing Chunk Size',
+        default=50,
+        config_parameter='cost_allocation.billing_chunk_size',
+        default_model='cost.allocation.settings',
+        help="Subscriptions billed and committed together by a billing worker"
+    )
+
     @api.constrains('admin_cost_percentage')
     def _check_admin_percentage(self):
         for record in self:
@@ -99,4 +125,12 @@ class CostAllocationSettings(models.TransientModel):
             if record.default_working_hours_month <= 0:
                 raise ValidationError("Working hours per month must be positive")
             if record.default_working_days_month <= 0:
-                raise ValidationError("Working days per month must be positive")
\ No newline at end of file
+                raise ValidationError("Working days per month must be positive")
+
+    @api.constrains('billing_parallel_workers', 'billing_chunk_size')
+    def _check_billing_parameters(self):
+        for record in self:
+            if record.billing_parallel_workers < 1:
+                raise ValidationError("At least one billing worker is required")
+            if record.billing_chunk_size < 1:
+                raise ValidationError("Billing chunk size must be positive")
\ No newline at end of file
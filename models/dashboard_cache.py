@@ -0,0 +1,204 @@
+# models/dashboard_cache.py
+
+from odoo import models, fields, api
+from datetime import timedelta
+import functools
+import json
+
+# Разделы дашборда, которые зависят от изменений модели
+SECTION_DEPENDENCIES = {
+    'client.cost.allocation': ['cost_overview', 'client_stats', 'cost_trends', 'top_clients', 'billing_summary'],
+    'client.service.subscription': ['client_stats', 'service_performance', 'billing_summary'],
+    'cost.pool': ['pool_distribution'],
+    'employee.workload': ['employee_utilization'],
+    'timesheet.cost.fact': ['timesheet_costs'],
+    'cost.kpi.monthly': ['cost_trends'],
+    'client.service.billing.schedule': ['billing_summary'],
+}
+
+
+class DashboardKpiCache(models.Model):
+    _name = 'cost.dashboard.cache'
+    _description = 'Dashboard KPI Cache'
+    _order = 'company_id, section'
+
+    company_id = fields.Many2one('res.company', string='Company', required=True, ondelete='cascade')
+    section = fields.Char(string='Section', required=True)
+    cache_key = fields.Char(string='Cache Key', required=True,
+                            help='Period parameters the section was computed for')
+    covered_company_ids = fields.Char(string='Covered Companies',
+                                      help='Comma-separated ids of all companies included in the payload')
+    date_from = fields.Date(string='Covers From',
+                            help='Earliest period included in the section; empty if not period-bound')
+    payload = fields.Text(string='Payload (JSON)')
+    computed_at = fields.Datetime(string='Computed At', required=True)
+
+    _sql_constraints = [
+        ('unique_section_key', 'unique(company_id, section, cache_key)',
+         'Only one cache entry per company, section and key is allowed!')
+    ]
+
+    @api.model
+    def _get_ttl(self):
+        """Cache time-to-live in seconds"""
+        return int(self.env['ir.config_parameter'].sudo().get_param('cost_allocation.dashboard_cache_ttl', 300))
+
+    @api.model
+    def _get_fresh_sections(self, company_id, cache_keys):
+        """Return cached payloads that are still within TTL
+
+        :param cache_keys: dict {section: cache_key}
+        :return: dict {section: payload}
+        """
+        ttl = self._get_ttl()
+        if ttl <= 0 or not cache_keys:
+            return {}
+
+        entries = self.sudo().search_read([
+            ('company_id', '=', company_id),
+            ('section', 'in', list(cache_keys)),
+            ('computed_at', '>=', fields.Datetime.now() - timedelta(seconds=ttl)),
+        ], ['section', 'cache_key', 'payload'])
+
+        return {
+            entry['section']: json.loads(entry['payload'])
+            for entry in entries
+            if cache_keys.get(entry['section']) == entry['cache_key']
+        }
+
+    @api.model
+    def _store_sections(self, company_id, covered_company_ids, entries):
+        """Upsert recomputed sections with one statement
+
+        :param covered_company_ids: all companies whose data the payloads include
+        :param entries: dict {section: (cache_key, date_from, payload)}
+        """
+        if not entries or self._get_ttl() <= 0:
+            return
+
+        covered = ','.join(str(cid) for cid in sorted(covered_company_ids))
+        values_sql = ', '.join(["(%s, %s, %s, %s, %s, %s, now() at time zone 'UTC', %s, %s,"
+                                " now() at time zone 'UTC', now() at time zone 'UTC')"] * len(entries))
+        params = []
+        for section, (cache_key, date_from, payload) in entries.items():
+            params += [company_id, section, cache_key, covered, date_from, json.dumps(payload, default=str),
+                       self.env.uid, self.env.uid]
+
+        self.env.cr.execute(f"""
+            INSERT INTO cost_dashboard_cache
+                   (company_id, section, cache_key, covered_company_ids, date_from, payload, computed_at,
+                    create_uid, write_uid, create_date, write_date)
+            VALUES {values_sql}
+            ON CONFLICT (company_id, section, cache_key) DO UPDATE
+               SET covered_company_ids = EXCLUDED.covered_company_ids,
+                   date_from = EXCLUDED.date_from,
+                   payload = EXCLUDED.payload,
+                   computed_at = EXCLUDED.computed_at,
+                   write_uid = EXCLUDED.write_uid,
+                   write_date = EXCLUDED.write_date
+        """, params)
+
+    @api.model
+    def _invalidate(self, model_name, period=None, company_ids=None):
+        """Drop cached sections affected by a change of model_name records
+
+        The rows are deleted after commit in a separate transaction: a DELETE
+        inside the writing transaction would lock the shared cache rows until
+        commit and serialize concurrent writers (e.g. parallel billing workers).
+
+        :param period: latest changed period; sections covering it (or not
+                       period-bound) are dropped. None drops all of them.
+        :param company_ids: restrict to entries covering any of these companies (all if None)
+        """
+        if not SECTION_DEPENDENCIES.get(model_name):
+            return
+
+        postcommit = self.env.cr.postcommit
+        pending = postcommit.data.setdefault('cost_dashboard_cache.invalidate', {})
+        if not pending:
+            postcommit.add(functools.partial(self._flush_invalidations, pending))
+
+        # Изменения одной транзакции по модели сводим к одному DELETE
+        scope = pending.setdefault(model_name, {'period': period, 'company_ids': set()})
+        if scope['period'] and (not period or period > scope['period']):
+            scope['period'] = period
+        if scope['company_ids'] is not None:
+            scope['company_ids'] = scope['company_ids'] | set(company_ids) if company_ids else None
+
+    @api.model
+    def _flush_invalidations(self, pending):
+        """Post-commit: delete the cache rows collected by _invalidate"""
+        with self.env.registry.cursor() as cr:
+            for model_name, scope in pending.items():
+                query = "DELETE FROM cost_dashboard_cache WHERE section IN %s"
+                params = [tuple(SECTION_DEPENDENCIES[model_name])]
+                if scope['company_ids']:
+                    # Строка затронута, если покрывает хотя бы одну из измененных компаний
+                    query += (" AND (covered_company_ids IS NULL"
+                              " OR string_to_array(covered_company_ids, ',')::int[] && %s::int[])")
+                    params.append(sorted(scope['company_ids']))
+                if scope['period']:
+                    query += " AND (date_from IS NULL OR date_from <= %s)"
+                    params.append(scope['period'])
+                cr.execute(query, params)
+
+    @api.model
+    def _notify_kpi_update(self, company_ids, payload):
+        """Push a KPI delta to dashboard users of these companies over the bus
+
+        Sent after commit by bus.bus; open dashboards patch their widgets
+        with the payload instead of reloading everything.
+        """
+        users = self.env['res.users'].sudo().search([
+            ('groups_id', 'in', self.env.ref('cost_allocation.group_cost_allocation_manager').id),
+            ('company_ids', 'in', list(company_ids)),
+        ])
+        if users:
+            self.env['bus.bus']._sendmany([
+                (user.partner_id, 'cost_allocation/kpi_update', payload) for user in users
+            ])
+
+
+class DashboardCacheMixin(models.AbstractModel):
+    """Invalidates dashboard KPI cache when records change"""
+    _name = 'cost.dashboard.cache.mixin'
+    _description = 'Dashboard Cache Invalidation Mixin'
+
+    # Поле периода для точечной инвалидации (None - сбрасываем все разделы модели)
+    _dashboard_period_field = None
+
+    def _get_dashboard_cache_scope(self, vals=None):
+        """Latest affected period and companies of these records"""
+        period = None
+        if self._dashboard_period_field:
+            periods = [period for period in self.mapped(self._dashboard_period_field) if period]
+            if vals and vals.get(self._dashboard_period_field):
+                periods.append(fields.Date.to_date(vals[self._dashboard_period_field]))
+            period = max(periods) if periods else None
+
+        company_ids = None
+        if 'company_id' in self._fields:
+            company_ids = self.mapped('company_id').ids or None
+
+        return period, company_ids
+
+    def _invalidate_dashboard_cache(self, vals=None):
+        period, company_ids = self._get_dashboard_cache_scope(vals)
+        self.env['cost.dashboard.cache']._invalidate(self._name, period, company_ids)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        records._invalidate_dashboard_cache()
+        return records
+
+    def write(self, vals):
+        # Старые периоды тоже затронуты - определяем до записи
+        period, company_ids = self._get_dashboard_cache_scope(vals)
+        result = super().write(vals)
+        self.env['cost.dashboard.cache']._invalidate(self._name, period, company_ids)
+        return result
+
+    def unlink(self):
+        self._invalidate_dashboard_cache()
+        return super().unlink()
@@ -1,6 +1,20 @@
 from odoo import models, fields, api
 from odoo.exceptions import ValidationError
+from odoo.tools import split_every
 from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from collections import defaultdict
+import csv
+import io
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Поля, от которых зависят ставки - перед их изменением фиксируем прошлый месяц
+RATE_FIELDS = {
+    'employee_id', 'use_manual', 'manual_salary', 'manual_benefits', 'use_dynamic_hours',
+    'manual_monthly_hours', 'resource_calendar_id', 'calculation_period',
+}
 
 
 class EmployeeCost(models.Model):
@@ -54,6 +68,9 @@ class EmployeeCost(models.Model):
     )
     active = fields.Boolean(default=True)
 
+    # История ставок по месяцам
+    history_ids = fields.One2many('cost.employee.history', 'employee_cost_id', string='Monthly Cost History')
+
     @api.depends('use_dynamic_hours', 'manual_monthly_hours', 'calculation_period', 'resource_calendar_id')
     def _compute_monthly_hours(self):
         """Calculate monthly working hours dynamically or use manual value"""
@@ -180,38 +197,184 @@ class EmployeeCost(models.Model):
     @api.model
     def update_monthly_working_hours(self):
         """Cron job to update working hours for new month"""
-        employees = self.search([('use_dynamic_hours', '=', True)])
         current_month = fields.Date.today().replace(day=1)
 
-        for emp in employees:
-            # Update calculation period to current month
-            emp.calculation_period = current_month
-            # This will trigger recomputation of monthly_hours
-            emp._compute_monthly_hours()
+        # Фиксируем ставки закрываемого месяца до пересчета часов. Уже записанные
+        # снимки не трогаем: их сделал write до изменения ставки в этом месяце
+        self.search([])._snapshot_previous_month()
+
+        # Один write на всех - monthly_hours пересчитается через depends
+        employees = self.search([('use_dynamic_hours', '=', True)])
+        employees.write({'calculation_period': current_month})
+
+    def action_snapshot_history(self, period_date=None):
+        """Store current rates of these employees as history for the given month"""
+        period = (period_date or fields.Date.today()).replace(day=1)
+        return self.env['cost.employee.history']._store_snapshot(self, period)
+
+    def _snapshot_previous_month(self):
+        """Keep last month's rates in history before they are changed
+
+        Only months without history are stored, so the first change in a month
+        records the rates that were in effect until then.
+        """
+        current_month = fields.Date.today().replace(day=1)
+        # Созданные в этом месяце в прошлом месяце ставок не имели
+        employees = self.filtered(lambda rec: rec.create_date and rec.create_date.date() < current_month)
+        return self.env['cost.employee.history']._store_snapshot(
+            employees, current_month - relativedelta(months=1), overwrite=False)
 
     def write(self, vals):
-        original_currencies = {}
-        for record in self:
-            if 'currency_id' in vals:
-                # Если пользователь явно выбрал валюту - запомним её
-                original_currencies[record.id] = vals['currency_id']
-            elif record.currency_id:
-                # Если валюта уже установлена - тоже запомним
-                original_currencies[record.id] = record.currency_id.id
-
-        # Сохраняем изменения
-        result = super().write(vals)
-
-        # ВОССТАНАВЛИВАЕМ валюты после compute методов
-        if original_currencies:
-            for record in self:
-                if record.id in original_currencies:
-                    expected_currency = original_currencies[record.id]
-                    if record.currency_id.id != expected_currency:
-                        # Валюта была перезаписана - восстанавливаем
-                        super(EmployeeCost, record).write({'currency_id': expected_currency})
-
-        return result
+        if 'currency_id' in vals:
+            # Валюту проверяем один раз на весь батч, без повторных write по записям
+            if not vals['currency_id']:
+                # Пустое значение не должно затирать уже выбранную валюту
+                vals = {key: value for key, value in vals.items() if key != 'currency_id'}
+            elif not self.env['res.currency'].browse(vals['currency_id']).exists():
+                raise ValidationError(f"Currency with ID {vals['currency_id']} does not exist")
+
+        if RATE_FIELDS.intersection(vals):
+            self._snapshot_previous_month()
+
+        return super().write(vals)
+
+    @api.model
+    def import_payroll(self, payroll_data):
+        """Apply a payroll file to employee costs in batched statements
+
+        Expected CSV columns: employee, salary, benefits (optional).
+        The employee column is matched against identification number or
+        badge ID, and against the employee name only when no identifier
+        matches. Keys matching several employees are not applied and are
+        reported as ambiguous. Rows switch the record to manual mode.
+
+        :param payroll_data: CSV content (str/bytes) or list of dicts
+        :return: dict with created/updated counts, unmatched and ambiguous employees
+        """
+        # Прямой UPDATE обходит ORM - права проверяем здесь, до любых изменений
+        self.check_access_rights('write')
+        rows = self._parse_payroll_rows(payroll_data)
+
+        # Сотрудники - одним поиском
+        keys = list({row['employee'] for row in rows})
+        employees = self.env['hr.employee'].search([
+            '|', '|',
+            ('identification_id', 'in', keys),
+            ('barcode', 'in', keys),
+            ('name', 'in', keys)
+        ])
+        # Уникальные идентификаторы отдельно от имени: однофамильцы не должны перезаписывать друг друга
+        ids_by_code = defaultdict(set)
+        ids_by_name = defaultdict(set)
+        for employee in employees:
+            for code in (employee.barcode, employee.identification_id):
+                if code:
+                    ids_by_code[code].add(employee.id)
+            ids_by_name[employee.name].add(employee.id)
+
+        payroll = {}
+        missing = []
+        ambiguous = []
+        for row in rows:
+            key = row['employee']
+            candidates = ids_by_code.get(key) or ids_by_name.get(key)
+            if not candidates:
+                missing.append(key)
+            elif len(candidates) > 1:
+                ambiguous.append(key)
+            else:
+                payroll[next(iter(candidates))] = (row['salary'], row['benefits'])
+
+        # Существующие записи - одним поиском (включая архивные)
+        existing = self.with_context(active_test=False).search([('employee_id', 'in', list(payroll))])
+        existing_by_employee = {rec.employee_id.id: rec.id for rec in existing}
+
+        self.create([{
+            'employee_id': employee_id,
+            'use_manual': True,
+            'manual_salary': salary,
+            'manual_benefits': benefits,
+        } for employee_id, (salary, benefits) in payroll.items() if employee_id not in existing_by_employee])
+
+        updates = [(existing_by_employee[employee_id], salary, benefits)
+                   for employee_id, (salary, benefits) in payroll.items() if employee_id in existing_by_employee]
+        to_update = self.browse([row[0] for row in updates])
+        to_update.check_access_rule('write')
+        # Ставки меняются мимо write - снимок прошлого месяца делаем сами
+        to_update._snapshot_previous_month()
+        self._apply_payroll_updates(updates)
+        _logger.info("Payroll import by user %s: updated cost.employee %s, created %s",
+                     self.env.uid, to_update.ids, len(payroll) - len(updates))
+
+        return {
+            'created': len(payroll) - len(updates),
+            'updated': len(updates),
+            'missing': missing,
+            'ambiguous': ambiguous,
+        }
+
+    @api.model
+    def _parse_payroll_rows(self, payroll_data):
+        """Normalize payroll input into a list of {'employee', 'salary', 'benefits'}"""
+        if isinstance(payroll_data, bytes):
+            payroll_data = payroll_data.decode('utf-8-sig')
+        if isinstance(payroll_data, str):
+            payroll_data = list(csv.DictReader(io.StringIO(payroll_data)))
+
+        rows = []
+        for line_number, row in enumerate(payroll_data, start=2):
+            employee_key = str(row.get('employee') or '').strip()
+            if not employee_key:
+                continue
+            try:
+                rows.append({
+                    'employee': employee_key,
+                    'salary': float(row.get('salary') or 0.0),
+                    'benefits': float(row.get('benefits') or 0.0),
+                })
+            except ValueError:
+                raise ValidationError(f"Invalid amount in payroll line {line_number}: {row}")
+        return rows
+
+    def _apply_payroll_updates(self, updates):
+        """Update manual values and dependent stored totals with one UPDATE per chunk
+
+        Does no access checks of its own: only call it from import_payroll,
+        which checks write rights and record rules on the updated records.
+
+        :param updates: list of (cost_employee_id, salary, benefits)
+        """
+        if not updates:
+            return
+
+        self.flush_model(['monthly_hours'])
+        payroll_fields = ['use_manual', 'manual_salary', 'manual_benefits', 'monthly_salary',
+                          'monthly_benefits', 'monthly_total_cost', 'hourly_cost']
+
+        for chunk in split_every(1000, updates):
+            values_sql = ', '.join(['(%s, %s::float8, %s::float8)'] * len(chunk))
+            params = [value for row in chunk for value in row]
+            self.env.cr.execute(f"""
+                UPDATE cost_employee ce
+                   SET use_manual = TRUE,
+                       manual_salary = v.salary,
+                       manual_benefits = v.benefits,
+                       monthly_salary = v.salary,
+                       monthly_benefits = v.benefits,
+                       monthly_total_cost = v.salary + v.benefits,
+                       hourly_cost = CASE WHEN ce.monthly_hours > 0
+                                          THEN (v.salary + v.benefits) / ce.monthly_hours
+                                          ELSE 0 END,
+                       write_uid = %s,
+                       write_date = (now() at time zone 'UTC')
+                  FROM (VALUES {values_sql}) AS v(id, salary, benefits)
+                 WHERE ce.id = v.id
+            """, [self.env.uid] + params)
+
+        records = self.browse([row[0] for row in updates])
+        records.invalidate_recordset(payroll_fields + ['write_uid', 'write_date'])
+        # Пулы затрат зависят от monthly_total_cost - помечаем на пересчет
+        records.modified(['monthly_total_cost', 'hourly_cost'])
 
     def get_working_days_for_period(self, start_date, end_date):
         """Get working days for specific period"""
@@ -222,4 +385,104 @@ class EmployeeCost(models.Model):
 
     _sql_constraints = [
         ('unique_employee', 'unique(employee_id)', 'Employee cost configuration must be unique!')
-    ]
\ No newline at end of file
+    ]
+
+
+class EmployeeCostHistory(models.Model):
+    _name = 'cost.employee.history'
+    _description = 'Employee Monthly Cost History'
+    _order = 'period_date desc, employee_id'
+    _rec_name = 'employee_id'
+
+    employee_cost_id = fields.Many2one('cost.employee', string='Employee Cost', required=True,
+                                       ondelete='cascade')
+    employee_id = fields.Many2one('hr.employee', string='Employee', required=True, index=True)
+    period_date = fields.Date(string='Period', required=True, index=True,
+                              help='First day of the month these rates were in effect')
+
+    monthly_salary = fields.Float(string='Monthly Cost (with taxes)')
+    monthly_benefits = fields.Float(string='Monthly Benefits')
+    monthly_hours = fields.Float(string='Monthly Working Hours')
+    hourly_cost = fields.Float(string='Hourly Cost')
+    currency_id = fields.Many2one('res.currency', string='Currency')
+
+    _sql_constraints = [
+        ('unique_employee_period', 'unique(employee_id, period_date)',
+         'Only one cost history record per employee per month is allowed!')
+    ]
+
+    @api.model
+    def _store_snapshot(self, employee_costs, period, overwrite=True):
+        """Write history for the month in one batch: update existing rows, create the rest
+
+        :param overwrite: when False, employees that already have history
+                          for the month are left untouched
+        """
+        employee_costs = employee_costs.filtered('employee_id')
+        if not employee_costs:
+            return self.browse()
+
+        existing = self.search([
+            ('employee_id', 'in', employee_costs.employee_id.ids),
+            ('period_date', '=', period)
+        ])
+        existing_by_employee = {rec.employee_id.id: rec for rec in existing}
+
+        vals_list = []
+        for emp_cost in employee_costs:
+            vals = {
+                'employee_cost_id': emp_cost.id,
+                'employee_id': emp_cost.employee_id.id,
+                'period_date': period,
+                'monthly_salary': emp_cost.monthly_salary,
+                'monthly_benefits': emp_cost.monthly_benefits,
+                'monthly_hours': emp_cost.monthly_hours,
+                'hourly_cost': emp_cost.hourly_cost,
+                'currency_id': emp_cost.currency_id.id,
+            }
+            record = existing_by_employee.get(emp_cost.employee_id.id)
+            if record and not overwrite:
+                continue
+            if record:
+                # Повторный снимок за тот же месяц - обновляем только изменившиеся
+                if record.hourly_cost != vals['hourly_cost'] or record.monthly_hours != vals['monthly_hours']:
+                    record.write(vals)
+            else:
+                vals_list.append(vals)
+
+        return existing | self.create(vals_list)
+
+    @api.model
+    def _get_hourly_rates(self, employee_ids, periods):
+        """Hourly rate per (employee_id, month) in two queries.
+
+        History rows win; months without history fall back to the current
+        rate on cost.employee.
+
+        :param employee_ids: list of hr.employee IDs
+        :param periods: iterable of dates (any day of the month)
+        :return: dict {(employee_id, first_day_of_month): hourly_cost}
+        """
+        employee_ids = list(set(employee_ids))
+        months = {p.replace(day=1) for p in periods}
+        if not employee_ids or not months:
+            return {}
+
+        current_rates = {
+            emp_cost.employee_id.id: emp_cost.hourly_cost
+            for emp_cost in self.env['cost.employee'].search([('employee_id', 'in', employee_ids)])
+        }
+        rates = {
+            (employee_id, month): current_rates[employee_id]
+            for employee_id in employee_ids if employee_id in current_rates
+            for month in months
+        }
+
+        history = self.search_read([
+            ('employee_id', 'in', employee_ids),
+            ('period_date', 'in', list(months))
+        ], ['employee_id', 'period_date', 'hourly_cost'])
+        for row in history:
+            rates[(row['employee_id'][0], row['period_date'])] = row['hourly_cost']
+
+        return rates
@@ -2,15 +2,22 @@
 
 from odoo import models, fields, api
 from odoo.exceptions import ValidationError
+from datetime import timedelta
+from dateutil.relativedelta import relativedelta
+
+# Порог перегрузки, % сверх целевой нагрузки
+OVERLOAD_THRESHOLD = 20
 
 
 class EmployeeWorkload(models.Model):
     _name = 'employee.workload'
     _description = 'Employee Workload Analysis'
     _rec_name = 'display_name'
+    _inherit = ['cost.dashboard.cache.mixin']
+    _dashboard_period_field = 'period_date'
 
-    employee_id = fields.Many2one('hr.employee', string='Employee', required=True)
-    period_date = fields.Date(string='Period', required=True, default=fields.Date.today)
+    employee_id = fields.Many2one('hr.employee', string='Employee', required=True, index=True)
+    period_date = fields.Date(string='Period', required=True, default=fields.Date.today, index=True)
     display_name = fields.Char(string='Display Name', compute='_compute_display_name', store=True)
 
     # НОВЫЕ ПОЛЯ: из пулов затрат
@@ -28,6 +35,13 @@ class EmployeeWorkload(models.Model):
                                    help='Employee has more than optimal workload')
     overload_percentage = fields.Float(string='Overload %', compute='_compute_workload_stats', store=True)
 
+    # УТИЛИЗАЦИЯ: часы по табелям против мощности из cost.employee
+    timesheet_hours = fields.Float(string='Timesheet Hours', compute='_compute_utilization', store=True)
+    capacity_hours = fields.Float(string='Capacity Hours', compute='_compute_utilization', store=True,
+                                  help='Monthly working hours from employee cost configuration')
+    utilization_percentage = fields.Float(string='Utilization %', compute='_compute_utilization', store=True,
+                                          group_operator='avg')
+
     # АНАЛИЗ: поля для отображения (без store)
     workload_by_category = fields.Text(string='Workload by Category',
                                        compute='_compute_workload_analysis')
@@ -52,6 +66,9 @@ class EmployeeWorkload(models.Model):
     @api.depends('employee_id', 'period_date', 'target_workload')
     def _compute_workload_stats(self):
         """Вычисляем статистику для фильтрации (store=True)"""
+        # Активные сервисы по ответственным - одним сгруппированным запросом на весь набор
+        service_stats = self._get_service_load(self.employee_id.ids)
+
         for record in self:
             if not record.employee_id or not record.period_date:
                 record.active_services_count = 0
@@ -60,24 +77,150 @@ class EmployeeWorkload(models.Model):
                 record.overload_percentage = 0.0
                 continue
 
-            # Получаем активные сервисы, где сотрудник ответственный
-            active_services = self.env['client.service'].search([
-                ('responsible_employee_id', '=', record.employee_id.id),
-                ('status', '=', 'active')
-            ])
-
-            record.active_services_count = len(active_services)
-            total_workload = sum(active_services.mapped('effective_workload_factor'))
+            services_count, total_workload = service_stats.get(record.employee_id.id, (0, 0.0))
+            record.active_services_count = services_count
             record.total_workload_factor = total_workload
 
             # Расчет перегрузки
             if record.target_workload > 0:
                 record.overload_percentage = ((total_workload - record.target_workload) / record.target_workload) * 100
-                record.is_overloaded = record.overload_percentage > 20  # 20% порог перегрузки
+                record.is_overloaded = record.overload_percentage > OVERLOAD_THRESHOLD
             else:
                 record.overload_percentage = 0.0
                 record.is_overloaded = False
 
+    @api.depends('employee_id', 'period_date')
+    def _compute_utilization(self):
+        """Утилизация по табелям: часы за месяц / мощность, сгруппированно по всем записям"""
+        utilization_by_period = {}
+        for period in set(self.filtered('period_date').mapped('period_date')):
+            records = self.filtered(lambda r: r.period_date == period)
+            utilization_by_period[period] = self._get_utilization_data(period, records.employee_id.ids)
+
+        for record in self:
+            data = utilization_by_period.get(record.period_date, {}).get(record.employee_id.id, {})
+            record.timesheet_hours = data.get('timesheet_hours', 0.0)
+            record.capacity_hours = data.get('capacity_hours', 0.0)
+            record.utilization_percentage = data.get('utilization_percentage', 0.0)
+
+    @api.model
+    def _get_service_load(self, employee_ids=None):
+        """Active services count and workload factor per responsible employee
+
+        :return: dict {employee_id: (services_count, total_workload_factor)}
+        """
+        domain = [('status', '=', 'active'), ('responsible_employee_id', '!=', False)]
+        if employee_ids is not None:
+            domain.append(('responsible_employee_id', 'in', employee_ids))
+
+        groups = self.env['client.service']._read_group(
+            domain, ['responsible_employee_id'], ['__count', 'effective_workload_factor:sum'])
+        return {employee.id: (count, workload) for employee, count, workload in groups}
+
+    @api.model
+    def _get_utilization_data(self, period, employee_ids=None):
+        """Utilization of employees for a month in three grouped queries
+
+        Timesheet hours come from account.analytic.line, capacity from
+        cost.employee.monthly_hours and responsibility load from active
+        client services.
+
+        :param period: any date of the month
+        :param employee_ids: restrict to these hr.employee IDs (all employees with cost records if None)
+        :return: dict {employee_id: {timesheet_hours, capacity_hours, utilization_percentage,
+                                     active_services_count, total_workload_factor}}
+        """
+        month_start = period.replace(day=1)
+        month_end = month_start + relativedelta(months=1) - timedelta(days=1)
+
+        cost_domain = [] if employee_ids is None else [('employee_id', 'in', employee_ids)]
+        capacity = {
+            row['employee_id'][0]: row['monthly_hours']
+            for row in self.env['cost.employee'].search_read(cost_domain, ['employee_id', 'monthly_hours'])
+        }
+        if employee_ids is None:
+            employee_ids = list(capacity)
+
+        hours_groups = self.env['account.analytic.line']._read_group(
+            [
+                ('employee_id', 'in', employee_ids),
+                ('date', '>=', month_start),
+                ('date', '<=', month_end),
+            ],
+            ['employee_id'], ['unit_amount:sum'])
+        hours = {employee.id: amount for employee, amount in hours_groups}
+
+        service_load = self._get_service_load(employee_ids)
+
+        result = {}
+        for employee_id in employee_ids:
+            capacity_hours = capacity.get(employee_id, 0.0)
+            timesheet_hours = hours.get(employee_id, 0.0)
+            services_count, total_workload = service_load.get(employee_id, (0, 0.0))
+            result[employee_id] = {
+                'timesheet_hours': timesheet_hours,
+                'capacity_hours': capacity_hours,
+                'utilization_percentage': (timesheet_hours / capacity_hours * 100) if capacity_hours > 0 else 0.0,
+                'active_services_count': services_count,
+                'total_workload_factor': total_workload,
+            }
+        return result
+
+    def _refresh_statistics(self):
+        """Recompute stored statistics for the whole recordset in batch
+
+        The fields are marked for recomputation and flushed together, so the
+        ORM computes them once for all records and writes them in batched
+        UPDATEs instead of one write per record.
+        """
+        if not self:
+            return
+        fnames = [name for name, field in self._fields.items()
+                  if field.store and field.compute in ('_compute_workload_stats', '_compute_utilization')]
+        for fname in fnames:
+            self.env.add_to_compute(self._fields[fname], self)
+        self.flush_model(fnames)
+        # Пересчет идет мимо write - кэш дашборда сбрасываем один раз на весь набор
+        self._invalidate_dashboard_cache()
+
+    @api.model
+    def _generate_missing_workloads(self, period):
+        """Create workload records for active employees missing one for the month
+
+        Missing (employee, month) pairs are found with a single anti-join and
+        created with one multi-create; stored statistics of the new records
+        are then computed in batch through grouped queries.
+        """
+        month = period.replace(day=1)
+
+        self.flush_model(['employee_id', 'period_date'])
+        self.env['hr.employee'].flush_model(['active'])
+        self.env.cr.execute("""
+            SELECT e.id
+              FROM hr_employee e
+             WHERE e.active
+               AND NOT EXISTS (SELECT 1
+                                 FROM employee_workload w
+                                WHERE w.employee_id = e.id
+                                  AND w.period_date = %s)
+        """, [month])
+        employee_ids = [row[0] for row in self.env.cr.fetchall()]
+
+        return self.create([{'employee_id': employee_id, 'period_date': month} for employee_id in employee_ids])
+
+    @api.model
+    def update_workload_from_pools(self):
+        """Create missing workload records for the current month and refresh statistics (CRON method)"""
+        current_month = fields.Date.today().replace(day=1)
+
+        created = self._generate_missing_workloads(current_month)
+
+        # Новые записи уже посчитаны при создании - обновляем только существующие
+        existing = self.search([('period_date', '=', current_month), ('id', 'not in', created.ids)])
+        existing._refresh_statistics()
+
+        return len(created)
+
     @api.depends('employee_id', 'period_date')
     def _compute_workload_analysis(self):
         """Вычисляем детальный анализ для отображения (без store)"""
@@ -150,25 +293,4 @@ class EmployeePoolWorkload(models.Model):
     @api.model
     def update_workload_from_pools(self):
         """Update employee workload records from cost pool allocations (CRON method)"""
-        current_date = fields.Date.today()
-        current_month = current_date.replace(day=1)
-
-        # Получаем всех активных сотрудников
-        employees = self.env['hr.employee'].search([('active', '=', True)])
-
-        updated_count = 0
-        for employee in employees:
-            # Ищем или создаем запись workload для текущего месяца
-            existing_workload = self.env['employee.workload'].search([
-                ('employee_id', '=', employee.id),
-                ('period_date', '=', current_month)
-            ])
-
-            if not existing_workload:
-                self.env['employee.workload'].create({
-                    'employee_id': employee.id,
-                    'period_date': current_month,
-                })
-                updated_count += 1
-
-        return updated_count
\ No newline at end of file
+        return self.env['employee.workload'].update_workload_from_pools()
@@ -0,0 +1,222 @@
+# models/kpi_rollup.py
+
+from odoo import models, fields, api
+from datetime import timedelta
+from dateutil.relativedelta import relativedelta
+from collections import defaultdict
+
+
+class CostKpiMonthly(models.Model):
+    _name = 'cost.kpi.monthly'
+    _description = 'Monthly Cost KPI Rollup'
+    _order = 'period_date desc, company_id'
+    _rec_name = 'period_date'
+    _inherit = ['cost.dashboard.cache.mixin']
+    _dashboard_period_field = 'period_date'
+
+    company_id = fields.Many2one('res.company', string='Company', required=True, index=True)
+    period_date = fields.Date(string='Period', required=True, index=True,
+                              help='First day of the month')
+    currency_id = fields.Many2one('res.currency', related='company_id.currency_id')
+
+    # Costs of calculated/confirmed allocations
+    direct_cost = fields.Monetary(string='Direct Costs', currency_field='currency_id')
+    indirect_cost = fields.Monetary(string='Indirect Costs', currency_field='currency_id')
+    admin_cost = fields.Monetary(string='Administrative Costs', currency_field='currency_id')
+    total_cost = fields.Monetary(string='Total Cost', currency_field='currency_id')
+
+    # Subscriptions running in the month
+    revenue = fields.Monetary(string='Revenue', currency_field='currency_id')
+    client_count = fields.Integer(string='Allocated Clients')
+    active_subscriptions = fields.Integer(string='Active Subscriptions')
+
+    avg_utilization = fields.Float(string='Average Utilization (%)', group_operator='avg')
+
+    _sql_constraints = [
+        ('unique_company_period', 'unique(company_id, period_date)',
+         'Only one KPI rollup per company and month is allowed!')
+    ]
+
+    @api.model
+    def _refresh_months(self, periods, company_ids=None):
+        """Rebuild rollup rows for the given months.
+
+        Every (company, month) gets a row, also when there is no data, so
+        missing rows mean "not built". Rows are upserted with
+        INSERT ... ON CONFLICT in a fixed order, so transactions refreshing the
+        same month (confirmations, subscription changes, the cron) do not
+        collide on unique(company_id, period_date). Dashboard reads never
+        write rows; they compute missing months live.
+
+        :param periods: iterable of dates (any day of the month)
+        :param company_ids: companies to rebuild (all if None)
+        """
+        months = sorted({period.replace(day=1) for period in periods})
+        if company_ids is None:
+            company_ids = self.env['res.company'].sudo().search([]).ids
+        if not months or not company_ids:
+            return self.browse()
+
+        value_fields = ['direct_cost', 'indirect_cost', 'admin_cost', 'total_cost', 'revenue',
+                        'client_count', 'active_subscriptions', 'avg_utilization']
+        vals_list = sorted(self._compute_months(months, sorted(company_ids)),
+                           key=lambda vals: (vals['company_id'], vals['period_date']))
+        columns = ['company_id', 'period_date'] + value_fields
+        row_sql = "(%s, now() at time zone 'UTC', now() at time zone 'UTC', %s, %s)" % (
+            ', '.join(['%s'] * len(columns)), self.env.uid, self.env.uid)
+        self.env.cr.execute(f"""
+            INSERT INTO cost_kpi_monthly
+                   ({', '.join(columns)}, create_date, write_date, create_uid, write_uid)
+            VALUES {', '.join([row_sql] * len(vals_list))}
+            ON CONFLICT (company_id, period_date) DO UPDATE
+               SET {', '.join(f"{name} = EXCLUDED.{name}" for name in value_fields)},
+                   write_date = EXCLUDED.write_date,
+                   write_uid = EXCLUDED.write_uid
+         RETURNING id
+        """, [vals[name] for vals in vals_list for name in columns])
+        rows = self.sudo().browse([row_id for row_id, in self.env.cr.fetchall()])
+        rows.invalidate_recordset()
+        # Запись мимо ORM - кэш дашборда сбрасываем сами
+        self.env['cost.dashboard.cache']._invalidate(self._name, months[-1], company_ids)
+        return rows
+
+    @api.model
+    def _compute_months(self, months, company_ids):
+        """Rollup values per (company, month) without writing anything.
+
+        Grouped queries per month over allocations, subscriptions and
+        workloads.
+
+        :return: list of create values, one per company and month
+        """
+        allocation_model = self.env['client.cost.allocation'].sudo()
+        subscription_model = self.env['client.service.subscription'].sudo()
+        workload_model = self.env['employee.workload'].sudo()
+
+        vals_list = []
+        for month in months:
+            month_end = month + relativedelta(months=1) - timedelta(days=1)
+
+            costs = {
+                company.id: (direct, indirect, admin, total, clients)
+                for company, direct, indirect, admin, total, clients in allocation_model._read_group(
+                    [
+                        ('company_id', 'in', company_ids),
+                        ('period_date', '>=', month),
+                        ('period_date', '<=', month_end),
+                        ('state', 'in', ['calculated', 'confirmed'])
+                    ],
+                    ['company_id'],
+                    ['direct_cost:sum', 'indirect_cost:sum', 'admin_cost:sum', 'total_cost:sum',
+                     'client_id:count_distinct'],
+                )
+            }
+
+            # Подписки, действовавшие в месяце: начались до его конца и не закончились до его начала
+            subscriptions = {
+                company.id: (count, revenue)
+                for company, count, revenue in subscription_model._read_group(
+                    [
+                        ('company_id', 'in', company_ids),
+                        ('state', '!=', 'draft'),
+                        ('start_date', '<=', month_end),
+                        '|', ('end_date', '>=', month),
+                        '&', ('end_date', '=', False), ('state', '=', 'active'),
+                    ],
+                    ['company_id'],
+                    ['__count', 'total_amount:sum'],
+                )
+            }
+
+            utilization = defaultdict(list)
+            for employee, avg in workload_model._read_group(
+                    [('period_date', '>=', month), ('period_date', '<=', month_end)],
+                    ['employee_id'],
+                    ['utilization_percentage:avg']):
+                utilization[employee.company_id.id].append(avg or 0)
+
+            for company_id in company_ids:
+                direct, indirect, admin, total, clients = costs.get(company_id, (0, 0, 0, 0, 0))
+                count, revenue = subscriptions.get(company_id, (0, 0))
+                company_utilization = utilization.get(company_id)
+                vals_list.append({
+                    'company_id': company_id,
+                    'period_date': month,
+                    'direct_cost': direct or 0,
+                    'indirect_cost': indirect or 0,
+                    'admin_cost': admin or 0,
+                    'total_cost': total or 0,
+                    'client_count': clients or 0,
+                    'revenue': revenue or 0,
+                    'active_subscriptions': count,
+                    'avg_utilization': (sum(company_utilization) / len(company_utilization)
+                                        if company_utilization else 0),
+                })
+
+        return vals_list
+
+    @api.model
+    def _get_trends(self, date_from, date_to, company_ids):
+        """Monthly totals, one row per month
+
+        Past months come from the stored rollup. The current month and months
+        that were not built yet are computed live, so a dashboard read never
+        writes rows (concurrent readers would race on the unique key).
+
+        :return: list of (month, direct, indirect, admin, total, revenue)
+        """
+        months = []
+        month = date_from.replace(day=1)
+        while month <= date_to:
+            months.append(month)
+            month += relativedelta(months=1)
+        company_ids = list(company_ids)
+        current_month = fields.Date.today().replace(day=1)
+        value_fields = ['direct_cost', 'indirect_cost', 'admin_cost', 'total_cost', 'revenue']
+
+        # Компании передаются явно - права на чтение свода не требуются
+        rows = self.sudo().search_read([
+            ('period_date', 'in', months),
+            ('period_date', '<', current_month),
+            ('company_id', 'in', company_ids),
+        ], ['company_id', 'period_date'] + value_fields)
+        built = {(row['company_id'][0], row['period_date']) for row in rows}
+
+        # Компании с одинаковым набором недостающих месяцев считаем вместе
+        missing = defaultdict(list)
+        for company_id in company_ids:
+            missing_months = tuple(month for month in months if (company_id, month) not in built)
+            if missing_months:
+                missing[missing_months].append(company_id)
+        for missing_months, missing_companies in missing.items():
+            rows += self._compute_months(missing_months, missing_companies)
+
+        totals = {month: [0.0] * len(value_fields) for month in months}
+        for row in rows:
+            month_totals = totals[row['period_date']]
+            for index, name in enumerate(value_fields):
+                month_totals[index] += row[name] or 0
+        return [(month, *totals[month]) for month in months]
+
+    @api.model
+    def action_backfill(self, date_from=None):
+        """Rebuild the rollup for all history since date_from (earliest allocation by default)"""
+        if not date_from:
+            [(date_from,)] = self.env['client.cost.allocation'].sudo()._read_group(
+                [], [], ['period_date:min'])
+        if not date_from:
+            return self.browse()
+
+        today = fields.Date.today()
+        months = []
+        month = date_from.replace(day=1)
+        while month <= today:
+            months.append(month)
+            month += relativedelta(months=1)
+        return self._refresh_months(months)
+
+    @api.model
+    def cron_refresh_current_months(self):
+        """Cron job: rebuild the rollup for the current and previous month"""
+        current_month = fields.Date.today().replace(day=1)
+        self._refresh_months([current_month - relativedelta(months=1), current_month])
@@ -51,7 +51,7 @@ class ResPartner(models.Model):
         ('down', 'Decreasing'),
         ('stable', 'Stable'),
         ('new', 'New Client')
-    ], string='Cost Trend', compute='_compute_cost_trend', store=True)
+    ], string='Cost Trend', compute='_compute_cost_stats', store=True)
 
     @api.depends('support_level')
     def _compute_sla_times(self):
@@ -107,33 +107,42 @@ class ResPartner(models.Model):
     # ИСПРАВЛЕНО: поле client.service называется 'status', а не 'active'
     @api.depends('client_service_ids.status', 'subscription_ids.state')
     def _compute_service_stats(self):
+        # Сгруппированные счетчики на весь батч партнеров вместо фильтрации по каждому
+        partner_ids = [partner_id for partner_id in self._origin.ids if partner_id]
+        service_counts = dict(self.env['client.service']._read_group(
+            [('client_id', 'in', partner_ids), ('status', '=', 'active')],
+            ['client_id'], ['__count']))
+        subscription_counts = dict(self.env['client.service.subscription']._read_group(
+            [('client_id', 'in', partner_ids), ('state', '=', 'active')],
+            ['client_id'], ['__count']))
+
         for partner in self:
-            # ИСПРАВЛЕНО: используем status='active' вместо поля 'active'
-            partner.service_count = len(partner.client_service_ids.filtered(lambda s: s.status == 'active'))
-            partner.subscription_count = len(partner.subscription_ids.filtered(lambda s: s.state == 'active'))
+            partner.service_count = service_counts.get(partner._origin, 0)
+            partner.subscription_count = subscription_counts.get(partner._origin, 0)
 
     @api.depends('cost_allocation_ids.total_cost', 'cost_allocation_ids.period_date')
     def _compute_cost_stats(self):
+        """Last cost, its date and trend from the latest two periods of each client
+
+        Recomputed only for clients whose allocations changed; one window
+        query fetches the two latest allocations for the whole batch.
+        """
+        latest = self._get_latest_allocations()
+
         for partner in self:
-            latest_allocation = partner.cost_allocation_ids.sorted('period_date', reverse=True)[:1]
+            allocations = latest.get(partner._origin.id, [])
 
-            if latest_allocation:
-                partner.last_monthly_cost = latest_allocation.total_cost
-                partner.last_cost_date = latest_allocation.period_date
+            if allocations:
+                partner.last_cost_date, partner.last_monthly_cost = allocations[0]
             else:
                 partner.last_monthly_cost = 0
                 partner.last_cost_date = False
 
-    @api.depends('cost_allocation_ids.total_cost', 'cost_allocation_ids.period_date')
-    def _compute_cost_trend(self):
-        for partner in self:
-            allocations = partner.cost_allocation_ids.sorted('period_date', reverse=True)
-
             if len(allocations) < 2:
                 partner.cost_trend = 'new'
             else:
-                current = allocations[0].total_cost
-                previous = allocations[1].total_cost
+                current = allocations[0][1]
+                previous = allocations[1][1]
 
                 if abs(current - previous) / max(previous, 1) < 0.05:  # 5% threshold
                     partner.cost_trend = 'stable'
@@ -142,6 +151,30 @@ class ResPartner(models.Model):
                 else:
                     partner.cost_trend = 'down'
 
+    def _get_latest_allocations(self):
+        """Two latest allocations per partner: {partner_id: [(period_date, total_cost), ...]}"""
+        partner_ids = tuple(partner_id for partner_id in self._origin.ids if partner_id)
+        if not partner_ids:
+            return {}
+
+        self.env['client.cost.allocation'].flush_model(['client_id', 'period_date', 'total_cost'])
+        self.env.cr.execute("""
+            SELECT client_id, period_date, total_cost
+              FROM (
+                  SELECT client_id, period_date, total_cost,
+                         ROW_NUMBER() OVER (PARTITION BY client_id ORDER BY period_date DESC, id DESC) AS position
+                    FROM client_cost_allocation
+                   WHERE client_id IN %s
+              ) latest
+             WHERE position <= 2
+             ORDER BY client_id, position
+        """, [partner_ids])
+
+        result = {}
+        for client_id, period_date, total_cost in self.env.cr.fetchall():
+            result.setdefault(client_id, []).append((period_date, total_cost or 0))
+        return result
+
     def action_view_services(self):
         """Open client services"""
         return {
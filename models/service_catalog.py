@@ -1,6 +1,7 @@
 # models/service_catalog.py
 
 from odoo import models, fields, api
+from odoo.osv import expression
 
 
 class ServiceCatalog(models.Model):
@@ -154,6 +155,60 @@ class ServiceCatalog(models.Model):
                 vals['support_hours_per_unit'] = 1.0
         return super().create(vals_list)
 
+    @api.model
+    def _resolve_by_names(self, entries):
+        """Find or create catalog items for many service names in one pass
+
+        Existing items and categories are matched case-insensitively with one
+        search each; missing categories, service types and catalog items are
+        created with one multi-create each.
+
+        :param entries: dict name -> dict(category_name, unit_id, unit_cost, unit_price)
+        :return: dict lower-cased name -> service.catalog
+        """
+        if not entries:
+            return {}
+
+        catalogs = {}
+        for catalog in self.search(expression.OR([[('name', '=ilike', name)] for name in entries])):
+            catalogs.setdefault(catalog.name.lower(), catalog)
+
+        missing = {}
+        for name, entry in entries.items():
+            if name.lower() not in catalogs:
+                missing.setdefault(name.lower(), dict(entry, name=name))
+        if not missing:
+            return catalogs
+
+        category_model = self.env['service.category']
+        category_names = {entry['category_name'] for entry in missing.values()}
+        categories = {}
+        for category in category_model.search(
+                expression.OR([[('name', '=ilike', name)] for name in category_names])):
+            categories.setdefault(category.name.lower(), category)
+        new_category_names = {name.lower(): name for name in category_names if name.lower() not in categories}
+        for category in category_model.create([{'name': name} for name in new_category_names.values()]):
+            categories[category.name.lower()] = category
+
+        entries_to_create = list(missing.values())
+        service_types = self.env['service.type'].create([{
+            'name': entry['name'],
+            'category_id': categories[entry['category_name'].lower()].id,
+            'unit_id': entry['unit_id'],
+        } for entry in entries_to_create])
+
+        for catalog in self.create([{
+            'name': entry['name'],
+            'service_type_id': service_type.id,
+            'manual_base_cost': entry['unit_cost'],
+            'use_manual_cost': True,
+            'markup_percentage': ((entry['unit_price'] - entry['unit_cost']) / entry['unit_cost'] * 100
+                                  if entry['unit_cost'] > 0 else 0),
+        } for entry, service_type in zip(entries_to_create, service_types)]):
+            catalogs[catalog.name.lower()] = catalog
+
+        return catalogs
+
     def action_view_clients(self):
         """View clients using this catalog service"""
         self.ensure_one()
@@ -1,21 +1,35 @@
-from odoo import models, fields, api
+from odoo import models, fields, api, Command
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools import split_every, create_index, float_compare
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from collections import defaultdict
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Подписок на один multi-create счетов (и один коммит в cron)
+INVOICE_BATCH_SIZE = 100
+# Сколько будущих дат выставления держать в графике каждой подписки
+BILLING_SCHEDULE_HORIZON = 3
+# Поля, от которых зависят даты графика
+BILLING_SCHEDULE_FIELDS = {'start_date', 'recurring_interval', 'recurring_rule_type', 'invoice_day'}
 
 
 class ClientServiceSubscription(models.Model):
     _name = 'client.service.subscription'
     _description = 'Client Service Subscription'
     _order = 'client_id, start_date desc'
-    _inherit = ['mail.thread', 'mail.activity.mixin', 'sequence.helper']  # ДОБАВЛЕНО: sequence.helper
+    _inherit = ['mail.thread', 'mail.activity.mixin', 'sequence.helper',  # ДОБАВЛЕНО: sequence.helper
+                'cost.dashboard.cache.mixin']
 
     # ДОБАВЛЕНО: поле кода для подписок
     code = fields.Char(string='Subscription Code', readonly=True, copy=False)
     name = fields.Char(string='Subscription Name', required=True, tracking=True)
     client_id = fields.Many2one('res.partner', string='Client', required=True,
-                                domain=[('is_company', '=', True)], tracking=True)
+                                domain=[('is_company', '=', True)], tracking=True, index=True)
 
-    company_id = fields.Many2one('res.company', string='Company', required=True,
+    company_id = fields.Many2one('res.company', string='Company', required=True, index=True,
                                  default=lambda self: self.env.company)
 
     # Period
@@ -49,11 +63,16 @@ class ClientServiceSubscription(models.Model):
     # Invoicing
     auto_invoice = fields.Boolean(string='Auto Invoice', default=True)
     invoice_day = fields.Integer(string='Invoice Day', default=1, help='Day of month to generate invoice')
-    next_invoice_date = fields.Date(string='Next Invoice Date', compute='_compute_next_invoice_date', store=True)
+    next_invoice_date = fields.Date(string='Next Invoice Date', compute='_compute_next_invoice_date', store=True,
+                                    index=True)
+    billing_schedule_ids = fields.One2many('client.service.billing.schedule', 'subscription_id',
+                                           string='Billing Schedule')
 
     # Analytics
-    total_invoiced = fields.Float(string='Total Invoiced', compute='_compute_invoice_stats')
-    invoice_count = fields.Integer(string='Invoice Count', compute='_compute_invoice_stats')
+    invoice_ids = fields.One2many('account.move', 'subscription_id', string='Invoices')
+    # Хранимые: пересчитываются при проведении/отмене счета, по ним можно сортировать и фильтровать
+    total_invoiced = fields.Float(string='Total Invoiced', compute='_compute_invoice_stats', store=True)
+    invoice_count = fields.Integer(string='Invoice Count', compute='_compute_invoice_stats', store=True)
 
 
     @api.depends('service_line_ids.total_price')
@@ -61,50 +80,123 @@ class ClientServiceSubscription(models.Model):
         for subscription in self:
             subscription.total_amount = sum(subscription.service_line_ids.mapped('total_price'))
 
-    @api.depends('start_date', 'recurring_interval', 'recurring_rule_type', 'state')
+    @api.depends('billing_schedule_ids.date', 'billing_schedule_ids.state')
     def _compute_next_invoice_date(self):
+        """Earliest pending date of the billing schedule (does not depend on today)"""
         for subscription in self:
-            if subscription.state != 'active' or not subscription.auto_invoice:
-                subscription.next_invoice_date = False
-                continue
+            pending = subscription.billing_schedule_ids.filtered(lambda entry: entry.state == 'pending')
+            subscription.next_invoice_date = min(pending.mapped('date'), default=False)
+
+    @api.constrains('invoice_day')
+    def _check_invoice_day(self):
+        for subscription in self:
+            if not 1 <= subscription.invoice_day <= 31:
+                raise ValidationError("Invoice day must be between 1 and 31.")
+
+    def _iter_billing_dates(self, after=None):
+        """Invoice dates of the subscription: one per recurring interval after the start
+
+        Monthly dates fall on the invoice day, clamped to the month length.
+        Dates up to ``after`` are skipped by jumping straight to its interval
+        instead of walking from the start; the sequence ends at the end date.
+        """
+        self.ensure_one()
+        interval = max(self.recurring_interval, 1)
+        occurrence = 1
+        if after and after > self.start_date:
+            if self.recurring_rule_type == 'monthly':
+                elapsed = (after.year - self.start_date.year) * 12 + after.month - self.start_date.month
+            elif self.recurring_rule_type == 'yearly':
+                elapsed = after.year - self.start_date.year
+            elif self.recurring_rule_type == 'weekly':
+                elapsed = (after - self.start_date).days // 7
+            else:
+                elapsed = (after - self.start_date).days
+            # Интервал с датой не позже after - более ранние даты заведомо пропускаются
+            occurrence = max(elapsed // interval, 1)
+
+        while True:
+            step = interval * occurrence
+            if self.recurring_rule_type == 'monthly':
+                # relativedelta(day=...) сдвигает 31-е на последний день короткого месяца
+                date = self.start_date + relativedelta(months=step, day=self.invoice_day or 1)
+            elif self.recurring_rule_type == 'yearly':
+                date = self.start_date + relativedelta(years=step)
+            elif self.recurring_rule_type == 'weekly':
+                date = self.start_date + timedelta(weeks=step)
+            else:
+                date = self.start_date + timedelta(days=step)
+            if self.end_date and date > self.end_date:
+                return
+            if not after or date > after:
+                yield date
+            occurrence += 1
+
+    def _sync_billing_schedule(self, reset=False, first_dates=None):
+        """Keep BILLING_SCHEDULE_HORIZON pending dates for billable subscriptions
+
+        Subscriptions that are not active or not auto-invoiced lose their
+        pending dates. New dates continue after the last pending one, or,
+        when nothing is pending, after the last invoiced date but not
+        before today, so reactivated subscriptions are not back-billed.
+
+        :param reset: rebuild pending dates (the recurring rule changed)
+        :param first_dates: subscription id -> first pending date for
+                            subscriptions that have no schedule yet
+        """
+        first_dates = first_dates or {}
+        schedule_model = self.env['client.service.billing.schedule']
+        billable = self.filtered(lambda s: s.state == 'active' and s.auto_invoice and s.start_date)
+        obsolete = (self if reset else self - billable).billing_schedule_ids.filtered(
+            lambda entry: entry.state == 'pending')
+        obsolete.unlink()
 
-            if not subscription.start_date:
-                subscription.next_invoice_date = False
+        today = fields.Date.today()
+        vals_list = []
+        for subscription in billable:
+            entries = subscription.billing_schedule_ids
+            pending = entries.filtered(lambda entry: entry.state == 'pending')
+            missing = BILLING_SCHEDULE_HORIZON - len(pending)
+            if missing <= 0:
                 continue
 
-            # Calculate next invoice date based on recurring rule
-            if subscription.recurring_rule_type == 'monthly':
-                # Find the next invoice date
-                today = fields.Date.today()
-                start = subscription.start_date
-
-                # If subscription just started, next invoice is on invoice_day of next month
-                if start >= today:
-                    next_month = start + relativedelta(months=1)
-                    subscription.next_invoice_date = next_month.replace(day=subscription.invoice_day)
-                else:
-                    # Find next occurrence based on recurring interval
-                    months_passed = ((today.year - start.year) * 12 + today.month - start.month)
-                    next_period = months_passed + subscription.recurring_interval
-                    next_date = start + relativedelta(months=next_period)
-                    subscription.next_invoice_date = next_date.replace(day=subscription.invoice_day)
+            if pending:
+                after = max(pending.mapped('date'))
+            elif not entries and first_dates.get(subscription.id):
+                # Дата из периода до графика - даже прошедшая, неоплаченный период не теряется
+                after = first_dates[subscription.id]
+                vals_list.append({'subscription_id': subscription.id, 'date': after})
+                missing -= 1
             else:
-                # For other intervals, use simpler logic
-                subscription.next_invoice_date = subscription.start_date + relativedelta(
-                    days=subscription.recurring_interval if subscription.recurring_rule_type == 'daily' else 0,
-                    weeks=subscription.recurring_interval if subscription.recurring_rule_type == 'weekly' else 0,
-                    months=subscription.recurring_interval if subscription.recurring_rule_type == 'monthly' else 0,
-                    years=subscription.recurring_interval if subscription.recurring_rule_type == 'yearly' else 0
-                )
+                after = max(entries.mapped('date') + [today - timedelta(days=1)])
+
+            for date in subscription._iter_billing_dates(after):
+                if missing <= 0:
+                    break
+                vals_list.append({'subscription_id': subscription.id, 'date': date})
+                missing -= 1
 
+        return schedule_model.create(vals_list)
+
+    @api.depends('invoice_ids.state', 'invoice_ids.move_type', 'invoice_ids.amount_total')
     def _compute_invoice_stats(self):
+        """Count and total of non-cancelled customer invoices, one grouped query for all records"""
+        stats = {
+            subscription: (count, total)
+            for subscription, count, total in self.env['account.move']._read_group(
+                [
+                    ('subscription_id', 'in', self._origin.ids),
+                    ('move_type', '=', 'out_invoice'),
+                    ('state', '!=', 'cancel')
+                ],
+                ['subscription_id'],
+                ['__count', 'amount_total:sum'],
+            )
+        }
         for subscription in self:
-            invoices = self.env['account.move'].search([
-                ('subscription_id', '=', subscription.id),
-                ('move_type', '=', 'out_invoice')
-            ])
-            subscription.invoice_count = len(invoices)
-            subscription.total_invoiced = sum(invoices.mapped('amount_total'))
+            count, total = stats.get(subscription._origin, (0, 0.0))
+            subscription.invoice_count = count
+            subscription.total_invoiced = total
 
     def action_view_invoices(self):
         self.ensure_one()
@@ -121,19 +213,11 @@ class ClientServiceSubscription(models.Model):
         """Manually generate invoice for this subscription"""
         self.ensure_one()
         if not self.service_line_ids:
-            from odoo.exceptions import UserError
             raise UserError("Cannot generate invoice without service lines.")
 
-        invoice_vals = self._prepare_invoice_vals()
-        invoice = self.env['account.move'].create(invoice_vals)
-
-        # Create invoice lines
-        for line in self.service_line_ids:
-            line_vals = line._prepare_invoice_line_vals(invoice)
-            self.env['account.move.line'].create(line_vals)
-
-        # ИСПРАВЛЕНО: в Odoo 17 достаточно invalidate cache, итоги пересчитываются автоматически
-        invoice.invalidate_recordset(['amount_total', 'amount_untaxed', 'amount_tax'])
+        invoice = self._create_invoices()
+        if not invoice:
+            raise UserError("Nothing to invoice: no service line is active in the billing period.")
 
         return {
             'type': 'ir.actions.act_window',
@@ -144,56 +228,155 @@ class ClientServiceSubscription(models.Model):
             'views': [(False, 'form')]
         }
 
-    def _prepare_invoice_vals(self):
-        """Prepare invoice values"""
+    def _get_period_invoices(self):
+        """Invoices already issued for the current billing period, by subscription
+
+        Looked up by the (subscription, billing period) key, which is unique
+        among non-cancelled invoices, so concurrent billing cannot invoice a
+        period twice while a cancelled invoice does not block re-billing.
+        """
+        periods = {date for date in self.mapped('next_invoice_date') if date}
+        if not periods:
+            return {}
+        invoices = self.env['account.move'].search([
+            ('subscription_id', 'in', self.ids),
+            ('billing_period_date', 'in', list(periods)),
+            ('state', '!=', 'cancel')
+        ])
+        return {
+            invoice.subscription_id: invoice
+            for invoice in invoices
+            if invoice.billing_period_date == invoice.subscription_id.next_invoice_date
+        }
+
+    def _create_invoices(self):
+        """Create invoices for these subscriptions with one multi-create
+
+        Lines are embedded as create commands in the invoice vals, so each
+        move is built and its totals computed once instead of per line.
+        Subscriptions already invoiced for their billing period get their
+        existing invoice back instead of a new one; subscriptions with no line
+        active in the period get no invoice.
+        """
+        subscriptions = self.filtered('service_line_ids')
+        if not subscriptions:
+            return self.env['account.move']
+
+        existing = subscriptions._get_period_invoices()
+        existing_invoices = self.env['account.move'].union(*existing.values())
+        to_invoice = subscriptions.filtered(lambda subscription: subscription not in existing)
+        if not to_invoice:
+            return existing_invoices
+
+        income_accounts = self._get_income_accounts(to_invoice.company_id)
+        # Пропорциональные суммы всех строк пакета - одним запросом
+        charges = to_invoice.service_line_ids._get_prorated_charges({
+            subscription.id: subscription._get_billing_period_bounds()
+            for subscription in to_invoice
+            if subscription.next_invoice_date
+        })
+        vals_list = [subscription._prepare_invoice_vals(income_accounts, charges) for subscription in to_invoice]
+        # Пустой счет не создаем - ни одна строка не действовала в периоде
+        invoices = self.env['account.move'].create([vals for vals in vals_list if vals['invoice_line_ids']])
+
+        # Одно уведомление дашборда на компанию вместо сообщения на каждый счет
+        for company in invoices.company_id:
+            company_invoices = invoices.filtered(lambda invoice: invoice.company_id == company)
+            self.env['cost.dashboard.cache']._notify_kpi_update([company.id], {
+                'event': 'invoice_generated',
+                'company_id': company.id,
+                'period': fields.Date.today().strftime('%Y-%m'),
+                'subscription_ids': company_invoices.subscription_id.ids,
+                'client_ids': company_invoices.partner_id.ids,
+                'invoice_count': len(company_invoices),
+                'invoiced_amount': sum(company_invoices.mapped('amount_total')),
+            })
+
+        return existing_invoices | invoices
+
+    def _prepare_invoice_vals(self, income_accounts=None, charges=None):
+        """Prepare invoice values with embedded line commands
+
+        :param income_accounts: company id -> default income account, see _get_income_accounts
+        :param charges: line id -> prorated charge, see _get_prorated_charges
+        """
+        if income_accounts is None:
+            income_accounts = self._get_income_accounts(self.company_id)
+        if charges is None:
+            charges = self.service_line_ids._get_prorated_charges(
+                {self.id: self._get_billing_period_bounds()} if self.next_invoice_date else {})
         return {
             'partner_id': self.client_id.id,
             'move_type': 'out_invoice',
             'subscription_id': self.id,
+            'billing_period_date': self.next_invoice_date,
+            'company_id': self.company_id.id,
             'currency_id': self.currency_id.id,
             'invoice_date': fields.Date.today(),
-            'ref': f'Subscription: {self.name}'
+            'ref': f'Subscription: {self.name}',
+            'invoice_line_ids': [
+                Command.create(line._prepare_invoice_line_vals(income_accounts=income_accounts,
+                                                               charge=charges.get(line.id)))
+                for line in self.service_line_ids
+                # Строки, не действовавшие в периоде, не выставляются
+                if not charges.get(line.id) or charges[line.id][1]
+            ],
         }
 
+    def _get_billing_period_bounds(self):
+        """Period billed at the next invoice date: the recurring interval before it
+
+        :return: (first day, last day)
+        """
+        self.ensure_one()
+        interval = max(self.recurring_interval, 1)
+        step = {
+            'monthly': relativedelta(months=interval),
+            'yearly': relativedelta(years=interval),
+            'weekly': relativedelta(weeks=interval),
+        }.get(self.recurring_rule_type, relativedelta(days=interval))
+        return self.next_invoice_date - step, self.next_invoice_date - timedelta(days=1)
+
     def _update_next_invoice_date(self):
-        """Update next invoice date after generating invoice"""
+        """Update next invoice date after generating invoice
+
+        Marks the due schedule date of each subscription invoiced and tops
+        the schedule up, with one write and one create for all of them.
+        """
+        due_entries = self.env['client.service.billing.schedule']
         for subscription in self:
-            if subscription.recurring_rule_type == 'monthly':
-                subscription.next_invoice_date += relativedelta(months=subscription.recurring_interval)
-            elif subscription.recurring_rule_type == 'yearly':
-                subscription.next_invoice_date += relativedelta(years=subscription.recurring_interval)
-            elif subscription.recurring_rule_type == 'weekly':
-                subscription.next_invoice_date += timedelta(weeks=subscription.recurring_interval)
-            elif subscription.recurring_rule_type == 'daily':
-                subscription.next_invoice_date += timedelta(days=subscription.recurring_interval)
+            pending = subscription.billing_schedule_ids.filtered(lambda entry: entry.state == 'pending')
+            if pending:
+                due_entries |= pending.sorted('date')[0]
+        due_entries.write({'state': 'invoiced'})
+        self._sync_billing_schedule()
 
     def _get_default_income_account(self):
         """Get default income account for invoicing"""
-        # ИСПРАВЛЕНО: более надежный поиск аккаунта дохода
-        # Сначала ищем по коду 7xxx (доходы)
-        income_account = self.env['account.account'].search([
-            ('account_type', '=', 'income'),
-            ('company_id', '=', self.env.company.id),
-            ('deprecated', '=', False)
-        ], limit=1)
-
-        # Если не найден income account, ищем по коду 70% (выручка)
-        if not income_account:
-            income_account = self.env['account.account'].search([
-                ('code', '=like', '70%'),
-                ('company_id', '=', self.env.company.id),
-                ('deprecated', '=', False)
-            ], limit=1)
+        return self._get_income_accounts(self.env.company).get(
+            self.env.company.id, self.env['account.account'])
 
-        # Крайний случай - любой доходный счет
-        if not income_account:
-            income_account = self.env['account.account'].search([
-                ('code', '=like', '7%'),
-                ('company_id', '=', self.env.company.id),
-                ('deprecated', '=', False)
-            ], limit=1)
+    @api.model
+    def _get_income_accounts(self, companies):
+        """Default income account per company, resolved for all companies at once
 
-        return income_account
+        :return: dict company id -> account.account
+        """
+        accounts = {}
+        # ИСПРАВЛЕНО: более надежный поиск аккаунта дохода
+        # Сначала счета дохода, затем по коду 70% (выручка), в крайнем случае любой 7xxx
+        for domain in ([('account_type', '=', 'income')],
+                       [('code', '=like', '70%')],
+                       [('code', '=like', '7%')]):
+            missing = companies.filtered(lambda company: company.id not in accounts)
+            if not missing:
+                break
+            for account in self.env['account.account'].search(domain + [
+                ('company_id', 'in', missing.ids),
+                ('deprecated', '=', False)
+            ]):
+                accounts.setdefault(account.company_id.id, account)
+        return accounts
 
     @api.model_create_multi
     def create(self, vals_list):
@@ -201,26 +384,210 @@ class ClientServiceSubscription(models.Model):
             # ДОБАВЛЕНО: автогенерация кода подписки
             if not vals.get('code'):
                 vals['code'] = self._generate_code('client.service.subscription.code')
-        return super().create(vals_list)
-
-    @api.model
-    def cron_generate_invoices(self):
-        """Cron job to generate invoices"""
-        today = fields.Date.today()
-        subscriptions = self.search([
-            ('state', '=', 'active'),
-            ('auto_invoice', '=', True),
-            ('next_invoice_date', '<=', today)
+        subscriptions = super().create(vals_list)
+        subscriptions.filtered(lambda s: s.state != 'draft')._refresh_kpi_rollup()
+        subscriptions._sync_billing_schedule()
+        return subscriptions
+
+    def write(self, vals):
+        result = super().write(vals)
+        if BILLING_SCHEDULE_FIELDS.intersection(vals):
+            self._sync_billing_schedule(reset=True)
+        elif {'state', 'auto_invoice'}.intersection(vals):
+            self._sync_billing_schedule()
+        # Смена статуса меняет выручку и число активных подписок текущего месяца
+        if 'state' in vals:
+            self._refresh_kpi_rollup()
+        return result
+
+    def _refresh_kpi_rollup(self):
+        """Rebuild the current month KPI rollup for these subscriptions' companies"""
+        if self:
+            self.env['cost.kpi.monthly']._refresh_months([fields.Date.today()], self.company_id.ids)
+
+    def _rate_usage(self):
+        """Usage-rating stage: set metered line quantities before invoicing
+
+        Billable quantities of all metered lines of these subscriptions come
+        from two grouped queries (client driver quantities and active client
+        services); changed lines are then written in one write per distinct
+        quantity. Rated quantities take effect from the start of the billing
+        period they are billed for, so proration bills the whole period at
+        the rated quantity.
+
+        :return: rated lines whose quantity changed
+        """
+        line_model = self.env['client.service.subscription.line']
+        lines = line_model.search([
+            ('subscription_id', 'in', self.ids),
+            ('usage_source', '!=', 'fixed')
         ])
+        if not lines:
+            return line_model
+
+        driver_lines = lines.filtered(lambda line: line.usage_source == 'driver')
+        driver_quantities = {
+            (client.id, driver.id): quantity
+            for client, driver, quantity in self.env['client.cost.driver']._read_group(
+                [
+                    ('client_id', 'in', driver_lines.client_id.ids),
+                    ('driver_id', 'in', driver_lines.usage_driver_id.ids)
+                ],
+                ['client_id', 'driver_id'],
+                ['quantity:sum'],
+            )
+        } if driver_lines else {}
+
+        service_lines = lines - driver_lines
+        service_quantities = {
+            (client.id, service.id): quantity
+            for client, service, quantity in self.env['client.service']._read_group(
+                [
+                    ('client_id', 'in', service_lines.client_id.ids),
+                    ('service_catalog_id', 'in', service_lines.service_id.ids),
+                    ('status', '=', 'active')
+                ],
+                ['client_id', 'service_catalog_id'],
+                ['quantity:sum'],
+            )
+        } if service_lines else {}
+
+        period_starts = {
+            subscription: subscription._get_billing_period_bounds()[0]
+            for subscription in lines.subscription_id
+            if subscription.next_invoice_date
+        }
+
+        # Одна запись на каждое новое значение количества и начало периода, а не на каждую строку
+        changed = defaultdict(lambda: line_model)
+        for line in lines:
+            if line.usage_source == 'driver':
+                quantity = driver_quantities.get((line.client_id.id, line.usage_driver_id.id), 0.0)
+            else:
+                quantity = service_quantities.get((line.client_id.id, line.service_id.id), 0.0)
+            if line.quantity != quantity:
+                changed[(period_starts.get(line.subscription_id), quantity)] |= line
+
+        for (period_start, quantity), quantity_lines in changed.items():
+            # Количество относится к выставляемому периоду - в истории оно действует с его начала
+            quantity_lines.with_context(change_date=period_start).write({'quantity': quantity})
+        return line_model.union(*changed.values())
 
-        for subscription in subscriptions:
+    @api.model
+    def cron_generate_invoices(self, batch_size=INVOICE_BATCH_SIZE):
+        """Cron job to generate invoices
+
+        Due subscriptions are invoiced in chunks: one multi-create per chunk,
+        committed together with the moved next invoice dates, so a crash
+        never re-invoices a committed chunk.
+        """
+        due_subscriptions = self.env['client.service.billing.schedule']._get_due_subscriptions()
+        # Количества метрируемых строк - одним проходом по всем подпискам до выставления
+        due_subscriptions._rate_usage()
+        subscription_ids = due_subscriptions.ids
+
+        for batch_ids in split_every(batch_size, subscription_ids):
+            batch = self.browse(batch_ids)
             try:
-                subscription.action_generate_invoice()
-                # Update next invoice date
-                subscription._update_next_invoice_date()
-            except Exception as e:
-                # Log error but continue with other subscriptions
-                subscription.message_post(body=f"Failed to generate invoice: {e}")
+                with self.env.cr.savepoint():
+                    batch._invoice_due()
+            except Exception:
+                # Пакет не прошел - выясняем, какая подписка мешает, по одной
+                _logger.exception("Batch invoice generation failed, retrying subscriptions one by one")
+                for subscription in batch:
+                    try:
+                        with self.env.cr.savepoint():
+                            subscription._invoice_due()
+                    except Exception as e:
+                        # Log error but continue with other subscriptions
+                        subscription.message_post(body=f"Failed to generate invoice: {e}")
+
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+
+
+    def _invoice_due(self):
+        """Invoice due subscriptions and advance the schedule of the billed ones
+
+        Subscriptions whose lines were all inactive in the period get no
+        invoice, but their period is marked handled. Subscriptions without
+        service lines stay due, so the period is not lost while they are set up.
+        """
+        invoiced = self._create_invoices().subscription_id & self
+        billed = self.filtered('service_line_ids')
+        billed._update_next_invoice_date()
+        if billed - invoiced:
+            _logger.info("Subscriptions %s not invoiced: no service line active in the period",
+                         (billed - invoiced).ids)
+        skipped = self - billed
+        if skipped:
+            _logger.warning("Subscriptions %s not invoiced: no service lines", skipped.ids)
+        return invoiced
+
+    @api.model
+    def cron_sync_billing_schedules(self):
+        """Cron job: build missing billing schedules (after install or data imports)
+
+        Subscriptions without any schedule start from their stored next
+        invoice date (kept in the column from before the schedule existed),
+        so periods that were overdue and unbilled at upgrade are still billed.
+        """
+        subscriptions = self.search([('state', '=', 'active'), ('auto_invoice', '=', True)])
+        for batch_ids in split_every(INVOICE_BATCH_SIZE, subscriptions.ids):
+            # Сохраненное значение читаем из таблицы: ORM пересчитал бы его по пустому графику
+            self.env.cr.execute("""
+                SELECT subscription.id, subscription.next_invoice_date
+                  FROM client_service_subscription subscription
+                 WHERE subscription.id IN %s
+                   AND subscription.next_invoice_date IS NOT NULL
+                   AND NOT EXISTS (SELECT 1
+                                     FROM client_service_billing_schedule entry
+                                    WHERE entry.subscription_id = subscription.id)
+            """, [tuple(batch_ids)])
+            self.browse(batch_ids)._sync_billing_schedule(first_dates=dict(self.env.cr.fetchall()))
+
+
+class ClientServiceBillingSchedule(models.Model):
+    _name = 'client.service.billing.schedule'
+    _description = 'Subscription Billing Schedule'
+    _order = 'date, id'
+    _rec_name = 'date'
+    _inherit = ['cost.dashboard.cache.mixin']
+
+    subscription_id = fields.Many2one('client.service.subscription', string='Subscription',
+                                      required=True, ondelete='cascade', index=True)
+    client_id = fields.Many2one(related='subscription_id.client_id', store=True)
+    company_id = fields.Many2one(related='subscription_id.company_id', store=True)
+    date = fields.Date(string='Invoice Date', required=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('invoiced', 'Invoiced')
+    ], string='Status', default='pending', required=True)
+
+    _sql_constraints = [
+        ('unique_subscription_date', 'unique(subscription_id, date)',
+         'A subscription can only be billed once per date!')
+    ]
+
+    def init(self):
+        # "Что подлежит выставлению сегодня" - диапазон по дате среди ожидающих
+        create_index(self.env.cr, 'client_service_billing_schedule_due_idx', self._table,
+                     ['date', 'company_id'], where="state = 'pending'")
+
+    @api.model
+    def _get_due_subscriptions(self, domain=None, date=None):
+        """Subscriptions with a pending invoice date on or before date (today by default)
+
+        A single range query on the pending-date index; only active
+        auto-invoiced subscriptions have pending dates.
+
+        :param domain: extra domain on schedule entries (subscription_id, client_id, company_id)
+        """
+        groups = self._read_group(
+            [('state', '=', 'pending'), ('date', '<=', date or fields.Date.today())] + (domain or []),
+            ['subscription_id'],
+        )
+        return self.env['client.service.subscription'].union(*(subscription for subscription, in groups))
 
 
 class ClientServiceSubscriptionLine(models.Model):
@@ -238,6 +605,11 @@ class ClientServiceSubscriptionLine(models.Model):
     sequence = fields.Integer(string='Sequence', default=10)
     service_id = fields.Many2one('service.catalog', string='Service', required=True)
 
+    # Active window within the subscription (billed prorated by day)
+    date_start = fields.Date(string='Start Date', help='Leave empty to bill from the subscription start')
+    date_end = fields.Date(string='End Date', help='Leave empty to bill until the subscription end')
+    change_ids = fields.One2many('client.service.subscription.line.change', 'line_id', string='Changes')
+
     # Service details
     name = fields.Text(string='Description')
     quantity = fields.Float(string='Quantity', default=1.0, required=True)
@@ -248,6 +620,17 @@ class ClientServiceSubscriptionLine(models.Model):
     client_service_ids = fields.Many2many('client.service', string='Client Services',
                                           help='Physical services/equipment linked to this subscription line')
 
+    # Usage rating
+    usage_source = fields.Selection([
+        ('fixed', 'Fixed Quantity'),
+        ('driver', 'Cost Driver Quantity'),
+        ('services', 'Active Client Services')
+    ], string='Quantity Source', default='fixed', required=True, index=True,
+        help='Fixed: quantity entered manually; Cost Driver: client quantity of the driver; '
+             'Active Client Services: total quantity of the client active services of this catalog item. '
+             'Metered quantities are rated before each invoicing.')
+    usage_driver_id = fields.Many2one('cost.driver', string='Usage Driver')
+
     # External integration (optional)
     external_line_id = fields.Char(string='External Line ID', help='ID from external subscription system')
 
@@ -256,6 +639,144 @@ class ClientServiceSubscriptionLine(models.Model):
         for record in self:
             record.total_price = record.quantity * record.unit_price
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        lines = super().create(vals_list)
+        # Первая запись истории без даты: количество и цена действуют с начала
+        lines._record_changes(False)
+        return lines
+
+    def write(self, vals):
+        changed = {'quantity', 'unit_price'}.intersection(vals)
+        if changed:
+            # Строки без истории (созданные до нее): сначала фиксируем прежние значения
+            # как действующие с начала, иначе дни до изменения выставляются по нулям
+            self.filtered(lambda line: not line.change_ids)._record_changes(False)
+        result = super().write(vals)
+        if changed:
+            self._record_changes(self.env.context.get('change_date') or fields.Date.today())
+        return result
+
+    def _record_changes(self, date):
+        """Store current quantity and price in the line history, effective from date"""
+        self.env['client.service.subscription.line.change'].create([{
+            'line_id': line.id,
+            'date': date,
+            'quantity': line.quantity,
+            'unit_price': line.unit_price,
+        } for line in self])
+
+    def _get_prorated_charges(self, periods):
+        """Proration engine: day-accurate charges of these lines for billing periods
+
+        One query for all lines: the line history is cut into segments
+        (quantity and price valid between two changes), each segment is
+        clipped to the billing period and the line and subscription active
+        windows, and charges are summed as daily rate x active days.
+
+        :param periods: subscription id -> (period start, period end), both inclusive
+        :return: dict line id -> (amount, active days, period days, quantity, unit price);
+                 quantity and unit price are those of the only history segment
+                 active in the period, None when several are
+        """
+        periods = {subscription_id: period for subscription_id, period in periods.items() if period}
+        lines = self.filtered(lambda line: line.subscription_id.id in periods)
+        if not lines:
+            return {}
+
+        self.flush_model(['quantity', 'unit_price', 'date_start', 'date_end', 'subscription_id'])
+        self.env['client.service.subscription'].flush_model(['start_date', 'end_date'])
+        self.env['client.service.subscription.line.change'].flush_model()
+
+        subscription_ids = list(periods)
+        self.env.cr.execute("""
+            WITH periods AS (
+                SELECT *
+                  FROM unnest(%(subscription_ids)s::int[], %(period_starts)s::date[], %(period_ends)s::date[])
+                       AS period(subscription_id, period_start, period_end)
+            ), changes AS (
+                SELECT change.line_id, change.date, change.quantity, change.unit_price, change.id
+                  FROM client_service_subscription_line_change change
+                 WHERE change.line_id IN %(line_ids)s
+                 UNION ALL
+                -- Строки без истории: текущие количество и цена действуют с начала
+                SELECT line.id, NULL, line.quantity, line.unit_price, 0
+                  FROM client_service_subscription_line line
+                 WHERE line.id IN %(line_ids)s
+                   AND NOT EXISTS (SELECT 1
+                                     FROM client_service_subscription_line_change change
+                                    WHERE change.line_id = line.id)
+            ), segments AS (
+                SELECT line_id, quantity, unit_price,
+                       COALESCE(date, '-infinity'::date) AS segment_start,
+                       LEAD(date) OVER (PARTITION BY line_id ORDER BY date NULLS FIRST, id) AS segment_end
+                  FROM changes
+            ), bounded AS (
+                SELECT segment.line_id, segment.quantity, segment.unit_price,
+                       period.period_end - period.period_start + 1 AS period_days,
+                       GREATEST(segment.segment_start, period.period_start,
+                                COALESCE(line.date_start, subscription.start_date, period.period_start)) AS date_from,
+                       LEAST(COALESCE(segment.segment_end, 'infinity'::date), period.period_end + 1,
+                             COALESCE(line.date_end + 1, 'infinity'::date),
+                             COALESCE(subscription.end_date + 1, 'infinity'::date)) AS date_to
+                  FROM segments segment
+                  JOIN client_service_subscription_line line ON line.id = segment.line_id
+                  JOIN client_service_subscription subscription ON subscription.id = line.subscription_id
+                  JOIN periods period ON period.subscription_id = line.subscription_id
+            )
+            SELECT line_id,
+                   SUM(quantity * unit_price * GREATEST(date_to - date_from, 0)) / MAX(period_days),
+                   SUM(GREATEST(date_to - date_from, 0)),
+                   MAX(period_days),
+                   COUNT(*) FILTER (WHERE date_to > date_from),
+                   MAX(quantity) FILTER (WHERE date_to > date_from),
+                   MAX(unit_price) FILTER (WHERE date_to > date_from)
+              FROM bounded
+             GROUP BY line_id
+        """, {
+            'subscription_ids': subscription_ids,
+            'period_starts': [periods[subscription_id][0] for subscription_id in subscription_ids],
+            'period_ends': [periods[subscription_id][1] for subscription_id in subscription_ids],
+            'line_ids': tuple(lines.ids),
+        })
+        return {
+            line_id: (amount or 0.0, active_days, period_days,
+                      quantity if segments == 1 else None, unit_price if segments == 1 else None)
+            for line_id, amount, active_days, period_days, segments, quantity, unit_price
+            in self.env.cr.fetchall()
+        }
+
+    def _apply_proration(self, vals, charge):
+        """Bill the charge of the billing period instead of the current quantity x unit price
+
+        A line with one quantity and price over the whole period is billed
+        with them as is; otherwise the prorated amount is billed and labelled.
+        """
+        if not charge:
+            return vals
+        amount, active_days, period_days, quantity, unit_price = charge
+        if quantity is not None:
+            # Один отрезок истории в периоде - выставляем его количество, а не текущее
+            vals['quantity'] = quantity
+            if active_days == period_days:
+                vals['price_unit'] = unit_price
+                return vals
+        if float_compare(amount, vals['quantity'] * vals['price_unit'], precision_digits=2) == 0:
+            return vals
+
+        vals['name'] = f"{vals['name']} (prorated: {active_days}/{period_days} days)"
+        if vals['quantity']:
+            vals['price_unit'] = amount / vals['quantity']
+        else:
+            vals.update(quantity=1, price_unit=amount)
+        return vals
+
+    @api.constrains('usage_source', 'usage_driver_id')
+    def _check_usage_driver(self):
+        for line in self:
+            if line.usage_source == 'driver' and not line.usage_driver_id:
+                raise ValidationError("A usage driver is required for lines rated by cost driver quantity.")
+
     @api.onchange('service_id')
     def _onchange_service_id(self):
         if self.service_id:
@@ -264,20 +785,40 @@ class ClientServiceSubscriptionLine(models.Model):
             # ИСПРАВЛЕНО: используем sales_price из service.catalog
             self.unit_price = self.service_id.sales_price
 
-    def _prepare_invoice_line_vals(self, invoice):
-        """Prepare invoice line values"""
+    def _prepare_invoice_line_vals(self, invoice=None, income_accounts=None, charge=None):
+        """Prepare invoice line values (without move_id when embedded in invoice vals)
+
+        :param charge: prorated charge of the line, see _get_prorated_charges
+        """
+        if income_accounts is None:
+            income_accounts = self.subscription_id._get_income_accounts(self.company_id)
         # ИСПРАВЛЕНО: добавлена проверка на наличие account
-        account = self.service_id.property_account_income_id or self.subscription_id._get_default_income_account()
+        account = self.service_id.property_account_income_id or income_accounts.get(self.company_id.id)
         if not account:
-            from odoo.exceptions import UserError
             raise UserError(f"No income account found for service '{self.service_id.name}'. "
                             f"Please configure an income account for this service.")
 
-        return {
-            'move_id': invoice.id,
+        vals = {
             'name': self.name or self.service_id.name,
             'quantity': self.quantity,
             'price_unit': self.unit_price,
             'account_id': account.id,
             'subscription_line_id': self.id
-        }
\ No newline at end of file
+        }
+        self._apply_proration(vals, charge)
+        if invoice:
+            vals['move_id'] = invoice.id
+        return vals
+
+
+class ClientServiceSubscriptionLineChange(models.Model):
+    _name = 'client.service.subscription.line.change'
+    _description = 'Subscription Line Change History'
+    _order = 'line_id, date, id'
+
+    line_id = fields.Many2one('client.service.subscription.line', string='Subscription Line',
+                              required=True, ondelete='cascade', index=True)
+    subscription_id = fields.Many2one(related='line_id.subscription_id', store=True)
+    date = fields.Date(string='Effective From', help='Empty for the values the line was created with')
+    quantity = fields.Float(string='Quantity')
+    unit_price = fields.Float(string='Unit Price')
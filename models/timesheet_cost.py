@@ -0,0 +1,141 @@
+# models/timesheet_cost.py
+
+from odoo import models, fields, api
+from odoo.tools.sql import index_exists
+from datetime import timedelta
+from dateutil.relativedelta import relativedelta
+
+
+class TimesheetCostFact(models.Model):
+    _name = 'timesheet.cost.fact'
+    _description = 'Timesheet Cost Fact'
+    _order = 'period_date desc, partner_id, project_id'
+    _rec_name = 'project_id'
+    _inherit = ['cost.dashboard.cache.mixin']
+    _dashboard_period_field = 'period_date'
+
+    period_date = fields.Date(string='Period', required=True, index=True,
+                              help='First day of the month')
+    company_id = fields.Many2one('res.company', string='Company', index=True)
+    partner_id = fields.Many2one('res.partner', string='Client', index=True)
+    project_id = fields.Many2one('project.project', string='Project')
+    task_id = fields.Many2one('project.task', string='Task')
+    employee_id = fields.Many2one('hr.employee', string='Employee', index=True)
+
+    hours = fields.Float(string='Hours')
+    hourly_cost = fields.Float(string='Hourly Cost', group_operator='avg')
+    cost = fields.Monetary(string='Cost', currency_field='currency_id')
+    currency_id = fields.Many2one('res.currency', string='Currency')
+
+    def init(self):
+        # Один факт на месяц, компанию, клиента, проект, задачу и сотрудника - повторная сборка не дублирует
+        if index_exists(self.env.cr, 'timesheet_cost_fact_unique_idx'):
+            return
+        # Дубли прежних параллельных сборок удаляем: факты всегда можно пересобрать
+        self.env.cr.execute("""
+            DELETE FROM timesheet_cost_fact fact
+             USING timesheet_cost_fact other
+             WHERE fact.id > other.id
+               AND fact.period_date = other.period_date
+               AND fact.company_id IS NOT DISTINCT FROM other.company_id
+               AND fact.partner_id IS NOT DISTINCT FROM other.partner_id
+               AND fact.project_id IS NOT DISTINCT FROM other.project_id
+               AND fact.task_id IS NOT DISTINCT FROM other.task_id
+               AND fact.employee_id IS NOT DISTINCT FROM other.employee_id
+        """)
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX timesheet_cost_fact_unique_idx
+                ON timesheet_cost_fact (period_date, COALESCE(company_id, 0), COALESCE(partner_id, 0),
+                                        project_id, COALESCE(task_id, 0), employee_id)
+        """)
+
+    @api.model
+    def _refresh_periods(self, periods, partner_ids=None):
+        """Rebuild facts for the given months from timesheets.
+
+        One grouped query per month over account.analytic.line by
+        (project, task, employee), multiplied by the rate in effect for
+        that month, replaces the previous facts of the month.
+
+        Facts are shared by all users, so they are rebuilt as superuser from
+        all timesheets in scope. Rebuilds of a month are serialized with a
+        transaction-level advisory lock; the unique index turns any remaining
+        overlap into an error instead of doubled facts.
+
+        :param periods: iterable of dates (any day of the month)
+        :param partner_ids: rebuild only the facts of these clients (all if None)
+        """
+        months = sorted({period.replace(day=1) for period in periods})
+        if not months:
+            return self.browse()
+
+        for month in months:
+            self.env.cr.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s)",
+                                [self._table, month.toordinal()])
+
+        facts = self.sudo()
+        scope = [('partner_id', 'in', list(partner_ids))] if partner_ids is not None else []
+        facts.search([('period_date', 'in', months)] + scope).unlink()
+        line_scope = [('project_id.partner_id', 'in', list(partner_ids))] if partner_ids is not None else []
+
+        vals_list = []
+        for month in months:
+            month_end = month + relativedelta(months=1) - timedelta(days=1)
+            groups = self.env['account.analytic.line'].sudo()._read_group(
+                [
+                    ('project_id', '!=', False),
+                    ('employee_id', '!=', False),
+                    ('date', '>=', month),
+                    ('date', '<=', month_end),
+                ] + line_scope,
+                ['project_id', 'task_id', 'employee_id'],
+                ['unit_amount:sum'],
+            )
+            if not groups:
+                continue
+
+            rates = self.env['cost.employee.history'].sudo()._get_hourly_rates(
+                [employee.id for project, task, employee, hours in groups], [month])
+
+            for project, task, employee, hours in groups:
+                rate = rates.get((employee.id, month), 0.0)
+                vals_list.append({
+                    'period_date': month,
+                    'company_id': project.company_id.id or employee.company_id.id,
+                    'partner_id': project.partner_id.id,
+                    'project_id': project.id,
+                    'task_id': task.id,
+                    'employee_id': employee.id,
+                    'hours': hours,
+                    'hourly_cost': rate,
+                    'cost': hours * rate,
+                    'currency_id': (project.company_id or self.env.company).currency_id.id,
+                })
+
+        return facts.create(vals_list).sudo(False)
+
+    @api.model
+    def _get_cost_by_partner(self, periods, partner_ids):
+        """Direct cost per (partner_id, period) in one grouped query"""
+        groups = self._read_group(
+            [('period_date', 'in', list(periods)), ('partner_id', 'in', list(partner_ids))],
+            ['partner_id', 'period_date:day'],
+            ['cost:sum'],
+        )
+        return {(partner.id, period): cost for partner, period, cost in groups}
+
+    @api.model
+    def _get_employee_totals(self, period, employee_ids):
+        """Hours and cost per employee for a month: {employee_id: (hours, cost)}"""
+        groups = self._read_group(
+            [('period_date', '=', period.replace(day=1)), ('employee_id', 'in', list(employee_ids))],
+            ['employee_id'],
+            ['hours:sum', 'cost:sum'],
+        )
+        return {employee.id: (hours, cost) for employee, hours, cost in groups}
+
+    @api.model
+    def cron_refresh_current_periods(self):
+        """Cron job: rebuild facts for the current and previous month"""
+        current_month = fields.Date.today().replace(day=1)
+        self._refresh_periods([current_month - relativedelta(months=1), current_month])
@@ -3,6 +3,33 @@
 import { Component, onMounted, onWillUnmount, useState, xml, useRef } from "@odoo/owl";
 import { registry } from "@web/core/registry";
 import { useService } from "@web/core/utils/hooks";
+import { loadBundle } from "@web/core/assets";
+import { escape } from "@web/core/utils/strings";
+
+// Dashboard sections and the elements that show a skeleton while each one loads
+const DASHBOARD_SECTIONS = {
+    cost_overview: ['total_cost', 'cost_change'],
+    billing_summary: ['total_revenue', 'margin_info', 'due_invoices', 'total_invoiced'],
+    client_stats: ['total_clients', 'allocation_coverage'],
+    employee_utilization: ['avg_utilization', 'overloaded_info'],
+    service_performance: ['total_services', 'active_subscriptions'],
+    top_clients: ['top_clients_list'],
+    cost_trends: ['costTrendsChart'],
+    pool_distribution: ['poolDistributionChart'],
+    timesheet_costs: ['timesheet_total_hours', 'timesheet_total_cost', 'timesheet_top_projects', 'timesheet_top_employees'],
+};
+
+const FALLBACK_DATA = {
+    cost_overview: { current_total: 0, previous_total: 0, change_percent: 0 },
+    client_stats: { total_clients: 0, active_subscriptions: 0, allocated_clients: 0, allocation_coverage: 0 },
+    employee_utilization: { total_employees: 0, avg_utilization: 0, overloaded_count: 0 },
+    billing_summary: { total_revenue: 0, total_cost: 0, margin_percent: 0, due_invoices: 0, total_invoiced: 0 },
+    service_performance: { total_services: 0, active_subscriptions: 0 },
+    top_clients: [],
+    cost_trends: { months: [], total_costs: [] },
+    pool_distribution: [],
+    timesheet_costs: { total_hours: 0, total_cost: 0, top_projects: [], top_employees: [] }
+};
 
 export class CostAllocationDashboard extends Component {
     static template = xml`<div class="o_cost_dashboard_container" t-ref="dashboardContainer"></div>`;
@@ -11,20 +38,39 @@ export class CostAllocationDashboard extends Component {
         this.rpc = useService("rpc");
         this.action = useService("action");
         this.notification = useService("notification");
+        this.busService = useService("bus_service");
+        this.companyService = useService("company");
         this.dashboardRef = useRef("dashboardContainer");
+        this.loadId = 0;
+        this.charts = {};
+
+        // Chart.js поставляется в ассетах web (web.chartjs_lib) - без CDN, работает офлайн.
+        // Загрузка начинается сразу, но ждут ее только графики, а не KPI-плитки
+        this.chartLibPromise = loadBundle("web.chartjs_lib").catch((error) => {
+            console.error('Failed to load Chart.js bundle:', error);
+        });
 
         this.state = useState({
             loading: true,
             data: {},
             period: 12,
+            // Фильтры (company_ids, client_tag_ids, pool_types, service_category_ids,
+            // date_from, date_to) можно задать в контексте действия
+            filters: (this.props.action && this.props.action.context
+                && this.props.action.context.dashboard_filters) || {},
             chartsLoaded: false,
             error: null
         });
 
+        // Изменения KPI приходят по шине и патчат виджеты без полной перезагрузки
+        this.pendingSections = new Set();
+        this.onKpiUpdate = this.onKpiUpdate.bind(this);
+
         onMounted(() => {
             this.renderDashboard();
             this.loadDashboardData();
             this.setupEventListeners();
+            this.busService.subscribe("cost_allocation/kpi_update", this.onKpiUpdate);
         });
 
         onWillUnmount(() => {
@@ -260,6 +306,39 @@ export class CostAllocationDashboard extends Component {
                                             <small>
                                                 <strong id="due_invoices">-</strong> subscriptions due for invoice
                                             </small>
+                                            <small class="d-block">
+                                                Invoiced to date: <strong id="total_invoiced">-</strong>
+                                            </small>
+                                        </div>
+                                    </div>
+                                </div>
+                            </div>
+                        </div>
+                    </div>
+
+                    <!-- Timesheet Costs Row -->
+                    <div class="row">
+                        <div class="col-12 mb-3">
+                            <div class="card">
+                                <div class="card-header d-flex justify-content-between align-items-center">
+                                    <h5 class="mb-0">
+                                        <i class="fa fa-clock-o text-primary"></i>
+                                        Timesheet Costs
+                                    </h5>
+                                    <small class="text-muted">
+                                        <strong id="timesheet_total_hours">-</strong> h,
+                                        <strong id="timesheet_total_cost">-</strong>
+                                    </small>
+                                </div>
+                                <div class="card-body">
+                                    <div class="row">
+                                        <div class="col-lg-6">
+                                            <h6 class="text-muted mb-2">Top Projects</h6>
+                                            <div id="timesheet_top_projects"></div>
+                                        </div>
+                                        <div class="col-lg-6">
+                                            <h6 class="text-muted mb-2">Top Employees</h6>
+                                            <div id="timesheet_top_employees"></div>
                                         </div>
                                     </div>
                                 </div>
@@ -272,45 +351,201 @@ export class CostAllocationDashboard extends Component {
     }
 
     async loadDashboardData() {
-        try {
-            this.state.loading = true;
-            this.state.error = null;
+        // Each section has its own endpoint: fast KPI tiles render immediately,
+        // heavy charts arrive as soon as their own request completes
+        const loadId = ++this.loadId;
+        const failed = [];
 
-            console.log('Loading dashboard data...');
+        this.state.loading = true;
+        this.state.error = null;
+        this.state.data = {};
 
-            const data = await this.rpc('/cost_allocation/dashboard_data', {
-                period_months: this.state.period
-            });
+        const errorAlert = document.getElementById('error_alert');
+        if (errorAlert) {
+            errorAlert.style.display = 'none';
+        }
+
+        Object.keys(DASHBOARD_SECTIONS).forEach(section => this.setSkeleton(section, true));
+
+        await Promise.all(Object.keys(DASHBOARD_SECTIONS).map(async (section) => {
+            try {
+                const result = await this.rpc(`/cost_allocation/dashboard_data/${section}`, {
+                    period_months: this.state.period,
+                    filters: this.state.filters
+                });
+                // Ignore responses of a previous load (period changed meanwhile)
+                if (loadId !== this.loadId) return;
+                if (result.error) throw new Error(result.error);
+
+                this.state.data[section] = result[section];
+                await this.applySection(section, result[section]);
+            } catch (error) {
+                if (loadId !== this.loadId) return;
+                console.error(`Error loading dashboard section ${section}:`, error);
+                failed.push(section);
+                await this.applySection(section, FALLBACK_DATA[section]);
+            } finally {
+                if (loadId === this.loadId) {
+                    this.setSkeleton(section, false);
+                }
+            }
+        }));
+
+        if (loadId !== this.loadId) return;
+        this.state.loading = false;
+
+        if (failed.length) {
+            this.state.error = failed.join(', ');
+            this.showError('Failed to load dashboard sections: ' + this.state.error);
+        }
+    }
 
-            console.log('Dashboard data loaded:', data);
+    async refreshSections(sections) {
+        // Точечная перезагрузка отдельных разделов (без скелетонов)
+        const loadId = this.loadId;
+        await Promise.all(sections.map(async (section) => {
+            try {
+                const result = await this.rpc(`/cost_allocation/dashboard_data/${section}`, {
+                    period_months: this.state.period,
+                    filters: this.state.filters
+                });
+                if (loadId !== this.loadId || result.error) return;
+
+                this.state.data[section] = result[section];
+                await this.applySection(section, result[section]);
+            } catch (error) {
+                console.error(`Error refreshing dashboard section ${section}:`, error);
+            }
+        }));
+    }
+
+    scheduleRefresh(sections) {
+        // Во время закрытия месяца события идут пачками - перезапрашиваем разделы один раз
+        sections.forEach(section => this.pendingSections.add(section));
+        clearTimeout(this.refreshTimer);
+        this.refreshTimer = setTimeout(() => {
+            const pending = [...this.pendingSections];
+            this.pendingSections.clear();
+            this.refreshSections(pending);
+        }, 2000);
+    }
 
-            this.state.data = data;
-            this.state.loading = false;
+    onKpiUpdate(payload) {
+        if (!payload || this.state.loading) return;
 
-            // Hide error alert if it was shown
-            const errorAlert = document.getElementById('error_alert');
-            if (errorAlert) {
-                errorAlert.style.display = 'none';
+        // Только события компаний, которые показывает дашборд
+        const companyIds = (this.state.filters.company_ids && this.state.filters.company_ids.length)
+            ? this.state.filters.company_ids
+            : this.companyService.activeCompanyIds;
+        if (!companyIds.includes(payload.company_id)) return;
+
+        // Фильтры по клиентам нельзя проверить на клиенте - перезапрашиваем затронутые разделы
+        const clientFiltered = (this.state.filters.client_tag_ids || []).length
+            || (this.state.filters.service_category_ids || []).length;
+
+        if (payload.event === 'invoice_generated') {
+            this.scheduleRefresh(['billing_summary']);
+            return;
+        }
+
+        if (clientFiltered) {
+            this.scheduleRefresh(['cost_overview', 'client_stats', 'cost_trends', 'top_clients', 'billing_summary', 'timesheet_costs']);
+            return;
+        }
+
+        this.applyCostDelta(payload);
+        // Рейтинг и маржа зависят от всех клиентов - их пересчитывает сервер
+        this.scheduleRefresh(['top_clients', 'billing_summary', 'timesheet_costs']);
+    }
+
+    applyCostDelta(payload) {
+        const delta = payload.cost_delta || {};
+        const endDate = this.state.filters.date_to || new Date().toISOString().slice(0, 10);
+        const currentPeriod = endDate.slice(0, 7);
+        const [year, month] = currentPeriod.split('-').map(Number);
+        const previousPeriod = month === 1
+            ? `${year - 1}-12`
+            : `${year}-${String(month - 1).padStart(2, '0')}`;
+
+        const overview = this.state.data.cost_overview;
+        if (overview) {
+            if (payload.period === currentPeriod) {
+                overview.current_total = (overview.current_total || 0) + (delta.total || 0);
+                overview.current_direct = (overview.current_direct || 0) + (delta.direct || 0);
+                overview.current_indirect = (overview.current_indirect || 0) + (delta.indirect || 0);
+                overview.current_admin = (overview.current_admin || 0) + (delta.admin || 0);
+            } else if (payload.period === previousPeriod) {
+                overview.previous_total = (overview.previous_total || 0) + (delta.total || 0);
             }
 
-            // Update UI
-            this.updateKPICards(data);
-            this.updateTopClients(data.top_clients || []);
-            this.renderCharts(data);
+            const change = overview.previous_total > 0
+                ? ((overview.current_total - overview.previous_total) / overview.previous_total) * 100
+                : 0;
+            overview.change_percent = Math.round(change * 100) / 100;
+            overview.change_direction = change > 0 ? 'up' : change < 0 ? 'down' : 'stable';
+            this.updateCostOverview(overview);
+        }
 
-        } catch (error) {
-            console.error('Error loading dashboard data:', error);
-            this.state.loading = false;
-            this.state.error = error.message || 'Unknown error';
+        const clientStats = this.state.data.client_stats;
+        if (clientStats && payload.period === currentPeriod && (payload.client_ids || []).length) {
+            clientStats.allocated_clients = (clientStats.allocated_clients || 0) + payload.client_ids.length;
+            clientStats.allocation_coverage = Math.round(
+                clientStats.allocated_clients / Math.max(clientStats.total_clients || 0, 1) * 1000) / 10;
+            this.updateClientStats(clientStats);
+        }
 
-            // Show error in UI
-            this.showError('Failed to load dashboard data: ' + (error.message || 'Network error'));
+        const trends = this.state.data.cost_trends;
+        const index = trends && trends.months ? trends.months.indexOf(payload.period) : -1;
+        if (index >= 0) {
+            ['direct', 'indirect', 'admin', 'total'].forEach(name => {
+                const series = trends[`${name}_costs`];
+                if (series) {
+                    series[index] = (series[index] || 0) + (delta[name] || 0);
+                }
+            });
+            this.renderCharts({ cost_trends: trends });
+        }
+    }
 
-            // Load fallback data
-            this.loadFallbackData();
+    async applySection(section, payload) {
+        switch (section) {
+            case 'cost_overview':
+                this.updateCostOverview(payload);
+                break;
+            case 'billing_summary':
+                this.updateBillingSummary(payload);
+                break;
+            case 'client_stats':
+                this.updateClientStats(payload);
+                break;
+            case 'employee_utilization':
+                this.updateEmployeeUtilization(payload);
+                break;
+            case 'service_performance':
+                this.updateServicePerformance(payload);
+                break;
+            case 'top_clients':
+                this.updateTopClients(payload || []);
+                break;
+            case 'timesheet_costs':
+                this.updateTimesheetCosts(payload);
+                break;
+            case 'cost_trends':
+            case 'pool_distribution':
+                await this.renderCharts({ [section]: payload });
+                break;
         }
     }
 
+    setSkeleton(section, loading) {
+        (DASHBOARD_SECTIONS[section] || []).forEach(id => {
+            const el = document.getElementById(id);
+            if (el) {
+                el.classList.toggle('o_dashboard_skeleton', loading);
+            }
+        });
+    }
+
     showError(message) {
         const errorAlert = document.getElementById('error_alert');
         const errorMessage = document.getElementById('error_message');
@@ -324,34 +559,7 @@ export class CostAllocationDashboard extends Component {
         this.notification.add(message, { type: 'danger' });
     }
 
-    loadFallbackData() {
-        // Load basic data to prevent empty dashboard
-        const fallbackData = {
-            cost_overview: { current_total: 0, previous_total: 0, change_percent: 0 },
-            client_stats: { total_clients: 0, active_subscriptions: 0, allocated_clients: 0, allocation_coverage: 0 },
-            employee_utilization: { total_employees: 0, avg_utilization: 0, overloaded_count: 0 },
-            billing_summary: { total_revenue: 0, total_cost: 0, margin_percent: 0, due_invoices: 0 },
-            service_performance: { total_services: 0, active_subscriptions: 0 },
-            top_clients: [],
-            cost_trends: { months: [], total_costs: [] },
-            pool_distribution: []
-        };
-
-        this.updateKPICards(fallbackData);
-        this.updateTopClients([]);
-    }
-
-    updateKPICards(data) {
-        if (!data) return;
-
-        const {
-            cost_overview = {},
-            client_stats = {},
-            employee_utilization = {},
-            billing_summary = {},
-            service_performance = {}
-        } = data;
-
+    updateCostOverview(cost_overview = {}) {
         // Total Cost
         const totalCostEl = document.getElementById('total_cost');
         if (totalCostEl) {
@@ -366,7 +574,9 @@ export class CostAllocationDashboard extends Component {
                 changeEl.className = `change-indicator text-${change_direction === 'up' ? 'warning' : change_direction === 'down' ? 'success' : 'muted'}`;
             }
         }
+    }
 
+    updateBillingSummary(billing_summary = {}) {
         // Revenue
         const revenueEl = document.getElementById('total_revenue');
         if (revenueEl) {
@@ -378,6 +588,19 @@ export class CostAllocationDashboard extends Component {
             }
         }
 
+        // Billing Status
+        const dueInvoicesEl = document.getElementById('due_invoices');
+        if (dueInvoicesEl) {
+            dueInvoicesEl.textContent = (billing_summary.due_invoices || 0).toString();
+        }
+
+        const invoicedEl = document.getElementById('total_invoiced');
+        if (invoicedEl) {
+            invoicedEl.textContent = this.formatCurrency(billing_summary.total_invoiced || 0);
+        }
+    }
+
+    updateClientStats(client_stats = {}) {
         // Clients
         const clientsEl = document.getElementById('total_clients');
         if (clientsEl) {
@@ -388,7 +611,9 @@ export class CostAllocationDashboard extends Component {
                 coverageEl.textContent = `Coverage: ${client_stats.allocation_coverage || 0}%`;
             }
         }
+    }
 
+    updateEmployeeUtilization(employee_utilization = {}) {
         // Team Utilization
         const utilizationEl = document.getElementById('avg_utilization');
         if (utilizationEl) {
@@ -399,7 +624,9 @@ export class CostAllocationDashboard extends Component {
                 overloadedEl.textContent = `Overloaded: ${employee_utilization.overloaded_count || 0}`;
             }
         }
+    }
 
+    updateServicePerformance(service_performance = {}) {
         // Service Stats
         const servicesEl = document.getElementById('total_services');
         if (servicesEl) {
@@ -410,12 +637,6 @@ export class CostAllocationDashboard extends Component {
         if (subscriptionsEl) {
             subscriptionsEl.textContent = (service_performance.active_subscriptions || 0).toString();
         }
-
-        // Billing Status
-        const dueInvoicesEl = document.getElementById('due_invoices');
-        if (dueInvoicesEl) {
-            dueInvoicesEl.textContent = (billing_summary.due_invoices || 0).toString();
-        }
     }
 
     updateTopClients(topClients) {
@@ -459,56 +680,89 @@ export class CostAllocationDashboard extends Component {
         listEl.innerHTML = html;
     }
 
-    renderCharts(data) {
-        if (!data) return;
+    updateTimesheetCosts(timesheet_costs = {}) {
+        const hoursEl = document.getElementById('timesheet_total_hours');
+        if (hoursEl) {
+            hoursEl.textContent = (timesheet_costs.total_hours || 0).toFixed(1);
+        }
 
-        // Load Chart.js if not already loaded
-        if (typeof Chart === 'undefined') {
-            this.loadChartJS().then(() => {
-                this.createCharts(data);
-            });
-        } else {
-            this.createCharts(data);
+        const costEl = document.getElementById('timesheet_total_cost');
+        if (costEl) {
+            costEl.textContent = this.formatCurrency(timesheet_costs.total_cost || 0);
         }
+
+        this.renderTimesheetList('timesheet_top_projects', timesheet_costs.top_projects);
+        this.renderTimesheetList('timesheet_top_employees', timesheet_costs.top_employees);
     }
 
-    async loadChartJS() {
-        return new Promise((resolve) => {
-            if (document.getElementById('chartjs-script')) {
-                resolve();
-                return;
-            }
+    renderTimesheetList(elementId, rows) {
+        const listEl = document.getElementById(elementId);
+        if (!listEl) return;
 
-            const script = document.createElement('script');
-            script.id = 'chartjs-script';
-            script.src = 'https://cdnjs.cloudflare.com/ajax/libs/Chart.js/3.9.1/chart.min.js';
-            script.onload = resolve;
-            script.onerror = () => {
-                console.error('Failed to load Chart.js');
-                resolve(); // Don't block the dashboard
-            };
-            document.head.appendChild(script);
+        if (!rows || !rows.length) {
+            listEl.innerHTML = `<p class="text-muted small mb-0">No timesheets for this month</p>`;
+            return;
+        }
+
+        let html = '';
+        rows.forEach(row => {
+            html += `
+                <div class="d-flex justify-content-between mb-1 border-bottom">
+                    <span>${escape(row.name || '-')}</span>
+                    <span>
+                        <small class="text-muted me-2">${(row.hours || 0).toFixed(1)} h</small>
+                        <strong>${this.formatCurrency(row.cost || 0)}</strong>
+                    </span>
+                </div>
+            `;
         });
+
+        listEl.innerHTML = html;
+    }
+
+    async renderCharts(data) {
+        if (!data) return;
+
+        await this.chartLibPromise;
+        if (typeof Chart === 'undefined') return;
+
+        this.createCharts(data);
     }
 
     createCharts(data) {
         const { cost_trends, pool_distribution } = data;
 
-        if (cost_trends && cost_trends.months && cost_trends.months.length > 0) {
-            this.createCostTrendsChart(cost_trends);
-        } else {
-            document.getElementById('trends_no_data').style.display = 'block';
+        // Разделы приходят по отдельности - рисуем только полученные
+        if ('cost_trends' in data) {
+            const hasTrends = cost_trends && cost_trends.months && cost_trends.months.length > 0;
+            if (hasTrends) {
+                this.createCostTrendsChart(cost_trends);
+            } else {
+                this.destroyChart('costTrends');
+            }
+            document.getElementById('trends_no_data').style.display = hasTrends ? 'none' : 'block';
         }
 
-        if (pool_distribution && pool_distribution.length > 0) {
-            this.createPoolDistributionChart(pool_distribution);
-        } else {
-            document.getElementById('pools_no_data').style.display = 'block';
+        if ('pool_distribution' in data) {
+            const hasPools = pool_distribution && pool_distribution.length > 0;
+            if (hasPools) {
+                this.createPoolDistributionChart(pool_distribution);
+            } else {
+                this.destroyChart('poolDistribution');
+            }
+            document.getElementById('pools_no_data').style.display = hasPools ? 'none' : 'block';
         }
 
         this.state.chartsLoaded = true;
     }
 
+    destroyChart(name) {
+        if (this.charts[name]) {
+            this.charts[name].destroy();
+            delete this.charts[name];
+        }
+    }
+
     createCostTrendsChart(trendData) {
         const ctx = document.getElementById('costTrendsChart');
         if (!ctx || !trendData || !trendData.months || !trendData.total_costs) return;
@@ -521,7 +775,16 @@ export class CostAllocationDashboard extends Component {
                 return date.toLocaleDateString('en-US', { month: 'short', year: '2-digit' });
             });
 
-            new Chart(ctx, {
+            // Повторная загрузка обновляет существующий график вместо пересоздания
+            const chart = this.charts.costTrends;
+            if (chart) {
+                chart.data.labels = labels;
+                chart.data.datasets[0].data = trendData.total_costs;
+                chart.update();
+                return;
+            }
+
+            this.charts.costTrends = new Chart(ctx, {
                 type: 'line',
                 data: {
                     labels: labels,
@@ -572,7 +835,16 @@ export class CostAllocationDashboard extends Component {
             const costs = poolData.map(pool => pool.cost || 0);
             const colors = this.generateColors(poolData.length);
 
-            new Chart(ctx, {
+            const chart = this.charts.poolDistribution;
+            if (chart) {
+                chart.data.labels = labels;
+                chart.data.datasets[0].data = costs;
+                chart.data.datasets[0].backgroundColor = colors;
+                chart.update();
+                return;
+            }
+
+            this.charts.poolDistribution = new Chart(ctx, {
                 type: 'doughnut',
                 data: {
                     labels: labels,
@@ -702,6 +974,12 @@ export class CostAllocationDashboard extends Component {
     }
 
     cleanup() {
+        this.busService.unsubscribe("cost_allocation/kpi_update", this.onKpiUpdate);
+        clearTimeout(this.refreshTimer);
+
+        Object.values(this.charts).forEach(chart => chart.destroy());
+        this.charts = {};
+
         // Clean up event listeners if needed
         document.querySelectorAll('.period-select').forEach(btn => {
             btn.removeEventListener('click', this.changePeriod);
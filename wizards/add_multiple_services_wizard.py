@@ -1,6 +1,6 @@
 # wizards/add_multiple_services_wizard.py
 
-from odoo import models, fields, api, _
+from odoo import models, fields, api, _, Command
 from odoo.exceptions import ValidationError
 
 
@@ -23,32 +23,34 @@ class AddMultipleServicesWizard(models.TransientModel):
             raise ValidationError(_('Please select at least one service to add.'))
 
         # Create subscription lines for each selected service
+        # Все новые строки и обновления количеств - одной записью подписки
+        existing_lines = {line.service_id: line for line in self.subscription_id.service_line_ids}
+        commands = []
         lines_created = 0
         for service in self.service_ids:
             # Check if service already exists in subscription
-            existing_line = self.subscription_id.service_line_ids.filtered(
-                lambda l: l.service_id.id == service.id  # ИСПРАВЛЕНО: правильное поле
-            )
+            existing_line = existing_lines.get(service)  # ИСПРАВЛЕНО: правильное поле
 
             if existing_line:
                 # Update quantity instead of creating duplicate
-                existing_line.quantity += self.default_quantity
+                commands.append(Command.update(existing_line.id, {
+                    'quantity': existing_line.quantity + self.default_quantity,
+                }))
             else:
                 # Create new subscription line
                 # ИСПРАВЛЕНО: используем base_cost вместо sales_price
                 unit_price = self.default_unit_price or service.base_cost or 0.0
 
-                vals = {
-                    'subscription_id': self.subscription_id.id,
+                commands.append(Command.create({
                     'service_id': service.id,  # ИСПРАВЛЕНО: правильное поле
                     'name': service.name,
                     'quantity': self.default_quantity,
                     'unit_price': unit_price,
-                }
-
-                self.env['client.service.subscription.line'].create(vals)
+                }))
                 lines_created += 1
 
+        self.subscription_id.write({'service_line_ids': commands})
+
         # Show notification
         message = _('Successfully added %d services to subscription.') % lines_created
         if lines_created != len(self.service_ids):
@@ -22,25 +22,20 @@ class AllocationWizard(models.TransientModel):
 
     def action_create_allocations(self):
         """Create allocations for selected clients and period"""
-        allocations = self.env['client.cost.allocation']
+        existing = self.env['client.cost.allocation'].search([
+            ('client_id', 'in', self.client_ids.ids),
+            ('period_date', '=', self.period_date)
+        ])
+        existing_clients = set(existing.client_id.ids)
 
-        for client in self.client_ids:
-            # Check if allocation already exists
-            existing = self.env['client.cost.allocation'].search([
-                ('client_id', '=', client.id),
-                ('period_date', '=', self.period_date)
-            ])
+        allocations = self.env['client.cost.allocation'].create([{
+            'client_id': client.id,
+            'period_date': self.period_date,
+        } for client in self.client_ids if client.id not in existing_clients])
 
-            if not existing:
-                allocation = self.env['client.cost.allocation'].create({
-                    'client_id': client.id,
-                    'period_date': self.period_date,
-                })
-
-                if self.auto_calculate:
-                    allocation.action_calculate_costs()
-
-                allocations |= allocation
+        if self.auto_calculate and allocations:
+            # Расчет одним батчем - факты по табелям собираются один раз на период
+            allocations.action_calculate_costs()
 
         # Return action to show created allocations
         action = self.env.ref('cost_allocation.action_client_allocation').read()[0]
@@ -73,6 +68,26 @@ class CostReportWizard(models.TransientModel):
             res['period_to'] = today
         return res
 
+    def action_export_csv(self):
+        """Stream allocation detail for the period as CSV"""
+        return self._get_export_action('csv')
+
+    def action_export_xlsx(self):
+        """Stream allocation detail for the period as XLSX"""
+        return self._get_export_action('xlsx')
+
+    def _get_export_action(self, export_format):
+        self.ensure_one()
+        url = (f'/cost_allocation/export/allocations?export_format={export_format}'
+               f'&date_from={self.period_from}&date_to={self.period_to}')
+        if self.client_ids:
+            url += '&client_ids=' + ','.join(str(client_id) for client_id in self.client_ids.ids)
+        return {
+            'type': 'ir.actions.act_url',
+            'url': url,
+            'target': 'self',
+        }
+
     def action_generate_report(self):
         """Generate cost allocation report"""
         # Get allocations for the period
@@ -1,7 +1,9 @@
 # wizards/client_services_wizard.py - НОВЫЙ ВИЗАРД
 
-from odoo import models, fields, api
-from datetime import datetime, date
+from odoo import models, fields, api, Command
+from odoo.exceptions import UserError
+from datetime import datetime, date, timedelta
+from dateutil.relativedelta import relativedelta
 
 
 class ClientServicesWizard(models.TransientModel):
@@ -50,17 +52,7 @@ class ClientServicesWizard(models.TransientModel):
         self.service_line_ids.unlink()
 
         # Поиск всех драйверов затрат для клиента
-        domain = [('client_id', '=', self.client_id.id)]
-
-        # Применить фильтры
-        if self.pool_ids:
-            domain.append(('driver_id.pool_id', 'in', self.pool_ids.ids))
-        if self.service_category_ids:
-            domain.append(('driver_id.driver_category_id', 'in', self.service_category_ids.ids))
-        if not self.include_inactive:
-            domain.append(('driver_id.active', '=', True))
-
-        client_drivers = self.env['client.cost.driver'].search(domain)
+        client_drivers = self.env['client.cost.driver'].search(self._get_driver_domain(self.client_id))
 
         # Создать строки результатов
         for driver_allocation in client_drivers:
@@ -91,10 +83,29 @@ class ClientServicesWizard(models.TransientModel):
         }
 
     def action_export_to_excel(self):
-        """Экспорт в Excel"""
-        # Можно добавить позже
+        """Экспорт распределений клиента за месяц с детализацией по драйверам (XLSX, потоково)"""
         self.ensure_one()
-        return self.env.ref('cost_allocation.action_client_services_report').report_action(self)
+        date_from = self.period_date.replace(day=1)
+        date_to = date_from + relativedelta(months=1) - timedelta(days=1)
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/cost_allocation/export/allocations?export_format=xlsx'
+                   f'&date_from={date_from}&date_to={date_to}&client_ids={self.client_id.id}',
+            'target': 'self',
+        }
+
+    def _get_driver_domain(self, clients):
+        """Client cost drivers of the clients, with the wizard filters applied"""
+        domain = [('client_id', 'in', clients.ids)]
+
+        # Применить фильтры
+        if self.pool_ids:
+            domain.append(('driver_id.pool_id', 'in', self.pool_ids.ids))
+        if self.service_category_ids:
+            domain.append(('driver_id.driver_category_id', 'in', self.service_category_ids.ids))
+        if not self.include_inactive:
+            domain.append(('driver_id.active', '=', True))
+        return domain
 
     def action_create_subscription(self):
         """Создать подписку на основе услуг"""
@@ -103,49 +114,19 @@ class ClientServicesWizard(models.TransientModel):
         if not self.service_line_ids:
             raise UserError("No services found. Please load services first.")
 
-        # Создать подписку
-        subscription = self.env['client.service.subscription'].create({
-            'name': f"{self.client_id.name} Services - {self.period_date.strftime('%Y-%m')}",
-            'client_id': self.client_id.id,
-            'start_date': self.period_date,
-            'status': 'draft',
-        })
-
-        # Создать строки подписки
-        for line in self.service_line_ids:
-            # Найти или создать service catalog entry
-            service_catalog = self.env['service.catalog'].search([
-                ('name', 'ilike', line.driver_name)
-            ], limit=1)
-
-            if not service_catalog:
-                # Создать новый service catalog
-                category = self.env['service.category'].search([
-                    ('name', 'ilike', line.category_name)
-                ], limit=1)
-                if not category:
-                    category = self.env['service.category'].create({
-                        'name': line.category_name,
-                        'service_type': 'support'
-                    })
-
-                service_catalog = self.env['service.catalog'].create({
-                    'name': line.driver_name,
-                    'category_id': category.id,
-                    'unit_of_measure': 'unit',
-                    'base_cost': line.unit_cost,
-                    'markup_percent': (
-                                (line.unit_price - line.unit_cost) / line.unit_cost * 100) if line.unit_cost > 0 else 0,
-                })
-
-            # Создать subscription line
-            self.env['client.service.subscription.line'].create({
-                'subscription_id': subscription.id,
-                'service_catalog_id': service_catalog.id,
+        subscription = self._build_subscriptions(self.client_id, self.period_date, [
+            {
+                'client_id': self.client_id.id,
+                'driver': line.driver_id,
+                'name': line.driver_name,
+                'category_name': line.category_name,
+                'unit_id': line.driver_id.unit_id.id,
                 'quantity': line.quantity,
+                'unit_cost': line.unit_cost,
                 'unit_price': line.unit_price,
-                'total_price': line.total_revenue,
-            })
+            }
+            for line in self.service_line_ids
+        ])
 
         return {
             'type': 'ir.actions.act_window',
@@ -155,6 +136,81 @@ class ClientServicesWizard(models.TransientModel):
             'target': 'current',
         }
 
+    @api.model
+    def _create_subscriptions_for_clients(self, clients, period_date=None):
+        """Create a draft subscription per client from all its cost drivers
+
+        One search for the drivers of all clients, one pass to resolve the
+        catalog and one multi-create for the subscriptions with their lines.
+        """
+        period_date = period_date or fields.Date.today()
+        client_drivers = self.env['client.cost.driver'].search(
+            self._get_driver_domain(clients), order='client_id, id')
+        if not client_drivers:
+            raise UserError("None of the selected clients has cost drivers to subscribe to.")
+
+        subscriptions = self._build_subscriptions(client_drivers.client_id, period_date, [
+            {
+                'client_id': allocation.client_id.id,
+                'driver': allocation.driver_id,
+                'name': allocation.driver_id.name,
+                'category_name': allocation.driver_id.driver_category_id.name or 'Uncategorized',
+                'unit_id': allocation.driver_id.unit_id.id,
+                'quantity': allocation.quantity,
+                'unit_cost': allocation.driver_id.cost_per_unit,
+                'unit_price': allocation.driver_id.sales_price_per_unit,
+            }
+            for allocation in client_drivers
+        ])
+
+        return {
+            'type': 'ir.actions.act_window',
+            'name': 'Created Subscriptions',
+            'res_model': 'client.service.subscription',
+            'view_mode': 'tree,form',
+            'domain': [('id', 'in', subscriptions.ids)],
+            'target': 'current',
+        }
+
+    @api.model
+    def _build_subscriptions(self, clients, period_date, service_lines):
+        """Bulk subscription builder: one draft subscription per client
+
+        Catalog items for all service names are resolved (or created) in one
+        pass, then all subscriptions are created with their lines in a single
+        create. Lines are metered from their cost driver, so the billing
+        usage-rating stage keeps quantities in sync.
+
+        :param service_lines: list of dicts with client_id, driver, name,
+                              category_name, unit_id, quantity, unit_cost, unit_price
+        :return: created client.service.subscription records
+        """
+        catalogs = self.env['service.catalog']._resolve_by_names({
+            line['name']: line for line in service_lines
+        })
+
+        lines_by_client = {client.id: [] for client in clients}
+        for line in service_lines:
+            lines_by_client[line['client_id']].append(line)
+
+        return self.env['client.service.subscription'].create([{
+            'name': f"{client.name} Services - {period_date.strftime('%Y-%m')}",
+            'client_id': client.id,
+            'start_date': period_date,
+            'state': 'draft',
+            'service_line_ids': [
+                Command.create({
+                    'service_id': catalogs[line['name'].lower()].id,
+                    'name': line['name'],
+                    'quantity': line['quantity'],
+                    'unit_price': line['unit_price'],
+                    'usage_source': 'driver' if line['driver'] else 'fixed',
+                    'usage_driver_id': line['driver'].id,
+                })
+                for line in lines_by_client[client.id]
+            ],
+        } for client in clients])
+
 
 class ClientServicesWizardLine(models.TransientModel):
     _name = 'client.services.wizard.line'
@@ -1,6 +1,7 @@
 # wizards/service_cost_breakdown_wizard.py
 
 from odoo import models, fields, api
+from dateutil.relativedelta import relativedelta
 
 
 class ServiceCostBreakdownWizard(models.TransientModel):
@@ -104,11 +105,17 @@ class ServiceCostBreakdownWizard(models.TransientModel):
                     ('active', '=', True)
                 ])
                 employee_costs_data = {ec.employee_id.id: ec for ec in employee_costs}
+
+                # Фактические часы и затраты за прошлый месяц - из таблицы фактов по табелям
+                last_period = fields.Date.today().replace(day=1) - relativedelta(months=1)
+                timesheet_totals = self.env['timesheet.cost.fact']._get_employee_totals(
+                    last_period, employees.ids)
                 _logger.info(f"Found cost records for: {list(employee_costs_data.keys())}")
 
                 # Создать линию для каждого сотрудника
                 for employee in employees:
                     emp_cost = employee_costs_data.get(employee.id)
+                    period_hours, period_cost = timesheet_totals.get(employee.id, (0.0, 0.0))
 
                     if emp_cost:
                         cost_per_unit = emp_cost.hourly_cost * (service_catalog.support_hours_per_unit or 1.0)
@@ -117,7 +124,9 @@ class ServiceCostBreakdownWizard(models.TransientModel):
                             'monthly_cost': emp_cost.monthly_total_cost,
                             'hourly_cost': emp_cost.hourly_cost,
                             'cost_per_service_unit': cost_per_unit,
-                            'has_cost_record': True
+                            'has_cost_record': True,
+                            'period_hours': period_hours,
+                            'period_cost': period_cost,
                         }
                         _logger.info(f"Employee {employee.name}: {line_vals}")
                     else:
@@ -126,7 +135,9 @@ class ServiceCostBreakdownWizard(models.TransientModel):
                             'monthly_cost': 0.0,
                             'hourly_cost': 0.0,
                             'cost_per_service_unit': 0.0,
-                            'has_cost_record': False
+                            'has_cost_record': False,
+                            'period_hours': period_hours,
+                            'period_cost': period_cost,
                         }
                         _logger.info(f"Employee {employee.name}: NO COST RECORD")
 
@@ -236,5 +247,9 @@ class ServiceCostBreakdownLine(models.TransientModel):
     hourly_cost = fields.Float(string='Hourly Cost', readonly=True)
     cost_per_service_unit = fields.Monetary(string='Cost per Service Unit', currency_field='currency_id', readonly=True)
     has_cost_record = fields.Boolean(string='Has Cost Record', readonly=True)
+    period_hours = fields.Float(string='Hours Last Month', readonly=True,
+                                help='Timesheet hours logged in the previous month')
+    period_cost = fields.Monetary(string='Cost Last Month', currency_field='currency_id', readonly=True,
+                                  help='Timesheet cost of the previous month at the rate in effect then')
 
     currency_id = fields.Many2one(related='wizard_id.currency_id', readonly=True)
\ No newline at end of file